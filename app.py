@@ -8,21 +8,39 @@
 # -------------------------------------------------------------------------
 
 import os
+import re
 import json
+import math
 import time
-from datetime import datetime, timedelta
+import zlib
+import hashlib
+import queue
+import atexit
+import heapq
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
 
 # External Libraries
-import requests
+# requests, googletrans, numpy and telegram.ext are imported where they are first needed,
+# so a cold start (e.g. on Vercel) does not pay for them before the first update.
 from flask import Flask, request, jsonify
-from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Dispatcher, CommandHandler, MessageHandler, Filters
-from googletrans import Translator
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean
-from sqlalchemy.orm import sessionmaker
+from telegram import Bot, Update, Message, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import BadRequest, RetryAfter
+from telegram.utils.helpers import DefaultValue
+from sqlalchemy import create_engine, Column, Integer, BigInteger, Float, String, Text, Date, DateTime, Boolean
+from sqlalchemy import Table, ForeignKey, Index, event, inspect, select, case, or_, text, func, literal_column
+from sqlalchemy import insert as insert_statement, update as update_statement, bindparam
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, OperationalError, IntegrityError
 from random import choice
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
 
 # -------------------------------------------------------------------------
 # 1. CONFIGURATION & ENVIRONMENT VARIABLES
@@ -34,6 +52,142 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 # Custom AI API Configuration
 GAP_API_URL = os.environ.get('GAP_API_URL')
 GAP_API_KEY = os.environ.get('GAP_API_KEY')
+GAP_MODEL = os.environ.get('GAP_MODEL', 'gpt-3.5-turbo')
+# Schema setup: with AUTO_MIGRATE=true the first database access reads the stored
+# schema version (one query) and only migrates when it is behind SCHEMA_VERSION.
+# Set it to false in production and run `python app.py migrate`
+# (or `flask --app app migrate`) once per deploy to keep it off the request path.
+AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', 'true').lower() == 'true'
+
+# Database Connection Pooling
+# 'serverless': no pooling (NullPool) - every session opens and closes its own
+#               connection, so frozen instances never hold idle Postgres
+#               connections; put pgbouncer in front for connection reuse.
+# 'server':     sized QueuePool with pre-ping and recycling for long-running servers.
+# 'auto':       'serverless' on Vercel/AWS Lambda, 'server' everywhere else.
+DB_POOL_PROFILE = os.environ.get('DB_POOL_PROFILE', 'auto').lower()
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))  # Max seconds to wait for a connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))  # Seconds before a connection is replaced
+# GAP HTTP client tuning: keep-alive pool, timeouts (seconds), retries and circuit breaker
+GAP_POOL_SIZE = int(os.environ.get('GAP_POOL_SIZE', '10'))
+GAP_CONNECT_TIMEOUT = float(os.environ.get('GAP_CONNECT_TIMEOUT', '3.05'))
+GAP_READ_TIMEOUT = float(os.environ.get('GAP_READ_TIMEOUT', '30'))
+GAP_MAX_RETRIES = int(os.environ.get('GAP_MAX_RETRIES', '3'))
+GAP_RETRY_BUDGET = float(os.environ.get('GAP_RETRY_BUDGET', '8'))  # Max total backoff per call
+GAP_BREAKER_THRESHOLD = int(os.environ.get('GAP_BREAKER_THRESHOLD', '5'))  # Consecutive failures
+GAP_BREAKER_RESET = float(os.environ.get('GAP_BREAKER_RESET', '30'))  # Seconds the circuit stays open
+
+# AI Summary Cache Configuration
+# Bump SUMMARY_PROMPT_VERSION whenever the summarization prompt changes, so old
+# cached summaries are no longer served.
+SUMMARY_PROMPT_VERSION = 'v2'
+SUMMARY_CACHE_ENABLED = os.environ.get('SUMMARY_CACHE_ENABLED', 'true').lower() == 'true'
+SUMMARY_CACHE_SIZE = int(os.environ.get('SUMMARY_CACHE_SIZE', '256'))  # In-memory entries
+SUMMARY_CACHE_TTL = int(os.environ.get('SUMMARY_CACHE_TTL', str(30 * 24 * 3600)))  # Seconds
+# Long texts are summarized map-reduce style: chunks of ~SUMMARY_CHUNK_TOKENS are
+# summarized in parallel (at most SUMMARY_MAX_PARALLEL GAP calls) and then combined.
+SUMMARY_CHUNK_TOKENS = int(os.environ.get('SUMMARY_CHUNK_TOKENS', '2000'))
+SUMMARY_MAX_PARALLEL = int(os.environ.get('SUMMARY_MAX_PARALLEL', '4'))
+SUMMARY_MAX_CHUNKS = int(os.environ.get('SUMMARY_MAX_CHUNKS', '24'))
+SUMMARY_MAX_REDUCE_ROUNDS = 3
+# Stream the final completion (SSE) into a placeholder reply that is edited at most
+# every SUMMARY_STREAM_EDIT_INTERVAL seconds (group chats are slowed to their edit limit).
+SUMMARY_STREAMING_ENABLED = os.environ.get('SUMMARY_STREAMING_ENABLED', 'true').lower() == 'true'
+SUMMARY_STREAM_EDIT_INTERVAL = float(os.environ.get('SUMMARY_STREAM_EDIT_INTERVAL', '1.0'))
+DIGEST_DEFAULT_ITEMS = int(os.environ.get('DIGEST_DEFAULT_ITEMS', '10'))  # /summary digest
+DIGEST_MAX_ITEMS = int(os.environ.get('DIGEST_MAX_ITEMS', '50'))
+
+# Statistics Configuration
+# With rollups enabled the write handlers keep per-day counters in daily_stats,
+# so /summary reads O(days) rows instead of scanning tasks/archive/activity_log.
+STATS_ROLLUP_ENABLED = os.environ.get('STATS_ROLLUP_ENABLED', 'false').lower() == 'true'
+
+# Updates slower than this (milliseconds) are logged; 0 disables the slow-update log
+SLOW_UPDATE_MS = int(os.environ.get('SLOW_UPDATE_MS', '2000'))
+
+# Number of tasks per /tasks page
+TASKS_PAGE_SIZE = int(os.environ.get('TASKS_PAGE_SIZE', '10'))
+
+# Maximum number of ids/items accepted by one bulk command (/done 12-15, /buy add a, b, c)
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '50'))
+
+# Translation Cache Configuration
+TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE', '1024'))  # In-memory entries
+
+# Update Processing Configuration
+# 'sync' handles every update inside the webhook request (default, safe on Vercel).
+# 'async' acknowledges Telegram immediately and processes updates on a background
+# worker pool; use it on long-running servers (gunicorn, Procfile deployments).
+UPDATE_PROCESSING_MODE = os.environ.get('UPDATE_PROCESSING_MODE', 'sync').lower()
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '4'))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '100'))
+UPDATE_DRAIN_TIMEOUT = float(os.environ.get('UPDATE_DRAIN_TIMEOUT', '25'))
+# In 'sync' mode, return a handler's first Bot API call (usually its reply) in the
+# webhook response body instead of a separate HTTPS request to Telegram.
+WEBHOOK_REPLY_ENABLED = os.environ.get('WEBHOOK_REPLY_ENABLED', 'false').lower() == 'true'
+
+# Outbound Message Shaping (Telegram flood limits: ~30 msg/s overall, ~1 msg/s per
+# chat and 20 msg/min per group). Background senders wait for a token; the webhook
+# request thread never waits and hands calls without a token to a delivery thread.
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', '30'))  # Messages per second
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', '1'))  # Messages per second, private chats
+OUTBOUND_GROUP_RATE_PER_MINUTE = float(os.environ.get('OUTBOUND_GROUP_RATE_PER_MINUTE', '20'))
+OUTBOUND_CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', '3'))  # Back-to-back messages, private chats (groups: the per-minute rate)
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', '3'))  # Retries after a 429
+OUTBOUND_MAX_WAIT = float(os.environ.get('OUTBOUND_MAX_WAIT', '20'))  # Longer waits go to the deferred delivery thread
+OUTBOUND_DEFERRED_QUEUE_SIZE = int(os.environ.get('OUTBOUND_DEFERRED_QUEUE_SIZE', '1000'))  # Calls waiting for a token
+
+# Link Metadata (title/description/canonical URL of archived links, fetched in the background)
+LINK_METADATA_ENABLED = os.environ.get('LINK_METADATA_ENABLED', 'true').lower() == 'true'
+LINK_FETCH_WORKERS = int(os.environ.get('LINK_FETCH_WORKERS', '4'))
+LINK_FETCH_PER_HOST = int(os.environ.get('LINK_FETCH_PER_HOST', '2'))  # Concurrent requests per host
+LINK_FETCH_MAX_BYTES = int(os.environ.get('LINK_FETCH_MAX_BYTES', str(256 * 1024)))  # Download cap per page
+LINK_FETCH_TIMEOUT = float(os.environ.get('LINK_FETCH_TIMEOUT', '5'))  # Read timeout, seconds
+# Only for local testing: allow fetching loopback/private addresses (blocked to prevent SSRF)
+LINK_FETCH_ALLOW_PRIVATE = os.environ.get('LINK_FETCH_ALLOW_PRIVATE', 'false').lower() == 'true'
+
+# Related Items (/related and "similar items" in /search): hashed TF-IDF vectors of
+# archive items, computed locally with NumPy and kept in memory-mapped files.
+RELATED_ENABLED = os.environ.get('RELATED_ENABLED', 'true').lower() == 'true'
+RELATED_INDEX_DIR = os.environ.get('RELATED_INDEX_DIR', '/tmp/hugger-related')  # Must be writable (Vercel: /tmp)
+RELATED_VECTOR_DIM = int(os.environ.get('RELATED_VECTOR_DIM', '256'))  # 100k items x 256 floats = 100 MB on disk
+RELATED_MIN_SCORE = float(os.environ.get('RELATED_MIN_SCORE', '0.15'))  # Cosine similarity below this is noise
+RELATED_REFRESH_MAX_ROWS = int(os.environ.get('RELATED_REFRESH_MAX_ROWS', '2000'))  # Items one refresh may vectorize
+
+# Update Ledger: every update_id is claimed once in the database, so Telegram
+# redeliveries and concurrent workers/instances never process an update twice.
+UPDATE_LEDGER_ENABLED = os.environ.get('UPDATE_LEDGER_ENABLED', 'true').lower() == 'true'
+UPDATE_LEASE_SECONDS = int(os.environ.get('UPDATE_LEASE_SECONDS', '120'))  # A crashed claim can be retaken after this
+UPDATE_LEDGER_RETENTION_HOURS = int(os.environ.get('UPDATE_LEDGER_RETENTION_HOURS', '48'))
+UPDATE_LEDGER_PRUNE_EVERY = int(os.environ.get('UPDATE_LEDGER_PRUNE_EVERY', '500'))  # Claims between prunes
+
+# Retention: done tasks, bought shopping items and activity logs older than
+# RETENTION_DAYS are counted into monthly_rollups and moved to *_archive tables
+# by POST <WEBHOOK_PATH>/maintenance/retention (or `python app.py retention`).
+RETENTION_DAYS = max(30, int(os.environ.get('RETENTION_DAYS', '180')))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '1000'))
+RETENTION_MAX_BATCHES = int(os.environ.get('RETENTION_MAX_BATCHES', '20'))  # Per call, so one run stays short
+
+# Due-date Reminders: assignees are reminded REMINDER_LEAD_HOURS before a task's
+# due date ('upcoming') and when it passes ('overdue'), one message per chat.
+# 'thread' runs an in-process scheduler (long-running servers); 'cron' relies on
+# POST <WEBHOOK_PATH>/reminders being called periodically (serverless).
+REMINDERS_ENABLED = os.environ.get('REMINDERS_ENABLED', 'true').lower() == 'true'
+REMINDER_MODE = os.environ.get('REMINDER_MODE', 'thread' if UPDATE_PROCESSING_MODE == 'async' else 'cron').lower()
+REMINDER_LEAD_HOURS = float(os.environ.get('REMINDER_LEAD_HOURS', '24'))  # 0 disables 'upcoming' reminders
+REMINDER_CATCHUP_HOURS = float(os.environ.get('REMINDER_CATCHUP_HOURS', '24'))  # Longest window sent after downtime
+REMINDER_HORIZON_HOURS = float(os.environ.get('REMINDER_HORIZON_HOURS', '6'))  # Fire times loaded per heap refill
+
+# /mywork exports: spooled to disk above EXPORT_SPOOL_BYTES; Telegram bots may upload up to 50 MB
+EXPORT_SPOOL_BYTES = int(os.environ.get('EXPORT_SPOOL_BYTES', str(1024 * 1024)))
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+# Learned user profiles are cached in memory for this many seconds
+USER_DIRECTORY_TTL = int(os.environ.get('USER_DIRECTORY_TTL', '300'))
+# Ids/@usernames with no stored profile are not looked up again for this many seconds
+USER_DIRECTORY_MISS_TTL = int(os.environ.get('USER_DIRECTORY_MISS_TTL', '60'))
 
 # Default User Mapping (to personalize messages)
 # The application will try to load USER_NAMES_MAP from environment variables first.
@@ -46,120 +200,3036 @@ DEFAULT_USER_MAP = {
     "1140241105": "حمیدرضا" # Hamidreza Mousivand
 }
 
-# -------------------------------------------------------------------------
-# 2. DATABASE SETUP (SQLAlchemy)
-# -------------------------------------------------------------------------
+# -------------------------------------------------------------------------
+# 2. DATABASE SETUP (SQLAlchemy)
+# -------------------------------------------------------------------------
+
+if not DATABASE_URL:
+    print("FATAL: DATABASE_URL is not set. The application will not work without a database connection.")
+
+# Database Initialization
+# The engine is created on first use, not at import time.
+Base = declarative_base()
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker()
+
+# Request-scoped session: handlers share one session per update (per thread);
+# process_update() removes it once the update has been handled.
+db_session = scoped_session(_session_factory)
+
+
+class PoolMetrics:
+    """Connection pool counters: checkout waits, opened connections and connections in use."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.connections_opened = 0
+        self.timeouts = 0
+
+    def record_checkout(self, waited, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def record_connect(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def stats(self, pool=None):
+        with self._lock:
+            snapshot = {
+                'checkouts': self.checkouts,
+                'checkout_wait_ms_avg': round(self.wait_seconds_total / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                'checkout_wait_ms_max': round(self.wait_seconds_max * 1000, 2),
+                'checkout_timeouts': self.timeouts,
+                'connections_opened': self.connections_opened,
+            }
+        if pool is not None:
+            snapshot['pool_class'] = type(pool).__name__
+            snapshot['pool_status'] = pool.status()
+            if hasattr(pool, 'checkedout'):
+                snapshot['connections_in_use'] = pool.checkedout()
+                snapshot['connections_idle'] = pool.checkedin()
+        return snapshot
+
+
+pool_metrics = PoolMetrics()
+
+
+class _TimedPoolMixin:
+    """Measures how long each connection checkout waits (pool queue + connect time)."""
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except SQLAlchemyError:
+            pool_metrics.record_checkout(0.0, timed_out=True)
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - started_at)
+        return connection
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedNullPool(_TimedPoolMixin, NullPool):
+    pass
+
+
+def resolve_pool_profile():
+    """Returns 'serverless' or 'server' for DB_POOL_PROFILE (resolving 'auto')."""
+    if DB_POOL_PROFILE in ('serverless', 'server'):
+        return DB_POOL_PROFILE
+    serverless = os.environ.get('VERCEL') or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    return 'serverless' if serverless else 'server'
+
+
+def create_app_engine(url=None):
+    """Creates an engine with the pooling profile of this deployment."""
+    url = url or DATABASE_URL
+    if ':memory:' in str(url):
+        # In-memory SQLite lives in one connection; keep SQLAlchemy's default pool
+        options = {}
+    elif resolve_pool_profile() == 'serverless':
+        options = {'poolclass': TimedNullPool}
+    else:
+        options = {
+            'poolclass': TimedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': True,
+        }
+    new_engine = create_engine(url, echo=False, **options)
+    event.listen(new_engine, 'connect', lambda dbapi_connection, record: pool_metrics.record_connect())
+    instrument_engine(new_engine)
+    return new_engine
+
+
+def get_engine():
+    """Returns the shared engine, creating it (and, with AUTO_MIGRATE, the schema) on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                new_engine = create_app_engine()
+                if AUTO_MIGRATE and not schema_is_current(new_engine):
+                    migrate(new_engine)
+                _session_factory.configure(bind=new_engine)
+                _engine = new_engine
+    return _engine
+
+
+def Session(**kwargs):
+    """Opens a standalone ORM session on the shared engine (or on an explicit bind=...)."""
+    if 'bind' not in kwargs:
+        kwargs['bind'] = get_engine()
+    return _session_factory(**kwargs)
+
+
+def get_db_session():
+    """Returns the session of the update being processed (created on first use)."""
+    get_engine()  # Binds the session factory on first use
+    session = db_session()
+    session.info['request_scoped'] = True  # Its first commit also marks the update done (UpdateLedger)
+    return session
+
+# Search Text Normalization (Persian/Arabic)
+# Arabic code points that have a distinct Persian form are folded into it, and
+# characters that only change rendering (ZWNJ, tatweel, diacritics) are dropped,
+# so "كتاب‌ها" and "کتاب ها" index and match the same way.
+_PERSIAN_NORMALIZATION_TABLE = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی',
+    'ك': 'ک',
+    'ة': 'ه', 'ۀ': 'ه',
+    'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا',
+    'ؤ': 'و',
+    '\u200c': ' ',  # ZWNJ (نیم‌فاصله)
+    '\u200d': None, '\u200e': None, '\u200f': None,
+    'ـ': None,  # Tatweel
+    **{chr(code): None for code in range(0x064B, 0x0653)},  # Harakat
+    '\u0670': None,
+    **{persian: str(i) for i, persian in enumerate('۰۱۲۳۴۵۶۷۸۹')},
+    **{arabic: str(i) for i, arabic in enumerate('٠١٢٣٤٥٦٧٨٩')},
+})
+
+
+def normalize_persian_text(value):
+    """Normalizes Persian/Arabic text for indexing and searching."""
+    if not value:
+        return ''
+    return ' '.join(value.translate(_PERSIAN_NORMALIZATION_TABLE).lower().split())
+
+
+def normalize_tag(name):
+    """Normalizes a tag ('#برنامه‌نویسی' -> 'برنامه_نویسی') so equal tags share one row."""
+    return '_'.join(normalize_persian_text(name.strip().lstrip('#')).split())[:64]
+
+
+def parse_tags(tags_text):
+    """Splits a stored comma-joined tags string into unique normalized tag names."""
+    names = (normalize_tag(part) for part in (tags_text or '').split(','))
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def search_terms(query_text, max_terms=8):
+    """Splits a search query into normalized word terms (underscores in tags split words too)."""
+    return re.findall(r'[^\W_]+', normalize_persian_text(query_text))[:max_terms]
+
+
+# Query parameters that only track where a click came from
+_TRACKING_PARAMS = re.compile(r'^(utm_\w+|fbclid|gclid|yclid|mc_cid|mc_eid|igshid|si|ref|ref_src)$', re.I)
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url):
+    """
+    Normalizes a URL so equal pages compare equal: lower-case scheme and host,
+    no default port, fragment or tracking parameters, sorted query, and no
+    trailing slash on the path.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if port and port != _DEFAULT_PORTS.get(scheme):
+        netloc += f':{port}'
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not _TRACKING_PARAMS.match(key)
+    ))
+    path = parts.path.rstrip('/') if parts.path not in ('', '/') else ''
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def archive_content_hash(content):
+    """Content hash for duplicate detection: the canonical URL for links, normalized text otherwise."""
+    content = (content or '').strip()
+    if content.startswith('http') and not any(char.isspace() for char in content):
+        material = 'link:' + canonicalize_url(content)
+    else:
+        material = 'text:' + normalize_persian_text(content)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+# Task Model (وظایف تیم)
+class Task(Base):
+    __tablename__ = 'tasks'
+    id = Column(Integer, primary_key=True)
+    title = Column(String(256), nullable=False)
+    assigned_to = Column(String(64))  # Telegram User ID
+    due_date = Column(DateTime)
+    status = Column(String(32), default='To Do')
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime)  # Set when the task is marked 'Done'
+    chat_id = Column(String(64))  # Chat the task was added in; due-date reminders go there
+
+    # /tasks pages are keyset range scans over (status, id), optionally per assignee
+    # (matched case-insensitively); overdue lookups and reminders scan (status, due_date).
+    __table_args__ = (
+        Index('ix_tasks_status_id', 'status', 'id'),
+        Index('ix_tasks_assignee_status_id', func.lower(assigned_to), status, id),
+        Index('ix_tasks_status_due_date', 'status', 'due_date'),
+    )
+
+# Task statuses that count as "still open"
+ACTIVE_TASK_STATUSES = ['To Do', 'In Progress']
+
+# User Directory Model (اعضای گروه) - learned from incoming updates
+class BotUser(Base):
+    __tablename__ = 'users'
+    id = Column(String(64), primary_key=True)  # Telegram User ID
+    username = Column(String(64), index=True)
+    first_name = Column(String(128))
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# Tag Index (تگ‌های آرشیو) - many-to-many between archive items and tags
+archive_tags = Table(
+    'archive_tags', Base.metadata,
+    Column('archive_id', Integer, ForeignKey('archive.id', ondelete='CASCADE'), primary_key=True),
+    Column('tag_id', Integer, ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_archive_tags_tag_id', 'tag_id', 'archive_id')
+)
+
+class Tag(Base):
+    __tablename__ = 'tags'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64), nullable=False, unique=True, index=True)
+
+# Archive Model (حافظه بلندمدت و آرشیو لینک)
+class ArchiveItem(Base):
+    __tablename__ = 'archive'
+    id = Column(Integer, primary_key=True)
+    title = Column(String(256), nullable=False)
+    content = Column(Text, nullable=False) # URL or Memorized Text
+    tags = Column(String(256))
+    user_id = Column(String(64))
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    search_text = Column(Text)  # Normalized title + content + tags (full-text index source)
+    description = Column(Text)  # Page description of archived links
+    canonical_url = Column(String(1024))
+    metadata_status = Column(String(16))  # Links only: 'pending', 'done' or 'failed'
+    content_hash = Column(String(64))  # archive_content_hash(content); NULL until dedupe_archive() ran for old rows
+    tag_list = relationship(Tag, secondary=archive_tags, lazy='selectin')
+
+    __table_args__ = (
+        Index('ix_archive_metadata_status', 'metadata_status'),
+        Index('ux_archive_content_hash', 'content_hash', unique=True),
+    )
+
+    def build_search_text(self):
+        """Builds the normalized text the full-text index is computed from."""
+        return normalize_persian_text(' '.join(filter(None, [self.title, self.content, self.tags, self.description])))
+
+
+@event.listens_for(ArchiveItem, 'before_insert')
+@event.listens_for(ArchiveItem, 'before_update')
+def _refresh_archive_search_text(mapper, connection, target):
+    """Keeps ArchiveItem.search_text in sync with the indexed fields."""
+    target.search_text = target.build_search_text()
+
+
+@event.listens_for(ArchiveItem, 'before_insert')
+def _set_archive_content_hash(mapper, connection, target):
+    """New rows always carry their duplicate-detection hash (old rows get it from dedupe_archive)."""
+    if target.content_hash is None:
+        target.content_hash = archive_content_hash(target.content)
+
+# Activity Log Model (ثبت کارکرد فردی)
+class ActivityLog(Base):
+    __tablename__ = 'activity_log'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String(64))
+    description = Column(Text, nullable=False)
+    logged_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_activity_log_user_logged_at', 'user_id', 'logged_at'),  # /mywork reports and exports
+    )
+
+# Shopping List Model (مدیریت خرید)
+class ShoppingItem(Base):
+    __tablename__ = 'shopping_list'
+    id = Column(Integer, primary_key=True)
+    item_name = Column(String(256), nullable=False)
+    is_bought = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    bought_at = Column(DateTime)
+
+# Daily Statistics Rollup (آمار روزانه) - maintained incrementally by the write handlers
+class DailyStat(Base):
+    __tablename__ = 'daily_stats'
+    day = Column(Date, primary_key=True)
+    user_id = Column(String(64), primary_key=True)
+    metric = Column(String(32), primary_key=True)  # tasks_created, tasks_done, archive_items, activity_logs
+    count = Column(Integer, nullable=False, default=0)
+
+# AI Summary Cache Model (کش خلاصه‌های هوش مصنوعی)
+class SummaryCacheEntry(Base):
+    __tablename__ = 'summary_cache'
+    key = Column(String(64), primary_key=True)  # sha256(model, prompt version, normalized text)
+    model = Column(String(64))
+    summary = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+# Translation Cache Model (کش ترجمه‌ها)
+class TranslationCacheEntry(Base):
+    __tablename__ = 'translation_cache'
+    key = Column(String(64), primary_key=True)  # sha256(src, dest, text)
+    src = Column(String(8))
+    dest = Column(String(8))
+    source_text = Column(Text, nullable=False)
+    translation = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Link Metadata Cache (پیش‌نمایش لینک‌ها) - validators for conditional GET plus the parsed fields
+class LinkMetadata(Base):
+    __tablename__ = 'link_metadata'
+    id = Column(Integer, primary_key=True)
+    url = Column(String(1024), nullable=False, unique=True)
+    etag = Column(String(256))
+    last_modified = Column(String(64))
+    title = Column(String(256))
+    description = Column(Text)
+    canonical_url = Column(String(1024))
+    fetched_at = Column(DateTime, default=datetime.utcnow)
+
+# Processed Updates Ledger - one row per Telegram update_id, claimed with a lease
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    status = Column(String(16), nullable=False, default='processing')  # 'processing' or 'done'
+    lease_until = Column(DateTime, nullable=False)
+    claimed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_processed_updates_claimed_at', 'claimed_at'),
+    )
+
+# Retention (نگهداری داده‌های قدیمی) - per-user, per-month counts of rows moved out of the hot tables
+class MonthlyRollup(Base):
+    __tablename__ = 'monthly_rollups'
+    month = Column(Date, primary_key=True)  # First day of the month
+    user_id = Column(String(64), primary_key=True)
+    metric = Column(String(32), primary_key=True)  # activity_logs, tasks_done, items_bought
+    count = Column(Integer, nullable=False, default=0)
+
+# Cold copies of the rows moved by RetentionJob (same columns, ids kept)
+class ActivityLogArchive(Base):
+    __tablename__ = 'activity_log_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(String(64))
+    description = Column(Text, nullable=False)
+    logged_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_activity_log_archive_user_logged_at', 'user_id', 'logged_at'),
+    )
+
+class TaskArchive(Base):
+    __tablename__ = 'tasks_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    title = Column(String(256), nullable=False)
+    assigned_to = Column(String(64))
+    due_date = Column(DateTime)
+    status = Column(String(32))
+    created_at = Column(DateTime)
+    completed_at = Column(DateTime)
+    chat_id = Column(String(64))
+
+class ShoppingItemArchive(Base):
+    __tablename__ = 'shopping_list_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    item_name = Column(String(256), nullable=False)
+    is_bought = Column(Boolean)
+    created_at = Column(DateTime)
+    bought_at = Column(DateTime)
+
+# Scheduler bookkeeping - end of the last processed window per job (reminders)
+class SchedulerState(Base):
+    __tablename__ = 'scheduler_state'
+    name = Column(String(32), primary_key=True)
+    last_run_at = Column(DateTime, nullable=False)
+
+# Schema version written by migrate(); AUTO_MIGRATE skips migrating when it is current
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+
+# Full-text search backend: 'postgres' (tsvector + GIN), 'fts5' (SQLite) or 'like' (fallback).
+# Set by setup_search_index() during migrations, or detected on the first search.
+SEARCH_BACKEND = None
+
+
+def _add_missing_columns(connection, table_name, columns):
+    """Adds columns introduced after a table was first created (create_all never alters tables)."""
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    for name, ddl in columns:
+        if name not in existing:
+            connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {name} {ddl}'))
+
+
+def _backfill_archive_search_text(connection, batch_size=500):
+    """Fills search_text for rows archived before the full-text index existed."""
+    while True:
+        rows = connection.execute(text(
+            'SELECT id, title, content, tags FROM archive WHERE search_text IS NULL LIMIT :limit'
+        ), {'limit': batch_size}).fetchall()
+        if not rows:
+            break
+        connection.execute(
+            text('UPDATE archive SET search_text = :search_text WHERE id = :id'),
+            [
+                {'id': row.id, 'search_text': normalize_persian_text(' '.join(filter(None, [row.title, row.content, row.tags])))}
+                for row in rows
+            ]
+        )
+
+
+def upgrade_schema(bind):
+    """Brings tables created by older versions of the bot up to date."""
+    with bind.begin() as connection:
+        _add_missing_columns(connection, 'archive', [
+            ('search_text', 'TEXT'), ('description', 'TEXT'),
+            ('canonical_url', 'VARCHAR(1024)'), ('metadata_status', 'VARCHAR(16)'),
+            ('content_hash', 'VARCHAR(64)'),
+        ])
+        _add_missing_columns(connection, 'tasks', [('completed_at', 'TIMESTAMP'), ('chat_id', 'VARCHAR(64)')])
+        _add_missing_columns(connection, 'tasks_archive', [('chat_id', 'VARCHAR(64)')])
+
+        # Replaced by the case-insensitive ix_tasks_assignee_status_id
+        connection.execute(text("DROP INDEX IF EXISTS ix_tasks_assigned_status_id"))
+
+        # create_all only creates indexes together with new tables. IF NOT EXISTS rather than
+        # checkfirst: reflection does not report expression indexes on every backend.
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def setup_search_index(bind):
+    """Creates the full-text index for the archive and picks the search backend."""
+    global SEARCH_BACKEND
+
+    with bind.begin() as connection:
+        _backfill_archive_search_text(connection)
+
+        if connection.dialect.name == 'postgresql':
+            # 'simple' config: no stemming/stop words, which suits Persian + English mixed text
+            connection.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_archive_search_tsv "
+                "ON archive USING GIN (to_tsvector('simple', search_text))"
+            ))
+            SEARCH_BACKEND = 'postgres'
+            return
+
+    if bind.dialect.name != 'sqlite':
+        return
+
+    try:
+        with bind.begin() as connection:
+            created = not connection.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_fts'"
+            )).first()
+            connection.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5("
+                "search_text, content='archive', content_rowid='id', tokenize='unicode61')"
+            ))
+            # Triggers keep the external-content FTS table in sync with every write path
+            connection.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS archive_fts_ai AFTER INSERT ON archive BEGIN "
+                "INSERT INTO archive_fts(rowid, search_text) VALUES (new.id, new.search_text); END"
+            ))
+            connection.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS archive_fts_ad AFTER DELETE ON archive BEGIN "
+                "INSERT INTO archive_fts(archive_fts, rowid, search_text) VALUES ('delete', old.id, old.search_text); END"
+            ))
+            connection.execute(text(
+                "CREATE TRIGGER IF NOT EXISTS archive_fts_au AFTER UPDATE ON archive BEGIN "
+                "INSERT INTO archive_fts(archive_fts, rowid, search_text) VALUES ('delete', old.id, old.search_text); "
+                "INSERT INTO archive_fts(rowid, search_text) VALUES (new.id, new.search_text); END"
+            ))
+            if created:
+                connection.execute(text("INSERT INTO archive_fts(archive_fts) VALUES ('rebuild')"))
+        SEARCH_BACKEND = 'fts5'
+    except OperationalError as e:
+        # SQLite builds without FTS5 still work, just with the slower LIKE fallback
+        print(f"WARNING: SQLite FTS5 is not available, falling back to LIKE search: {e}")
+        SEARCH_BACKEND = 'like'
+
+
+def get_search_backend(session):
+    """Returns the search backend, detecting it when migrations ran in another process."""
+    global SEARCH_BACKEND
+    if SEARCH_BACKEND is None:
+        dialect = session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            SEARCH_BACKEND = 'postgres'
+        elif dialect == 'sqlite' and session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_fts'"
+        )).first():
+            SEARCH_BACKEND = 'fts5'
+        else:
+            SEARCH_BACKEND = 'like'
+    return SEARCH_BACKEND
+
+
+def get_or_create_tags(session, names):
+    """Returns Tag rows for the given normalized names, creating missing ones (two queries at most)."""
+    if not names:
+        return []
+    tags = {tag.name: tag for tag in session.query(Tag).filter(Tag.name.in_(names))}
+    for name in names:
+        if name in tags:
+            continue
+        try:
+            with session.begin_nested():
+                tag = Tag(name=name)
+                session.add(tag)
+        except IntegrityError:
+            # Created concurrently by another worker
+            tag = session.query(Tag).filter(Tag.name == name).one()
+        tags[name] = tag
+    return [tags[name] for name in names]
+
+
+def _backfill_archive_tags(bind, batch_size=500):
+    """Links archive rows created before the tag index existed to their tags."""
+    session = Session(bind=bind)
+    try:
+        last_id = 0
+        while True:
+            untagged = ~ArchiveItem.id.in_(select(archive_tags.c.archive_id))
+            items = session.query(ArchiveItem).filter(
+                ArchiveItem.id > last_id,
+                ArchiveItem.tags.isnot(None),
+                ArchiveItem.tags != '',
+                untagged
+            ).order_by(ArchiveItem.id).limit(batch_size).all()
+            if not items:
+                break
+            for item in items:
+                item.tag_list = get_or_create_tags(session, parse_tags(item.tags))
+            last_id = items[-1].id
+            session.commit()
+    finally:
+        session.close()
+
+
+def dedupe_archive(bind, batch_size=1000):
+    """
+    One-off job: hashes archive rows created before duplicate detection and
+    removes duplicates, moving their tag links to the row that is kept (the one
+    already holding the hash, i.e. the older one within the scan). Works in
+    id-ordered batches, one transaction each, so it never loads the whole table.
+    """
+    archive = ArchiveItem.__table__
+    hashed = removed = 0
+    last_id = 0
+    while True:
+        with bind.begin() as connection:
+            rows = connection.execute(
+                select(archive.c.id, archive.c.content).where(
+                    archive.c.content_hash.is_(None), archive.c.id > last_id
+                ).order_by(archive.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            hashes = {row.id: archive_content_hash(row.content) for row in rows}
+            owners = dict(connection.execute(
+                select(archive.c.content_hash, archive.c.id).where(archive.c.content_hash.in_(set(hashes.values())))
+            ).all())
+            updates, keep_for = [], {}
+            for row in rows:
+                content_hash = hashes[row.id]
+                if content_hash in owners:
+                    keep_for[row.id] = owners[content_hash]
+                else:
+                    owners[content_hash] = row.id
+                    updates.append({'row_id': row.id, 'row_hash': content_hash})
+
+            if keep_for:
+                links = connection.execute(
+                    select(archive_tags.c.archive_id, archive_tags.c.tag_id).where(archive_tags.c.archive_id.in_(list(keep_for)))
+                ).all()
+                existing_links = set(connection.execute(
+                    select(archive_tags.c.archive_id, archive_tags.c.tag_id).where(
+                        archive_tags.c.archive_id.in_(set(keep_for.values()))
+                    )
+                ).all())
+                moved = {(keep_for[archive_id], tag_id) for archive_id, tag_id in links} - existing_links
+                if moved:
+                    connection.execute(archive_tags.insert(), [{'archive_id': a, 'tag_id': t} for a, t in moved])
+                connection.execute(archive_tags.delete().where(archive_tags.c.archive_id.in_(list(keep_for))))
+                connection.execute(archive.delete().where(archive.c.id.in_(list(keep_for))))
+            # Duplicates are gone before the hashes land, so the unique index is never violated
+            if updates:
+                connection.execute(
+                    archive.update().where(archive.c.id == bindparam('row_id')).values(content_hash=bindparam('row_hash')),
+                    updates
+                )
+            hashed += len(updates)
+            removed += len(keep_for)
+    return {'hashed': hashed, 'removed': removed}
+
+
+# Bump whenever migrate() gains a step, so AUTO_MIGRATE instances run it once
+SCHEMA_VERSION = 2
+
+
+def schema_is_current(bind):
+    """True if migrate() has already brought the database to SCHEMA_VERSION (a single query)."""
+    try:
+        with bind.connect() as connection:
+            version = connection.execute(select(func.max(SchemaVersion.version))).scalar()
+    except SQLAlchemyError:
+        return False  # No schema_version table yet
+    return version is not None and version >= SCHEMA_VERSION
+
+
+def migrate(bind):
+    """Creates and upgrades all tables, indexes and derived data. Safe to run repeatedly."""
+    Base.metadata.create_all(bind)
+    upgrade_schema(bind)
+    setup_search_index(bind)
+    _backfill_archive_tags(bind)
+    _seed_daily_stats(bind)
+    with bind.begin() as connection:
+        table = SchemaVersion.__table__
+        connection.execute(table.delete())
+        connection.execute(table.insert().values(version=SCHEMA_VERSION))
+
+# -------------------------------------------------------------------------
+# 3. UTILITY FUNCTIONS
+# -------------------------------------------------------------------------
+
+def _load_user_names_map():
+    """Parses USER_NAMES_MAP (JSON: {"<user_id>": "<name>"}), falling back to DEFAULT_USER_MAP."""
+    try:
+        user_map_json = os.environ.get('USER_NAMES_MAP')
+        user_map = json.loads(user_map_json) if user_map_json else DEFAULT_USER_MAP
+        return {str(key): value for key, value in user_map.items()}
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        print("WARNING: USER_NAMES_MAP is not valid JSON, using the default user map.")
+        return dict(DEFAULT_USER_MAP)
+
+
+class UserDirectory:
+    """
+    Resolves Telegram users to display names.
+
+    The configured map (USER_NAMES_MAP) is parsed once; users seen in updates
+    are learned into the users table, and learned profiles are cached in
+    memory for cache_ttl seconds so other workers' changes show up without a
+    restart. Keys that resolve to nothing are remembered for miss_ttl seconds,
+    so unknown ids/@usernames do not cost a query on every lookup.
+    reload() re-reads everything on demand.
+    """
+
+    FALLBACK_NAME = 'رفیق'
+
+    def __init__(self, cache_ttl=300, miss_ttl=60):
+        self.cache_ttl = cache_ttl
+        self.miss_ttl = miss_ttl
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Re-parses USER_NAMES_MAP and drops the learned-profile cache."""
+        static_map = _load_user_names_map()
+        with self._lock:
+            self._static_map = static_map
+            self._profiles = {}  # user_id -> (username, first_name, loaded_at)
+            self._usernames = {}  # lowercase username -> user_id
+            self._misses = {}  # user_id or '@' + lowercase username -> checked_at
+
+    def _cached_profile(self, user_id):
+        profile = self._profiles.get(user_id)
+        if profile and time.monotonic() - profile[2] < self.cache_ttl:
+            return profile
+        return None
+
+    def _remember(self, user_id, username, first_name):
+        with self._lock:
+            self._profiles[user_id] = (username, first_name, time.monotonic())
+            self._misses.pop(user_id, None)
+            if username:
+                self._usernames[username.lower()] = user_id
+                self._misses.pop('@' + username.lower(), None)
+
+    def _recently_missed(self, key):
+        checked_at = self._misses.get(key)
+        return checked_at is not None and time.monotonic() - checked_at < self.miss_ttl
+
+    def _remember_misses(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._misses[key] = now
+
+    def _display_name(self, user_id):
+        if user_id in self._static_map:
+            return self._static_map[user_id]
+        profile = self._cached_profile(user_id)
+        if profile and profile[1]:
+            return profile[1]
+        return None
+
+    def learn(self, user):
+        """Records a telegram.User seen in an update; writes only when something changed."""
+        if user is None or user.is_bot:
+            return
+        user_id = str(user.id)
+        profile = self._cached_profile(user_id)
+        if profile and profile[0] == user.username and profile[1] == user.first_name:
+            return
+
+        session = Session()
+        try:
+            stored = session.get(BotUser, user_id)
+            if stored is None or stored.username != user.username or stored.first_name != user.first_name:
+                session.merge(BotUser(
+                    id=user_id, username=user.username, first_name=user.first_name, updated_at=datetime.utcnow()
+                ))
+                session.commit()
+            self._remember(user_id, user.username, user.first_name)
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"WARNING: Could not store user {user_id}: {e}")
+        finally:
+            session.close()
+
+    def name(self, user_id):
+        """Display name for a single user id."""
+        return self.resolve_many([user_id]).get(str(user_id), self.FALLBACK_NAME)
+
+    def resolve_many(self, keys):
+        """
+        Resolves many user ids and/or '@username' strings with at most one query.
+        Returns {key: display_name} for every key that could be resolved.
+        """
+        resolved = {}
+        missing_ids, missing_usernames = set(), set()
+        for key in {str(key) for key in keys if key}:
+            if key.startswith('@'):
+                user_id = self._usernames.get(key[1:].lower())
+                name = self._display_name(user_id) if user_id else None
+                if name:
+                    resolved[key] = name
+                elif not self._recently_missed('@' + key[1:].lower()):
+                    missing_usernames.add(key[1:].lower())
+            else:
+                name = self._display_name(key)
+                if name:
+                    resolved[key] = name
+                elif not self._recently_missed(key):
+                    missing_ids.add(key)
+
+        if missing_ids or missing_usernames:
+            session = Session()
+            try:
+                conditions = []
+                if missing_ids:
+                    conditions.append(BotUser.id.in_(missing_ids))
+                if missing_usernames:
+                    conditions.append(func.lower(BotUser.username).in_(missing_usernames))
+                for user in session.query(BotUser).filter(or_(*conditions)):
+                    self._remember(user.id, user.username, user.first_name)
+                looked_up = True
+            except SQLAlchemyError as e:
+                looked_up = False  # A failed query says nothing about whether the keys exist
+                print(f"WARNING: User lookup failed: {e}")
+            finally:
+                session.close()
+
+            misses = []
+            for user_id in missing_ids:
+                name = self._display_name(user_id)
+                if name:
+                    resolved[user_id] = name
+                else:
+                    misses.append(user_id)
+            for username in missing_usernames:
+                user_id = self._usernames.get(username)
+                name = self._display_name(user_id) if user_id else None
+                if name:
+                    resolved['@' + username] = name
+                else:
+                    misses.append('@' + username)
+            if looked_up:
+                self._remember_misses(misses)
+        return resolved
+
+
+user_directory = UserDirectory(cache_ttl=USER_DIRECTORY_TTL, miss_ttl=USER_DIRECTORY_MISS_TTL)
+
+
+def get_user_name(user_id):
+    """Retrieves a personalized name based on user ID."""
+    return user_directory.name(user_id)
+
+
+def learn_user(update: Update, context):
+    """Runs before every handler: remembers the sender (and replied-to author) in the user directory."""
+    user_directory.learn(update.effective_user)
+    if update.message and update.message.reply_to_message:
+        user_directory.learn(update.message.reply_to_message.from_user)
+
+
+def is_valid_url(url):
+    """Simple check if a string looks like a URL."""
+    return url.startswith('http')
+
+
+def parse_id_list(args, limit=BULK_MAX_ITEMS):
+    """
+    Parses ids like `3 5 9`, `3,5,9` or `12-15` into a sorted list.
+    Returns None if a part is not a number/range or more than `limit` ids are given.
+    """
+    ids = set()
+    for part in re.split(r'[\s,،]+', ' '.join(args).strip()):
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)(?:-(\d+))?', part)
+        if not match:
+            return None
+        first, last = int(match.group(1)), int(match.group(2) or match.group(1))
+        if last < first or last - first >= limit:
+            return None
+        ids.update(range(first, last + 1))
+        if len(ids) > limit:
+            return None
+    return sorted(ids) or None
+
+
+def parse_item_list(text, limit=BULK_MAX_ITEMS):
+    """
+    Splits `milk, eggs, bread` (Latin or Persian commas) into item names.
+    Returns None if more than `limit` items are given (like parse_id_list).
+    """
+    items = [item.strip() for item in re.split(r'[,،\n]', text) if item.strip()]
+    return items if len(items) <= limit else None
+
+
+def insert_returning(session, model, rows, columns=()):
+    """Inserts all rows with one multi-row `INSERT ... RETURNING` (a plain INSERT where RETURNING is unsupported)."""
+    statement = insert_statement(model).values(rows)
+    dialect = session.get_bind().dialect
+    if getattr(dialect, 'insert_returning', getattr(dialect, 'implicit_returning', False)):
+        return session.execute(statement.returning(*columns)).all()
+    session.execute(statement)
+    return []
+
+
+def update_returning(session, model, ids, values, *conditions, columns=()):
+    """
+    Runs one `UPDATE ... WHERE id IN (...) RETURNING` and returns the changed rows.
+
+    Backends without UPDATE ... RETURNING (MySQL, SQLite < 3.35) fall back to
+    selecting the matching rows first, so at most two statements are issued.
+    """
+    statement = update_statement(model).where(model.id.in_(ids), *conditions).values(values)
+    statement = statement.execution_options(synchronize_session=False)
+    dialect = session.get_bind().dialect
+    if getattr(dialect, 'update_returning', getattr(dialect, 'full_returning', False)):
+        return session.execute(statement.returning(*columns)).all()
+    rows = session.query(*columns).filter(model.id.in_(ids), *conditions).all()
+    session.execute(statement)
+    return rows
+
+
+def _tagged_archive_ids(tag_names):
+    """Subquery of archive ids carrying ALL given tags (index-only intersection on archive_tags)."""
+    return select(archive_tags.c.archive_id).join(
+        Tag, Tag.id == archive_tags.c.tag_id
+    ).where(
+        Tag.name.in_(tag_names)
+    ).group_by(
+        archive_tags.c.archive_id
+    ).having(func.count(archive_tags.c.tag_id) == len(tag_names))
+
+
+def find_archive_items(session, query_text, tags=None, limit=10):
+    """
+    Full-text search over the archive. Every term must match (as a prefix) and
+    every given tag must be attached; results are ordered by relevance first
+    and recency second.
+    """
+    terms = search_terms(query_text)
+    tag_names = list(dict.fromkeys(filter(None, (normalize_tag(tag) for tag in tags or []))))
+    if not terms and not tag_names:
+        return []
+
+    query = session.query(ArchiveItem)
+    if tag_names:
+        query = query.filter(ArchiveItem.id.in_(_tagged_archive_ids(tag_names)))
+
+    if not terms:
+        return query.order_by(ArchiveItem.archived_at.desc()).limit(limit).all()
+
+    backend = get_search_backend(session)
+    if backend == 'postgres':
+        vector = func.to_tsvector(literal_column("'simple'"), ArchiveItem.search_text)
+        ts_query = func.to_tsquery(literal_column("'simple'"), ' & '.join(f'{term}:*' for term in terms))
+        return query.filter(
+            vector.op('@@')(ts_query)
+        ).order_by(
+            func.ts_rank(vector, ts_query).desc(),
+            ArchiveItem.archived_at.desc()
+        ).limit(limit).all()
+
+    if backend == 'fts5':
+        fts = text(
+            "SELECT rowid AS id, bm25(archive_fts) AS rank FROM archive_fts WHERE archive_fts MATCH :match"
+        ).bindparams(
+            match=' AND '.join(f'"{term}"*' for term in terms)
+        ).columns(id=Integer, rank=Float).subquery('fts')
+        return query.join(
+            fts, fts.c.id == ArchiveItem.id
+        ).order_by(
+            fts.c.rank,  # bm25: lower is more relevant
+            ArchiveItem.archived_at.desc()
+        ).limit(limit).all()
+
+    # Fallback: every term must appear somewhere in the normalized text
+    return query.filter(
+        *[ArchiveItem.search_text.like(f'%{term}%') for term in terms]
+    ).order_by(ArchiveItem.archived_at.desc()).limit(limit).all()
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with an optional per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value or None (expired entries count as misses)."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entry when full."""
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SummaryCache:
+    """
+    Two-tier cache for AI summaries: an in-memory LRU in front of the
+    summary_cache table, so a summary survives restarts and is shared by all
+    workers. Keys are content addressed (model + prompt version + normalized text).
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.db_hits = 0
+        self.db_misses = 0
+        self._lock = threading.Lock()  # Guards the db_* counters (map-stage lookups run on executor threads)
+
+    @staticmethod
+    def make_key(text_to_summarize, model=None, prompt_version=SUMMARY_PROMPT_VERSION):
+        """Content hash used as the cache key."""
+        material = '\x1f'.join([model or GAP_MODEL, prompt_version, normalize_persian_text(text_to_summarize)])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Looks the key up in memory first, then in the database."""
+        summary = self.memory.get(key)
+        if summary is not None:
+            return summary
+
+        session = Session()
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+            entry = session.query(SummaryCacheEntry).filter(
+                SummaryCacheEntry.key == key,
+                SummaryCacheEntry.created_at >= cutoff
+            ).first()
+            with self._lock:
+                if entry is None:
+                    self.db_misses += 1
+                else:
+                    self.db_hits += 1
+            if entry is None:
+                return None
+            self.memory.put(key, entry.summary)
+            return entry.summary
+        except SQLAlchemyError as e:
+            print(f"WARNING: Summary cache lookup failed: {e}")
+            return None
+        finally:
+            session.close()
+
+    def put(self, key, summary, model=None):
+        """Stores a summary in both tiers and evicts expired database rows."""
+        self.memory.put(key, summary)
+
+        session = Session()
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+            session.query(SummaryCacheEntry).filter(
+                SummaryCacheEntry.created_at < cutoff
+            ).delete(synchronize_session=False)
+            session.merge(SummaryCacheEntry(
+                key=key, model=model or GAP_MODEL, summary=summary, created_at=datetime.utcnow()
+            ))
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"WARNING: Summary cache store failed: {e}")
+        finally:
+            session.close()
+
+    def stats(self):
+        """Hit/miss counters of both tiers."""
+        with self.memory._lock:
+            memory_hits, memory_misses = self.memory.hits, self.memory.misses
+        with self._lock:
+            db_hits, db_misses = self.db_hits, self.db_misses
+        return {
+            'enabled': SUMMARY_CACHE_ENABLED,
+            'memory_entries': len(self.memory),
+            'memory_hits': memory_hits,
+            'memory_misses': memory_misses,
+            'db_hits': db_hits,
+            'db_misses': db_misses,
+        }
+
+
+summary_cache = SummaryCache(maxsize=SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL)
+
+
+def activity_log_models(since):
+    """
+    Models holding activity logs from `since` on: ActivityLogArchive too when the
+    window reaches back past the retention cutoff (RetentionJob only moves logs
+    older than RETENTION_DAYS, so newer windows never need the archive).
+    """
+    if since is None or since < datetime.utcnow() - timedelta(days=RETENTION_DAYS):
+        return (ActivityLogArchive, ActivityLog)
+    return (ActivityLog,)
+
+
+class StatsEngine:
+    """
+    Counters for the /summary report.
+
+    Without rollups every counter is computed in a single round trip using
+    conditional aggregation. With STATS_ROLLUP_ENABLED the write handlers also
+    increment per-day, per-user counters in daily_stats, so reports only read
+    O(days x users) rows instead of scanning the raw tables.
+    """
+
+    METRICS = ('tasks_created', 'tasks_done', 'archive_items', 'activity_logs')
+
+    def __init__(self, rollup_enabled=False):
+        self.rollup_enabled = rollup_enabled
+
+    def record(self, session, metric, user_id, amount=1, day=None):
+        """Increments a daily counter inside the caller's transaction (no-op without rollups)."""
+        if not self.rollup_enabled or not amount:
+            return
+        day = day or datetime.utcnow().date()
+        key = (DailyStat.day == day, DailyStat.user_id == str(user_id), DailyStat.metric == metric)
+        updated = session.query(DailyStat).filter(*key).update(
+            {DailyStat.count: DailyStat.count + amount}, synchronize_session=False
+        )
+        if updated:
+            return
+        try:
+            with session.begin_nested():
+                session.add(DailyStat(day=day, user_id=str(user_id), metric=metric, count=amount))
+        except IntegrityError:
+            # Another worker inserted the row first
+            session.query(DailyStat).filter(*key).update(
+                {DailyStat.count: DailyStat.count + amount}, synchronize_session=False
+            )
+
+    @staticmethod
+    def _raw_counts(session, since, until=None):
+        """Counters straight from the raw tables for [since, until) in one query (remaining tasks included)."""
+        def window(column):
+            return column >= since if until is None else (column >= since) & (column < until)
+
+        task_counts = select(
+            func.count(case((window(Task.created_at), 1))).label('new_tasks'),
+            func.count(case((window(Task.completed_at), 1))).label('done_tasks'),
+            func.count(case((Task.status.in_(ACTIVE_TASK_STATUSES), 1))).label('remaining_tasks'),
+        ).subquery()
+        new_archives = select(func.count(ArchiveItem.id)).where(window(ArchiveItem.archived_at)).scalar_subquery()
+        log_counts = [
+            select(func.count(model.id)).where(window(model.logged_at)).scalar_subquery()
+            for model in activity_log_models(since)
+        ]
+        row = session.execute(select(
+            task_counts.c.new_tasks,
+            task_counts.c.done_tasks,
+            task_counts.c.remaining_tasks,
+            new_archives.label('new_archives'),
+            sum(log_counts[1:], log_counts[0]).label('new_logs'),
+        )).one()
+        return dict(row._mapping)
+
+    @staticmethod
+    def _raw_per_user_rows(session, since, until=None):
+        """(user_id, metric, count) rows from the raw tables; they only know the author of archive items and logs."""
+        def window(column):
+            return column >= since if until is None else (column >= since) & (column < until)
+
+        archive_counts = select(
+            ArchiveItem.user_id, literal_column("'archive_items'"), func.count(ArchiveItem.id)
+        ).where(window(ArchiveItem.archived_at)).group_by(ArchiveItem.user_id)
+        log_counts = [
+            select(
+                model.user_id, literal_column("'activity_logs'"), func.count(model.id)
+            ).where(window(model.logged_at)).group_by(model.user_id)
+            for model in activity_log_models(since)
+        ]
+        return session.execute(archive_counts.union_all(*log_counts)).all()
+
+    def weekly_counts(self, session, days=7):
+        """Returns all /summary counters for the last `days` x 24 hours."""
+        since = datetime.utcnow() - timedelta(days=days)
+        if not self.rollup_enabled:
+            return self._raw_counts(session, since)
+
+        # Whole days after `since` come from the rollups; the partial first day from the raw
+        # rows, so both paths count exactly the same window.
+        first_full_day = since.date() + timedelta(days=1)
+        metric_sums = [
+            select(func.coalesce(func.sum(DailyStat.count), 0)).where(
+                DailyStat.metric == metric, DailyStat.day >= first_full_day
+            ).scalar_subquery().label(metric)
+            for metric in self.METRICS
+        ]
+        row = session.execute(select(*metric_sums)).one()
+        boundary = self._raw_counts(session, since, datetime.combine(first_full_day, datetime.min.time()))
+        return {
+            'new_tasks': row.tasks_created + boundary['new_tasks'],
+            'done_tasks': row.tasks_done + boundary['done_tasks'],
+            'remaining_tasks': boundary['remaining_tasks'],
+            'new_archives': row.archive_items + boundary['new_archives'],
+            'new_logs': row.activity_logs + boundary['new_logs'],
+        }
+
+    def per_user_counts(self, session, days=7):
+        """Returns {user_id: {metric: count}} for the last `days` x 24 hours."""
+        since = datetime.utcnow() - timedelta(days=days)
+        if self.rollup_enabled:
+            first_full_day = since.date() + timedelta(days=1)
+            rows = session.query(
+                DailyStat.user_id, DailyStat.metric, func.sum(DailyStat.count)
+            ).filter(DailyStat.day >= first_full_day).group_by(DailyStat.user_id, DailyStat.metric).all()
+            rows += self._raw_per_user_rows(session, since, datetime.combine(first_full_day, datetime.min.time()))
+        else:
+            rows = self._raw_per_user_rows(session, since)
+
+        breakdown = {}
+        for row_user_id, metric, count in rows:
+            if not row_user_id:
+                continue  # Counters rebuilt from rows without a known author
+            counts = breakdown.setdefault(row_user_id, {})
+            counts[metric] = counts.get(metric, 0) + int(count or 0)
+        return breakdown
+
+    @staticmethod
+    def _raw_daily_totals(session, days=None):
+        """{(day, user_id, metric): count} computed from the raw and archive tables."""
+        # Tasks do not record who created/completed them, so old task counters go to user ''.
+        # Rows moved out by RetentionJob are counted from their archive tables.
+        unknown_user = literal_column("''")
+        sources = [
+            ('tasks_created', unknown_user, Task.created_at),
+            ('tasks_created', unknown_user, TaskArchive.created_at),
+            ('tasks_done', unknown_user, Task.completed_at),
+            ('tasks_done', unknown_user, TaskArchive.completed_at),
+            ('archive_items', ArchiveItem.user_id, ArchiveItem.archived_at),
+            ('activity_logs', ActivityLog.user_id, ActivityLog.logged_at),
+            ('activity_logs', ActivityLogArchive.user_id, ActivityLogArchive.logged_at),
+        ]
+        totals = {}
+        for metric, user_column, time_column in sources:
+            day = func.date(time_column)
+            query = session.query(day, user_column, func.count()).filter(
+                time_column.isnot(None)
+            ).group_by(day, user_column)
+            if days:
+                query = query.filter(time_column >= datetime.utcnow() - timedelta(days=days))
+            for row_day, row_user_id, count in query:
+                if isinstance(row_day, str):
+                    row_day = datetime.strptime(row_day, '%Y-%m-%d').date()
+                key = (row_day, str(row_user_id), metric)
+                totals[key] = totals.get(key, 0) + count
+        return totals
+
+    def rebuild(self, session, days=None):
+        """Recomputes daily_stats from the raw tables (used when rollups are first enabled)."""
+        query = session.query(DailyStat)
+        if days:
+            query = query.filter(DailyStat.day >= (datetime.utcnow() - timedelta(days=days)).date())
+        query.delete(synchronize_session=False)
+
+        for (row_day, row_user_id, metric), count in self._raw_daily_totals(session, days).items():
+            session.add(DailyStat(day=row_day, user_id=row_user_id, metric=metric, count=count))
+        session.commit()
+
+    def backfill(self, session):
+        """
+        Adds raw-table counts for every (day, metric) that has no rollup rows yet,
+        e.g. days before rollups were enabled or while they were switched off.
+        Days that already have rows are left alone (they are kept incrementally).
+        Returns the number of (day, metric) pairs filled.
+        """
+        present = set(session.query(DailyStat.day, DailyStat.metric).distinct().all())
+        filled = set()
+        for (row_day, row_user_id, metric), count in self._raw_daily_totals(session).items():
+            if (row_day, metric) in present:
+                continue
+            session.add(DailyStat(day=row_day, user_id=row_user_id, metric=metric, count=count))
+            filled.add((row_day, metric))
+        session.commit()
+        return len(filled)
+
+
+stats_engine = StatsEngine(rollup_enabled=STATS_ROLLUP_ENABLED)
+
+
+def _seed_daily_stats(bind):
+    """Fills daily_stats from the raw tables for every (day, metric) the rollups do not cover yet."""
+    if not stats_engine.rollup_enabled:
+        return
+    session = Session(bind=bind)
+    try:
+        stats_engine.backfill(session)
+    except SQLAlchemyError as e:
+        session.rollback()
+        print(f"WARNING: Could not seed daily statistics: {e}")
+    finally:
+        session.close()
+
+
+class GapApiError(Exception):
+    """Raised when the GAP API gives no usable answer. The message is the user-facing (Persian) text."""
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a remote service is down. After failure_threshold
+    consecutive failures the circuit opens for reset_timeout seconds; then a
+    single trial call is let through (half-open) to probe for recovery.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._open_until > time.monotonic():
+                return 'open'
+            return 'half-open' if self._failures >= self.failure_threshold else 'closed'
+
+    def retry_in(self):
+        """Seconds until the circuit lets calls through again."""
+        return max(0.0, self._open_until - time.monotonic())
+
+    def allow(self):
+        """Returns True if a call may be attempted now."""
+        with self._lock:
+            if self._open_until > time.monotonic():
+                return False
+            if self._failures >= self.failure_threshold:
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.reset_timeout
+
+    def open_for(self, seconds):
+        """Opens the circuit for a known period (e.g. a long Retry-After)."""
+        with self._lock:
+            self._trial_in_flight = False
+            self._open_until = max(self._open_until, time.monotonic() + seconds)
+
+
+def _parse_retry_after(value):
+    """Parses a Retry-After header (delta seconds or HTTP date) into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class GapApiClient:
+    """
+    Shared HTTP client for the GAP API: one keep-alive requests.Session with a
+    sized connection pool, separate connect/read timeouts, a retry policy that
+    honours Retry-After within a bounded time budget, a circuit breaker and
+    per-call latency tracking.
+
+    Retries sleep, so they only happen on background threads. On the
+    synchronous webhook request (OutboundSender.no_wait) a failed attempt is
+    final: it counts towards the breaker, and a 429/503 keeps the circuit open
+    for the server's Retry-After, so later calls fail fast until then.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, base_url, api_key, pool_size=10, connect_timeout=3.05, read_timeout=30,
+                 max_retries=3, retry_budget=8.0, breaker=None):
+        self.base_url = (base_url or '').rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=200)  # (path, status, seconds) of recent calls
+        self.calls = 0
+        self.failures = 0
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+        })
+
+    def _timed_post(self, path, payload, stream=False):
+        """Single POST attempt; records its latency (time to response headers when streaming)."""
+        started_at = time.monotonic()
+        status = 'error'
+        try:
+            response = self.session.post(self.base_url + path, json=payload, timeout=self.timeout, stream=stream)
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.monotonic() - started_at
+            self.calls += 1
+            self.latencies.append((path, status, elapsed))
+            observe_external_call('gap', elapsed, str(status))
+            if status != 200:
+                self.failures += 1
+
+    def post_json(self, path, payload):
+        """POSTs a JSON payload and returns the decoded response, raising GapApiError on failure."""
+        return self._post_with_retries(path, payload).json()
+
+    def stream_json(self, path, payload):
+        """
+        POSTs a streaming request and yields the decoded JSON of every server-sent
+        `data:` event until `[DONE]`. Servers that answer with plain JSON instead of
+        an event stream yield that single object. Retries only happen before the
+        first byte; a stream that breaks midway raises GapApiError.
+        """
+        import requests
+
+        response = self._post_with_retries(path, payload, stream=True)
+        try:
+            if 'text/event-stream' not in response.headers.get('Content-Type', ''):
+                yield response.json()
+                return
+            for raw_line in response.iter_lines():
+                # Decoded here: without a charset requests would assume ISO-8859-1 for text/*
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue  # Comments, keep-alives, event:/id: fields
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    return
+                yield json.loads(data)
+        except requests.exceptions.RequestException as e:
+            self.breaker.record_failure()
+            raise GapApiError(f"❌ خطای اتصال به سرور GAP API: {e}")
+        finally:
+            response.close()
+
+    def _post_with_retries(self, path, payload, stream=False):
+        """Sends the request with retries and the circuit breaker; returns the 200 response."""
+        import requests
+
+        if not self.breaker.allow():
+            raise GapApiError(
+                f"⏳ سرویس هوش مصنوعی موقتاً در دسترس نیست. حدود {int(self.breaker.retry_in()) + 1} ثانیه دیگه دوباره امتحان کن."
+            )
+
+        deadline = time.monotonic() + self.retry_budget
+        # Never sleep on the webhook request thread: one attempt, the breaker does the backoff
+        max_attempts = self.max_retries if outbound_sender.waiting_allowed() else 1
+        for attempt in range(max_attempts):
+            try:
+                response = self._timed_post(path, payload, stream=stream)
+            except requests.exceptions.ConnectionError as e:
+                # Nothing was sent yet or the connection dropped: safe to retry
+                self.breaker.record_failure()
+                delay = 2 ** attempt
+                if attempt + 1 == max_attempts or time.monotonic() + delay > deadline or not self.breaker.allow():
+                    raise GapApiError(f"❌ خطای اتصال به سرور GAP API: {e}")
+                time.sleep(delay)
+                continue
+            except requests.exceptions.RequestException as e:
+                # Read timeouts are not retried: a second 30s stall helps nobody
+                self.breaker.record_failure()
+                raise GapApiError(f"❌ خطای اتصال به سرور GAP API: {e}")
+
+            if response.status_code == 200:
+                self.breaker.record_success()
+                return response
+
+            if response.status_code not in self.RETRY_STATUSES:
+                # Client errors say nothing about the health of the service
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                raise GapApiError(f"❌ خطای API: {response.status_code} - پیام: {response.text[:100]}")
+
+            delay = _parse_retry_after(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = 2 ** attempt
+            if response.status_code != 429:
+                self.breaker.record_failure()
+
+            if attempt + 1 == max_attempts or time.monotonic() + delay > deadline:
+                # Waiting longer than the budget would only block the worker: fail fast
+                # and keep the circuit open until the server said it is ready again.
+                self.breaker.open_for(delay)
+                break
+            time.sleep(delay)
+
+        raise GapApiError("❌ خطای ناشی از محدودیت در تعداد درخواست‌ها. لطفاً دوباره تلاش کنید.")
+
+    def stats(self):
+        """Call counters, breaker state and latency percentiles of recent calls."""
+        durations = sorted(seconds for _, _, seconds in self.latencies)
+
+        def percentile(p):
+            return round(durations[min(len(durations) - 1, int(p * len(durations)))] * 1000, 1) if durations else None
+
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'circuit': self.breaker.state,
+            'latency_ms_p50': percentile(0.50),
+            'latency_ms_p95': percentile(0.95),
+            'latency_ms_last': round(self.latencies[-1][2] * 1000, 1) if self.latencies else None,
+        }
+
+
+_gap_client = None
+_gap_client_lock = threading.Lock()
+
+
+def get_gap_client():
+    """Returns the shared GAP API client, creating it (and importing requests) on first use."""
+    global _gap_client
+    if _gap_client is None:
+        with _gap_client_lock:
+            if _gap_client is None:
+                _gap_client = GapApiClient(
+                    GAP_API_URL, GAP_API_KEY,
+                    pool_size=GAP_POOL_SIZE,
+                    connect_timeout=GAP_CONNECT_TIMEOUT,
+                    read_timeout=GAP_READ_TIMEOUT,
+                    max_retries=GAP_MAX_RETRIES,
+                    retry_budget=GAP_RETRY_BUDGET,
+                    breaker=CircuitBreaker(GAP_BREAKER_THRESHOLD, GAP_BREAKER_RESET)
+                )
+    return _gap_client
+
+
+MEMORIZE_TAG = 'حافظه_بلند_مدت'  # Attached to every /memorize item
+
+SUMMARY_SYSTEM_PROMPT = "تو یک دستیار هوشمند، حرفه‌ای و خلاصه نویس هستی. متن فارسی یا انگلیسی زیر را بخوان و خلاصه‌ای دقیق، مختصر و کاملاً به زبان فارسی از آن تهیه کن."
+SUMMARY_USER_PROMPT = "خلاصه‌ای از این متن بده:\n\n"
+SUMMARY_CHUNK_PROMPT = "این بخشی از یک متن طولانی است. نکات اصلی همین بخش را خلاصه کن:\n\n"
+SUMMARY_REDUCE_PROMPT = "این‌ها خلاصه‌های بخش‌های پشت سر هم یک متن طولانی هستند. آن‌ها را در یک خلاصه منسجم و بدون تکرار ترکیب کن:\n\n"
+SUMMARY_DIGEST_PROMPT = "این‌ها پیام‌های مهم ذخیره‌شده تیم هستند (از قدیمی به جدید). یک جمع‌بندی کوتاه از موضوعات، تصمیم‌ها و کارهای باز آن‌ها بنویس:\n\n"
+
+
+def estimate_tokens(text_value):
+    """Rough token count without a tokenizer: ~4 ASCII characters or ~1.5 other characters per token."""
+    ascii_chars = sum(1 for char in text_value if ord(char) < 128)
+    return int(ascii_chars / 4 + (len(text_value) - ascii_chars) / 1.5) + 1
+
+
+def split_by_tokens(text_value, budget):
+    """Splits text into chunks of about `budget` tokens on paragraph, line or sentence boundaries."""
+    if estimate_tokens(text_value) <= budget:
+        return [text_value]
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text_value):
+        if not paragraph.strip():
+            continue
+        if estimate_tokens(paragraph) <= budget:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r'(?<=[.!?؟\n])\s+', paragraph):
+            # A single sentence over the budget is cut by characters
+            step = max(1, len(sentence) * budget // estimate_tokens(sentence))
+            pieces += [sentence[start:start + step] for start in range(0, len(sentence), step)]
+
+    chunks, current = [], ''
+    for piece in pieces:
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if current and estimate_tokens(candidate) > budget:
+            chunks.append(current)
+            candidate = piece
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+_summary_executor = None
+_summary_executor_lock = threading.Lock()
+
+
+def get_summary_executor():
+    """Shared, bounded thread pool for chunk summaries (caps concurrent GAP calls per process)."""
+    global _summary_executor
+    if _summary_executor is None:
+        with _summary_executor_lock:
+            if _summary_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_MAX_PARALLEL, thread_name_prefix='summary')
+    return _summary_executor
+
+
+def _keeping_no_wait(fn):
+    """Wraps fn for another thread so it keeps the calling thread's no-wait mode (see OutboundSender.no_wait)."""
+    if outbound_sender.waiting_allowed():
+        return fn
+
+    def run(*args, **kwargs):
+        with outbound_sender.no_wait():
+            return fn(*args, **kwargs)
+    return run
+
+
+def _request_summary(prompt, text_value, max_tokens=500, stage='full', use_cache=True, on_progress=None):
+    """
+    One GAP chat completion; results are cached per stage and content.
+    With on_progress, it is called with '' right before a request is sent and,
+    when SUMMARY_STREAMING_ENABLED, with the text so far as streamed tokens arrive.
+    """
+    cache_key = SummaryCache.make_key(text_value, prompt_version=f'{SUMMARY_PROMPT_VERSION}:{stage}')
+    if use_cache:
+        cached_summary = summary_cache.get(cache_key)
+        if cached_summary is not None:
+            return cached_summary
+
+    payload = {
+        # Assuming a standard chat completion endpoint structure
+        "model": GAP_MODEL, # Common model name (gpt-3.5-turbo by default)
+        "messages": [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt + text_value}
+        ],
+        "max_tokens": max_tokens
+    }
+    if on_progress:
+        on_progress('')
+    if on_progress and SUMMARY_STREAMING_ENABLED:
+        payload["stream"] = True
+        parts = []
+        for chunk in get_gap_client().stream_json('/chat/completions', payload):
+            delta_choice = chunk['choices'][0]
+            # Streamed events carry a delta; a server that ignores "stream" sends the whole message
+            piece = (delta_choice.get('delta') or delta_choice.get('message') or {}).get('content')
+            if piece:
+                parts.append(piece)
+                on_progress(''.join(parts))
+        summary = ''.join(parts)
+        if not summary:
+            raise ValueError('empty streamed completion')
+    else:
+        # Pooled keep-alive client; retries, Retry-After and the circuit breaker live there
+        result = get_gap_client().post_json('/chat/completions', payload)
+        # Assuming the response structure contains choices[0].message.content
+        summary = result['choices'][0]['message']['content']
+    if use_cache:
+        summary_cache.put(cache_key, summary)
+    return summary
+
+
+def summarize_text(text_value, prompt=SUMMARY_USER_PROMPT, use_cache=True, on_progress=None):
+    """
+    Map-reduce summarization. Input over SUMMARY_CHUNK_TOKENS is split into chunks
+    that are summarized in parallel (bounded by SUMMARY_MAX_PARALLEL); the partial
+    summaries are then combined, again in chunks if they are still too long.
+    Only the final completion is streamed to on_progress (see _request_summary).
+    Raises GapApiError or a parsing error (ValueError/KeyError/IndexError/TypeError).
+    """
+    use_cache = use_cache and SUMMARY_CACHE_ENABLED
+    chunks = split_by_tokens(text_value, SUMMARY_CHUNK_TOKENS)
+    if len(chunks) == 1:
+        return _request_summary(prompt, text_value, use_cache=use_cache, on_progress=on_progress)
+
+    if on_progress:
+        on_progress('')  # The map phase takes a while; show the placeholder now
+
+    if len(chunks) > SUMMARY_MAX_CHUNKS:
+        print(f"WARNING: Summary input has {len(chunks)} chunks; only the first {SUMMARY_MAX_CHUNKS} are summarized.")
+        chunks = chunks[:SUMMARY_MAX_CHUNKS]
+
+    for _ in range(SUMMARY_MAX_REDUCE_ROUNDS):
+        executor = get_summary_executor()
+        # Map calls made for the webhook request must not sleep on retries either
+        request_summary = _keeping_no_wait(_request_summary)
+        futures = [
+            executor.submit(request_summary, SUMMARY_CHUNK_PROMPT, chunk, 300, 'map', use_cache)
+            for chunk in chunks
+        ]
+        partials = [future.result() for future in futures]  # In input order; the first error propagates
+        combined = '\n\n'.join(f"({index}) {partial}" for index, partial in enumerate(partials, 1))
+        chunks = split_by_tokens(combined, SUMMARY_CHUNK_TOKENS)
+        if len(chunks) == 1:
+            break
+    return _request_summary(SUMMARY_REDUCE_PROMPT, chunks[0], stage='reduce', use_cache=use_cache, on_progress=on_progress)
+
+
+def _call_external_ai_api_for_summary(text_to_summarize, use_cache=True, prompt=SUMMARY_USER_PROMPT,
+                                      title="🧠 خلاصه‌سازی هوشمند:", on_progress=None):
+    """
+    Calls the configured external AI API (e.g., GAP API) for summarization.
+    Long texts are summarized chunk by chunk (see summarize_text). Successful
+    summaries are cached by content; pass use_cache=False to force a fresh call.
+    on_progress (e.g. ProgressiveReply.update) receives the formatted partial summary.
+    """
+    if not GAP_API_KEY or not GAP_API_URL:
+        return "⚠️ دسترسی به API هوش مصنوعی قطع است. لطفاً متغیرهای محیطی GAP_API_KEY و GAP_API_URL را تنظیم کنید."
+
+    try:
+        progress = None
+        if on_progress:
+            progress = lambda partial: on_progress(f"{title}\n\n{partial}" if partial else '')
+        summary = summarize_text(text_to_summarize, prompt=prompt, use_cache=use_cache, on_progress=progress)
+        return f"{title}\n\n{summary}"
+
+    except GapApiError as e:
+        return str(e)
+    except (ValueError, KeyError, IndexError, TypeError):
+        return "❌ پاسخ API هوش مصنوعی قابل خواندن نبود."
+
+
+def build_memorize_digest_text(session, limit):
+    """Joins the last `limit` /memorize items (oldest first) into one text for the digest."""
+    items = session.query(ArchiveItem).filter(
+        ArchiveItem.id.in_(_tagged_archive_ids([normalize_tag(MEMORIZE_TAG)]))
+    ).order_by(ArchiveItem.archived_at.desc(), ArchiveItem.id.desc()).limit(limit).all()
+    return len(items), '\n\n'.join(f"[{item.title}]\n{item.content}" for item in reversed(items))
+
+
+class GoogleTranslateBackend:
+    """
+    googletrans backend. Each thread lazily creates and reuses its own Translator
+    (HTTP client + token state, not safe to share), so translations from
+    different workers run in parallel instead of queueing behind one lock.
+    """
+
+    # Paragraphs of a batch are sent as one request, joined by newlines
+    SEPARATOR = '\n'
+
+    def __init__(self):
+        self._local = threading.local()
+        self._import_lock = threading.Lock()
+        self._translator_class = None
+
+    def _get_translator(self):
+        translator = getattr(self._local, 'translator', None)
+        if translator is None:
+            if self._translator_class is None:
+                with self._import_lock:
+                    if self._translator_class is None:
+                        from googletrans import Translator  # Heavy import (httpx), deferred to first use
+                        self._translator_class = Translator
+            translator = self._local.translator = self._translator_class()
+        return translator
+
+    def translate_batch(self, texts, src, dest):
+        """Translates a list of single-line texts, normally in a single request."""
+        translator = self._get_translator()
+        joined = translator.translate(self.SEPARATOR.join(texts), src=src, dest=dest).text
+        parts = joined.split(self.SEPARATOR)
+        if len(parts) == len(texts):
+            return parts
+        # The service merged or split lines: fall back to one request per text
+        return [translator.translate(item, src=src, dest=dest).text for item in texts]
+
+
+class TranslationService:
+    """
+    Process-wide translator with a bounded in-memory LRU and the translation_cache
+    table in front of a pluggable backend (anything with translate_batch(texts, src, dest)).
+    """
+
+    def __init__(self, backend=None, maxsize=TRANSLATION_CACHE_SIZE):
+        self.backend = backend or GoogleTranslateBackend()
+        self.memory = LRUCache(maxsize=maxsize)
+        self.backend_calls = 0
+
+    @staticmethod
+    def make_key(text_value, src, dest):
+        return hashlib.sha256('\x1f'.join([src, dest, text_value]).encode('utf-8')).hexdigest()
+
+    def _load_from_db(self, keys):
+        """Fetches cached translations for many keys in one query."""
+        if not keys:
+            return {}
+        session = Session()
+        try:
+            entries = session.query(TranslationCacheEntry).filter(TranslationCacheEntry.key.in_(keys)).all()
+            return {entry.key: entry.translation for entry in entries}
+        except SQLAlchemyError as e:
+            print(f"WARNING: Translation cache lookup failed: {e}")
+            return {}
+        finally:
+            session.close()
+
+    def _store_in_db(self, entries):
+        session = Session()
+        try:
+            for key, (source_text, translation, src, dest) in entries.items():
+                session.merge(TranslationCacheEntry(
+                    key=key, src=src, dest=dest, source_text=source_text, translation=translation
+                ))
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"WARNING: Translation cache store failed: {e}")
+        finally:
+            session.close()
+
+    def translate_many(self, texts, src='auto', dest='fa'):
+        """Translates a list of texts; only cache misses reach the backend, as one batch."""
+        keys = [self.make_key(item, src, dest) for item in texts]
+        results = {key: self.memory.get(key) for key in keys}
+
+        missing = [key for key in dict.fromkeys(keys) if results[key] is None]
+        for key, translation in self._load_from_db(missing).items():
+            results[key] = translation
+            self.memory.put(key, translation)
+
+        pending = OrderedDict(
+            (key, item) for key, item in zip(keys, texts) if results[key] is None
+        )
+        if pending:
+            self.backend_calls += 1
+            started_at = time.perf_counter()
+            outcome = 'error'
+            try:
+                translations = self.backend.translate_batch(list(pending.values()), src, dest)
+                outcome = 'ok'
+            finally:
+                observe_external_call('translate', time.perf_counter() - started_at, outcome)
+            new_entries = {}
+            for (key, source_text), translation in zip(pending.items(), translations):
+                results[key] = translation
+                self.memory.put(key, translation)
+                new_entries[key] = (source_text, translation, src, dest)
+            self._store_in_db(new_entries)
+
+        return [results[key] for key in keys]
+
+    def translate(self, text_value, src='auto', dest='fa'):
+        return self.translate_many([text_value], src=src, dest=dest)[0]
+
+
+translation_service = TranslationService()
+
+
+def set_translation_backend(backend):
+    """Swaps the translation backend (e.g. a local stand-in for tests) and clears the memory tier."""
+    translation_service.backend = backend
+    translation_service.memory = LRUCache(maxsize=translation_service.memory.maxsize)
+
+
+# --- Link Metadata (title, description, canonical URL of archived links) ---
+
+class LinkMetadataParser(HTMLParser):
+    """Collects <title>, description and canonical URL from the <head> of a page."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ''
+        self.meta = {}
+        self.canonical_url = None
+        self._in_title = False
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name.lower(): (value or '') for name, value in attrs}
+        if tag == 'title':
+            self._in_title = True
+        elif tag == 'meta':
+            key = (attrs.get('property') or attrs.get('name') or '').lower()
+            if key in ('og:title', 'og:description', 'og:url', 'description', 'twitter:description'):
+                self.meta.setdefault(key, attrs.get('content', '').strip())
+        elif tag == 'link' and 'canonical' in attrs.get('rel', '').lower().split():
+            self.canonical_url = attrs.get('href') or None
+        elif tag == 'body':
+            self.done = True  # Everything we need lives in <head>
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._in_title and not self.done:
+            self.title += data
+
+
+def parse_link_metadata(html, base_url):
+    """Returns {'title', 'description', 'canonical_url'} parsed from (the head of) an HTML page."""
+    parser = LinkMetadataParser()
+    try:
+        # Feed in pieces so parsing stops soon after </head>
+        for start in range(0, len(html), 8192):
+            parser.feed(html[start:start + 8192])
+            if parser.done:
+                break
+    except Exception as e:
+        print(f"WARNING: Could not parse page metadata of {base_url}: {e}")
+    title = parser.meta.get('og:title') or ' '.join(parser.title.split())
+    description = parser.meta.get('description') or parser.meta.get('og:description') or parser.meta.get('twitter:description')
+    canonical_url = parser.canonical_url or parser.meta.get('og:url')
+    return {
+        'title': title[:256] or None,
+        'description': ' '.join(description.split())[:1000] if description else None,
+        'canonical_url': urljoin(base_url, canonical_url)[:1024] if canonical_url else None,
+    }
+
+
+def _decode_html(body, content_type):
+    """Decodes a page using the charset from the header, a <meta charset>, or UTF-8."""
+    match = re.search(r'charset=["\']?([\w-]+)', content_type, re.I) or \
+        re.search(rb'<meta[^>]+charset=["\']?([\w-]+)', body[:4096], re.I)
+    charset = match.group(1) if match else 'utf-8'
+    if isinstance(charset, bytes):
+        charset = charset.decode('ascii')
+    try:
+        return body.decode(charset, errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+
+def _public_address(hostname):
+    """
+    Resolves `hostname` once and returns the address to connect to, or None unless
+    every address it resolves to is publicly routable (no SSRF into the LAN).
+    """
+    import socket
+    import ipaddress
+
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(hostname, None)]
+    except (socket.gaierror, UnicodeError):
+        return None
+    if not addresses or not all(ipaddress.ip_address(address.split('%')[0]).is_global for address in addresses):
+        return None
+    return addresses[0]
+
+
+def _pinned_address_adapter(pins, **kwargs):
+    """
+    HTTPAdapter whose connections go to the address pinned for their host in
+    `pins.hosts` (thread-local) instead of resolving the name again, so a DNS
+    answer that changes after the check (DNS rebinding) is never used. The
+    hostname still drives the Host header, SNI and certificate checks.
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def pin(connection):
+        address = getattr(pins, 'hosts', {}).get(connection.host.lower().rstrip('.'))
+        if address:
+            connection._dns_host = address
+
+    class PinnedHTTPConnection(HTTPConnection):
+        def _new_conn(self):
+            pin(self)
+            return super()._new_conn()
+
+    class PinnedHTTPSConnection(HTTPSConnection):
+        def _new_conn(self):
+            pin(self)
+            return super()._new_conn()
+
+    class PinnedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = PinnedHTTPConnection
+
+    class PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = PinnedHTTPSConnection
+
+    class PinnedAddressAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **pool_kwargs):
+            super().init_poolmanager(*args, **pool_kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': PinnedHTTPConnectionPool, 'https': PinnedHTTPSConnectionPool}
+
+    return PinnedAddressAdapter(**kwargs)
+
+
+class LinkMetadataFetcher:
+    """
+    Enriches archived links off the request path. A bounded thread pool fetches
+    pages with at most `per_host` concurrent requests per host, reads at most
+    `max_bytes` of each page, revalidates earlier fetches with conditional GET
+    (ETag / Last-Modified, stored in link_metadata), and writes title,
+    description and canonical URL back to the ArchiveItem, which re-indexes it.
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, workers=4, per_host=2, max_bytes=256 * 1024, timeout=5.0, allow_private=False):
+        self.workers = workers
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self.http = None
+        self._executor = None
+        self._host_slots = {}
+        self._pins = threading.local()  # hosts: {hostname: checked address} of the current fetch
+        self._lock = threading.Lock()
+
+    def _get_http(self):
+        if self.http is None:
+            import requests
+
+            http = requests.Session()
+            http.trust_env = False  # A proxy from the environment would resolve hosts itself, bypassing the pin
+            adapter = _pinned_address_adapter(self._pins, pool_maxsize=self.workers, max_retries=0)
+            http.mount('https://', adapter)
+            http.mount('http://', adapter)
+            http.headers.update({'User-Agent': 'HuggerBot/1.0 (link preview)', 'Accept': 'text/html,application/xhtml+xml'})
+            self.http = http
+        return self.http
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='link-metadata')
+            return self._executor
+
+    def _host_slot(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    def submit(self, archive_id, url):
+        """Queues one archive item for enrichment and returns its Future."""
+        return self._get_executor().submit(self.enrich, archive_id, url)
+
+    def enrich_pending(self, limit=50):
+        """Enriches up to `limit` items still marked pending (e.g. when serverless threads were frozen)."""
+        session = Session()
+        try:
+            pending = session.query(ArchiveItem.id, ArchiveItem.content).filter(
+                ArchiveItem.metadata_status == 'pending'
+            ).order_by(ArchiveItem.id).limit(limit).all()
+        finally:
+            session.close()
+        futures = [self.submit(item_id, url) for item_id, url in pending]
+        results = [future.result() for future in futures]
+        return {'processed': len(results), 'done': results.count('done'), 'failed': results.count('failed')}
+
+    def enrich(self, archive_id, url):
+        """Fetches the metadata of one link and stores it; returns 'done' or 'failed'."""
+        try:
+            metadata = self.fetch(url)
+            status = 'done' if metadata is not None else 'failed'
+        except Exception as e:
+            print(f"WARNING: Link metadata fetch failed for {url}: {e}")
+            metadata, status = None, 'failed'
+
+        session = Session()
+        try:
+            item = session.get(ArchiveItem, archive_id)
+            if item is None:
+                return status
+            if metadata:
+                if metadata['title'] and item.title == item.content:
+                    item.title = metadata['title']  # Replace the placeholder title (the link itself)
+                item.description = metadata['description'] or item.description
+                item.canonical_url = metadata['canonical_url'] or item.canonical_url
+            item.metadata_status = status
+            session.commit()  # before_update refreshes search_text, so the new title is searchable
+            if metadata and _related_index:
+                _related_index.update_item(archive_id, item.search_text)
+        except (SQLAlchemyError, OSError) as e:
+            session.rollback()
+            print(f"WARNING: Could not store link metadata for archive item {archive_id}: {e}")
+        finally:
+            session.close()
+        return status
+
+    def fetch(self, url):
+        """Returns the page metadata of `url` (revalidating a cached copy), or None if the page is unusable."""
+        session = Session()
+        try:
+            cached = session.query(LinkMetadata).filter(LinkMetadata.url == url).first()
+            headers = {}
+            if cached and cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached and cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+            response, final_url = self._get(url, headers)
+            if response is None:
+                return None
+            try:
+                if response.status_code == 304 and cached:
+                    cached.fetched_at = datetime.utcnow()
+                    session.commit()
+                    return {'title': cached.title, 'description': cached.description, 'canonical_url': cached.canonical_url}
+                if response.status_code != 200:
+                    return None
+                content_type = response.headers.get('Content-Type', '')
+                metadata = {'title': None, 'description': None, 'canonical_url': None}
+                if 'html' in content_type or not content_type:
+                    body = b''
+                    for chunk in response.iter_content(16 * 1024):
+                        body += chunk
+                        if len(body) >= self.max_bytes:
+                            break  # Byte cap: the <head> is all we need
+                    metadata = parse_link_metadata(_decode_html(body[:self.max_bytes], content_type), final_url)
+            finally:
+                response.close()
+
+            if cached is None:
+                cached = LinkMetadata(url=url)
+                session.add(cached)
+            # Validators describe the final URL, so they are only reused when there was no redirect
+            redirected = final_url != url
+            cached.etag = None if redirected else response.headers.get('ETag')
+            cached.last_modified = None if redirected else response.headers.get('Last-Modified')
+            cached.title = metadata['title']
+            cached.description = metadata['description']
+            cached.canonical_url = metadata['canonical_url'] or (final_url if redirected else None)
+            cached.fetched_at = datetime.utcnow()
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()  # Fetched concurrently by another worker; its row is as good as ours
+            return dict(metadata, canonical_url=cached.canonical_url)
+        finally:
+            session.close()
+
+    def _get(self, url, headers):
+        """GET with manual redirects, so every hop passes the host checks and per-host limit."""
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                return None, url
+            hostname = parts.hostname.lower().rstrip('.')
+            if self.allow_private:
+                self._pins.hosts = {}
+            else:
+                # Connect to exactly the address that was checked, not to a later DNS answer
+                address = _public_address(hostname)
+                if address is None:
+                    print(f"WARNING: Refusing to fetch {url}: host is not public")
+                    return None, url
+                self._pins.hosts = {hostname: address}
+
+            started_at = time.perf_counter()
+            outcome = 'error'
+            with self._host_slot(hostname):
+                try:
+                    response = self._get_http().get(
+                        url, headers=headers, stream=True, allow_redirects=False, timeout=(3.05, self.timeout)
+                    )
+                    outcome = str(response.status_code)
+                finally:
+                    observe_external_call('link', time.perf_counter() - started_at, outcome)
+
+            if response.is_redirect and response.headers.get('Location'):
+                response.close()
+                url = urljoin(url, response.headers['Location'])
+                headers = {}  # Validators belong to the original URL
+                continue
+            return response, url
+        return None, url
+
+
+link_metadata_fetcher = LinkMetadataFetcher(
+    workers=LINK_FETCH_WORKERS, per_host=LINK_FETCH_PER_HOST, max_bytes=LINK_FETCH_MAX_BYTES,
+    timeout=LINK_FETCH_TIMEOUT, allow_private=LINK_FETCH_ALLOW_PRIVATE,
+)
+
+
+# --- Related Items (local vector search over the archive) ---
+
+_RELATED_SUFFIXES = ('هایی', 'های', 'ها', 'ترین', 'تر')
+
+
+def related_features(text_value):
+    """
+    Features of a text for related-item search: words (with common Persian plural
+    and comparative suffixes stripped) plus the character 3-grams of each word,
+    which also match other inflections of it. Returns {feature: count}.
+    """
+    features = {}
+    for word in re.findall(r'[^\W_]+', normalize_persian_text(text_value)):
+        if len(word) < 2 or word.isdigit():
+            continue
+        for suffix in _RELATED_SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 2:
+                word = word[:-len(suffix)]
+                break
+        features['w:' + word] = features.get('w:' + word, 0) + 1
+        padded = f'<{word}>'
+        for start in range(len(padded) - 2):
+            gram = 'c:' + padded[start:start + 3]
+            features[gram] = features.get(gram, 0) + 1
+    return features
+
+
+class RelatedIndex:
+    """
+    Local "more like this" search over archive items (no GPU, no network).
+
+    Every item becomes a hashed TF-IDF vector: sublinear tf, idf from the
+    document frequencies known when the item was indexed, signed feature
+    hashing into `dim` buckets, L2-normalized. Vectors, item ids and the hashed
+    document-frequency table are memory-mapped files under `directory`, so a
+    restart reopens the index and refresh() only vectorizes items newer than
+    the last indexed id, at most `max_rows` per call.
+
+    Writing (refresh, rebuild, update_item) happens off the request path: in the
+    CLI, the maintenance route or the background refresh thread, under a file
+    lock so processes sharing the directory do not corrupt each other. Queries
+    take no file lock: they read the snapshot published in meta.json through
+    read-only mappings. A query is one matrix-vector product over the mapped
+    matrix plus an argpartition for the top k. rebuild() fills a new generation
+    of files and publishes it when done, so readers keep the old one meanwhile.
+    """
+
+    VERSION = 2
+    DF_BUCKETS = 1 << 20  # Hashed document-frequency table (4 MB)
+    DF_SEED = 0x5bd1e995
+    GRAM_WEIGHT = 0.5  # Character 3-grams count less than whole words
+    INITIAL_CAPACITY = 1024
+    BATCH_SIZE = 1000
+
+    def __init__(self, directory, dim=256):
+        import numpy  # Deferred: only /related and /search need it
+        self.np = numpy
+        self.directory = directory
+        self.dim = dim
+        # Writer state (only touched under _write_lock and the file lock)
+        self.count = 0
+        self.capacity = 0
+        self.last_id = 0
+        self.generation = 0
+        self._written_mtime = None
+        self._vectors = self._ids = self._df = None
+        self._write_lock = threading.Lock()
+        # Reader state: the published snapshot (meta.json mtime, vectors, ids, df, count)
+        self._snapshot = (None, None)
+        self._refresh_running = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name, generation=None):
+        if generation is not None:
+            stem, extension = name.split('.')
+            name = f'{stem}.{generation}.{extension}'
+        return os.path.join(self.directory, name)
+
+    def _file_lock(self):
+        """Exclusive lock across processes (writers only); released when the returned file is closed."""
+        handle = open(self._path('lock'), 'a')
+        try:
+            import fcntl
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        except ImportError:
+            pass  # No fcntl (Windows): only the in-process lock applies
+        return handle
+
+    def _files(self, capacity):
+        np = self.np
+        return [
+            ('vectors.f32', np.float32, (capacity, self.dim)),
+            ('ids.i64', np.int64, (capacity,)),
+            ('df.i32', np.int32, (self.DF_BUCKETS,)),
+        ]
+
+    def _map(self, capacity, fresh=False):
+        np = self.np
+        mapped = []
+        for name, dtype, shape in self._files(capacity):
+            path = self._path(name, self.generation)
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            with open(path, 'a+b') as handle:
+                if fresh:
+                    handle.truncate(0)
+                if os.path.getsize(path) < size:
+                    handle.truncate(size)  # Grows the file with zeros (readers' mappings stay valid)
+            mapped.append(np.memmap(path, dtype=dtype, mode='r+', shape=shape))
+        self._vectors, self._ids, self._df = mapped
+        self.capacity = capacity
+
+    def _read_meta(self):
+        """(mtime, meta) of the published snapshot; meta is {} when missing or built with other settings."""
+        meta_path = self._path('meta.json')
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None, {}
+        if meta.get('version') != self.VERSION or meta.get('dim') != self.dim:
+            meta = {}
+        return mtime, meta
+
+    def _sync(self):
+        """Reopens the writer's mappings when meta.json was written by another process since the last look."""
+        mtime, meta = self._read_meta()
+        if self._df is not None and mtime == self._written_mtime:
+            return
+        self.count = meta.get('count', 0)
+        self.last_id = meta.get('last_id', 0)
+        self.generation = meta['generation'] if meta else self.generation + 1  # Start over in new files
+        self._map(max(meta.get('capacity', 0), self.INITIAL_CAPACITY), fresh=not meta)
+        self._written_mtime = mtime
+
+    def _save_meta(self):
+        """Flushes the mapped files, then publishes the new row count (readers never see unwritten rows)."""
+        for mapped in (self._vectors, self._ids, self._df):
+            mapped.flush()
+        meta_path = self._path('meta.json')
+        with open(meta_path + '.tmp', 'w') as meta_file:
+            json.dump({
+                'version': self.VERSION, 'dim': self.dim, 'count': self.count, 'capacity': self.capacity,
+                'last_id': self.last_id, 'generation': self.generation,
+            }, meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+        self._written_mtime = os.stat(meta_path).st_mtime_ns
+
+    def snapshot(self):
+        """(vectors, ids, df, count) as last published, mapped read-only; None while the index is empty."""
+        np = self.np
+        meta_path = self._path('meta.json')
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime == self._snapshot[0]:
+                return self._snapshot[1]
+        mtime, meta = self._read_meta()
+        current = None
+        if meta.get('count'):
+            count, generation = meta['count'], meta['generation']
+            try:
+                current = (
+                    np.memmap(self._path('vectors.f32', generation), dtype=np.float32, mode='r', shape=(count, self.dim)),
+                    np.memmap(self._path('ids.i64', generation), dtype=np.int64, mode='r', shape=(count,)),
+                    np.memmap(self._path('df.i32', generation), dtype=np.int32, mode='r', shape=(self.DF_BUCKETS,)),
+                    count,
+                )
+            except (FileNotFoundError, ValueError):
+                current = None  # Replaced by a rebuild while we looked; the next query maps the new one
+                mtime = None
+        with self._lock:
+            self._snapshot = (mtime, current)
+        return current
+
+    def ready(self):
+        return self.snapshot() is not None
+
+    def _df_slot(self, data):
+        return zlib.crc32(data, self.DF_SEED) % self.DF_BUCKETS
+
+    def _vectorize(self, features, documents, df):
+        np = self.np
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in features.items():
+            data = feature.encode('utf-8')
+            bucket = zlib.crc32(data)
+            idf = math.log((1.0 + documents) / (1.0 + int(df[self._df_slot(data)]))) + 1.0
+            weight = (1.0 + math.log(count)) * idf
+            if feature.startswith('c:'):
+                weight *= self.GRAM_WEIGHT
+            vector[bucket % self.dim] += weight if bucket & 0x80000000 else -weight
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def _append(self, rows):
+        documents = [(row.id, related_features(row.search_text)) for row in rows]
+        documents = [(item_id, features) for item_id, features in documents if features]
+        total = self.count + len(documents)
+        if total > self.capacity:
+            self._map(max(total, self.capacity * 2))
+
+        # Document frequencies first, so a batch's own words already count toward their idf
+        slots = [self._df_slot(feature.encode('utf-8')) for _, features in documents for feature in features]
+        if slots:
+            self.np.add.at(self._df, slots, 1)
+        for row_number, (item_id, features) in enumerate(documents, start=self.count):
+            self._vectors[row_number] = self._vectorize(features, total, self._df)
+            self._ids[row_number] = item_id
+        self.count = total
+        self.last_id = rows[-1].id
+
+    def _fill(self, session, max_rows=None, publish=True):
+        """Appends archive items after last_id in batches, at most `max_rows`; returns how many were read."""
+        added = 0
+        while max_rows is None or added < max_rows:
+            limit = self.BATCH_SIZE if max_rows is None else min(self.BATCH_SIZE, max_rows - added)
+            rows = session.query(ArchiveItem.id, ArchiveItem.search_text).filter(
+                ArchiveItem.id > self.last_id
+            ).order_by(ArchiveItem.id).limit(limit).all()
+            if not rows:
+                break
+            self._append(rows)
+            if publish:
+                self._save_meta()
+            added += len(rows)
+        return added
+
+    def refresh(self, session, max_rows=None):
+        """Indexes up to `max_rows` archive items added since the last refresh (in any process); returns how many."""
+        with self._write_lock, self._file_lock():
+            self._sync()
+            return self._fill(session, max_rows)
+
+    def rebuild(self, session):
+        """Indexes the whole archive again into a new generation of files (refreshes idf for old items)."""
+        with self._write_lock, self._file_lock():
+            self._sync()
+            previous = self.generation
+            self.generation += 1
+            self.count, self.last_id = 0, 0
+            self._map(self.INITIAL_CAPACITY, fresh=True)
+            added = self._fill(session, publish=False)
+            self._save_meta()
+            for name, _, _ in self._files(0):
+                try:
+                    os.remove(self._path(name, previous))  # Readers still mapping it keep their pages
+                except OSError:
+                    pass
+            return added
+
+    def update_item(self, item_id, text_value):
+        """Re-vectorizes an indexed item whose text changed (link metadata arrived); later items wait for refresh()."""
+        with self._write_lock, self._file_lock():
+            self._sync()
+            row_number = int(self.np.searchsorted(self._ids[:self.count], item_id))  # ids are appended in order
+            if row_number < self.count and self._ids[row_number] == item_id:
+                self._vectors[row_number] = self._vectorize(related_features(text_value), self.count, self._df)
+                self._vectors.flush()
+
+    def schedule_refresh(self, max_rows):
+        """Refreshes on a background thread, `max_rows` at a time until caught up; no-op if one is running."""
+        with self._lock:
+            if self._refresh_running:
+                return
+            self._refresh_running = True
+        threading.Thread(target=self._background_refresh, args=(max_rows,), name='related-refresh', daemon=True).start()
+
+    def _background_refresh(self, max_rows):
+        session = Session()
+        try:
+            while self.refresh(session, max_rows) >= max_rows:
+                session.expire_all()
+        except (SQLAlchemyError, OSError) as e:
+            print(f"WARNING: Related-items refresh failed: {e}")
+        finally:
+            session.close()
+            with self._lock:
+                self._refresh_running = False
+
+    def similar(self, text_value, k=5, exclude_ids=(), min_score=0.0):
+        """
+        Returns [(archive_id, cosine similarity)] of the k items closest to `text_value`,
+        best first, from the published snapshot; [] while the index is empty.
+        """
+        np = self.np
+        snapshot = self.snapshot()
+        features = related_features(text_value)
+        if snapshot is None or not features:
+            return []
+        vectors, ids, df, count = snapshot
+        query = self._vectorize(features, count, df)
+        scores = vectors @ query
+        top = min(count, k + len(exclude_ids))
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        matches = [(int(ids[row]), float(scores[row])) for row in candidates]
+        return [(item_id, score) for item_id, score in matches if score >= min_score and item_id not in exclude_ids][:k]
+
+
+_related_index = None
+_related_index_lock = threading.Lock()
+
+
+def get_related_index():
+    """Returns the shared related-items index, or None when disabled or NumPy is missing."""
+    global _related_index
+    if _related_index is None and RELATED_ENABLED:
+        with _related_index_lock:
+            if _related_index is None:
+                try:
+                    _related_index = RelatedIndex(RELATED_INDEX_DIR, dim=RELATED_VECTOR_DIM)
+                except (ImportError, OSError) as e:
+                    print(f"WARNING: Related-items search is unavailable: {e}")
+                    _related_index = False  # Do not retry on every message
+    return _related_index or None
+
+
+def find_related_items(session, text_value, limit=5, exclude_ids=()):
+    """Archive items worded similarly to `text_value` as [(ArchiveItem, score)]; [] without an index or while it is cold."""
+    index = get_related_index()
+    if index is None:
+        return []
+    if not index.ready():
+        index.schedule_refresh(RELATED_REFRESH_MAX_ROWS)  # Built in the background; this request skips it
+        return []
+    try:
+        # A few extra candidates make up for items deleted since they were indexed
+        matches = index.similar(text_value, k=limit + 5, exclude_ids=set(exclude_ids), min_score=RELATED_MIN_SCORE)
+    except OSError as e:
+        print(f"WARNING: Related-items index failed: {e}")
+        return []
+    if not matches:
+        return []
+    items = {item.id: item for item in session.query(ArchiveItem).filter(ArchiveItem.id.in_([item_id for item_id, _ in matches]))}
+    return [(items[item_id], score) for item_id, score in matches if item_id in items][:limit]
+
+
+# --- Outbound Telegram Messages (rate limiting, splitting, edit collapsing) ---
+
+TELEGRAM_MESSAGE_LIMIT = 4096  # Characters (UTF-16 code units) per message
+
+
+def _telegram_length(text):
+    """Message length as Telegram counts it (UTF-16 code units, so emoji count twice)."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Splits a long message into chunks of at most `limit`, preferring line boundaries."""
+    if _telegram_length(text) <= limit:
+        return [text]
+    chunks, current = [], ''
+    for line in text.splitlines(keepends=True):
+        if _telegram_length(current + line) <= limit:
+            current += line
+            continue
+        if current:
+            chunks.append(current)
+            current = ''
+        # A single line longer than the limit is cut hard
+        while _telegram_length(line) > limit:
+            cut = limit
+            while _telegram_length(line[:cut]) > limit:
+                cut -= 1
+            chunks.append(line[:cut])
+            line = line[cut:]
+        current = line
+    if current:
+        chunks.append(current)
+    return [chunk.rstrip('\n') or chunk for chunk in chunks]
+
+
+class TokenBucket:
+    """
+    Token bucket for outgoing calls. reserve() takes a token (the balance may go
+    negative) and returns how long the caller has to wait, so concurrent waiting
+    senders queue up in arrival order; try_take() only takes a token that is
+    available right now.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def try_take(self):
+        """Takes a token if one is available now; never goes into debt."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def refund(self):
+        """Returns a token taken for a call that was not sent."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def block(self, seconds):
+        """Stops handing out tokens for `seconds` (after a 429 from Telegram)."""
+        with self._lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = min(self.tokens, 0)
+            self.updated_at = now
+
+
+class OutboundSender:
+    """
+    Shapes outgoing Bot API calls to Telegram's flood limits.
+
+    Every sending call needs a token from the global bucket and from its chat's
+    bucket (groups: 20 per minute, with a full minute of burst). Messages over
+    4096 characters are split on line boundaries, a 429 blocks the chat for
+    `retry_after` seconds, and edits of a message made while an earlier edit is
+    still waiting are merged into it, so only the latest text is sent.
+
+    Background threads wait for their token on the calling thread. Inside
+    no_wait() (the synchronous webhook request) nothing sleeps: a call without
+    a token, or one answered with 429, goes to a delivery thread that waits and
+    sends it, and later calls to that chat follow it there to keep their order.
+    A call that would have to wait longer than `max_wait` (for a token or after
+    a 429) is handed to that delivery thread too, so the caller is not blocked
+    and the reply is not lost; only the delivery thread waits that long.
+    """
 
-if not DATABASE_URL:
-    print("FATAL: DATABASE_URL is not set. The application will not work without a database connection.")
+    UNLIMITED_METHODS = frozenset({'answerCallbackQuery', 'sendChatAction', 'getMe', 'getUpdates', 'setWebhook'})
 
-# Database Initialization
-Base = declarative_base()
-engine = create_engine(DATABASE_URL, echo=False)
-Session = sessionmaker(bind=engine)
+    def __init__(self, global_rate, chat_rate, group_rate, chat_burst, group_burst=20, max_retries=3, max_wait=25,
+                 max_chats=10000, deferred_queue_size=1000):
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.max_chats = max_chats
+        self._chat_buckets = OrderedDict()
+        self._pending_edits = {}  # (chat_id, message_id) -> latest edit waiting to be sent
+        self._deferred = queue.Queue(maxsize=deferred_queue_size)
+        self._deferred_chats = {}  # chat_id -> calls of that chat in the deferred queue
+        self._deferred_thread = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
 
-# Task Model (وظایف تیم)
-class Task(Base):
-    __tablename__ = 'tasks'
-    id = Column(Integer, primary_key=True)
-    title = Column(String(256), nullable=False)
-    assigned_to = Column(String(64))  # Telegram User ID
-    due_date = Column(DateTime)
-    status = Column(String(32), default='To Do')
-    created_at = Column(DateTime, default=datetime.utcnow)
+    @contextmanager
+    def no_wait(self):
+        """Within this block, calls on this thread are sent now or deferred, never waited for."""
+        previous = getattr(self._local, 'no_wait', False)
+        self._local.no_wait = True
+        try:
+            yield
+        finally:
+            self._local.no_wait = previous
 
-# Archive Model (حافظه بلندمدت و آرشیو لینک)
-class ArchiveItem(Base):
-    __tablename__ = 'archive'
-    id = Column(Integer, primary_key=True)
-    title = Column(String(256), nullable=False)
-    content = Column(Text, nullable=False) # URL or Memorized Text
-    tags = Column(String(256))
-    user_id = Column(String(64))
-    archived_at = Column(DateTime, default=datetime.utcnow)
+    def waiting_allowed(self):
+        return not getattr(self._local, 'no_wait', False)
 
-# Activity Log Model (ثبت کارکرد فردی)
-class ActivityLog(Base):
-    __tablename__ = 'activity_log'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(String(64))
-    description = Column(Text, nullable=False)
-    logged_at = Column(DateTime, default=datetime.utcnow)
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if str(chat_id).startswith('-'):
+                    bucket = TokenBucket(self.group_rate, self.group_burst)
+                else:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chat_buckets[chat_id] = bucket
+                while len(self._chat_buckets) > self.max_chats:
+                    self._chat_buckets.popitem(last=False)
+            self._chat_buckets.move_to_end(chat_id)
+            return bucket
 
-# Shopping List Model (مدیریت خرید)
-class ShoppingItem(Base):
-    __tablename__ = 'shopping_list'
-    id = Column(Integer, primary_key=True)
-    item_name = Column(String(256), nullable=False)
-    is_bought = Column(Boolean, default=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    bought_at = Column(DateTime)
+    def send(self, endpoint, data, post):
+        """Delivers one Bot API call through `post(endpoint, data)`, splitting long messages."""
+        text = data.get('text')
+        if endpoint == 'sendMessage' and isinstance(text, str) and _telegram_length(text) > TELEGRAM_MESSAGE_LIMIT:
+            chunks = split_message(text)
+            OUTBOUND_MESSAGES.inc(len(chunks) - 1, outcome='split')
+            result = None
+            for index, chunk in enumerate(chunks):
+                chunk_data = dict(data, text=chunk)
+                if index > 0:
+                    chunk_data.pop('reply_to_message_id', None)
+                if index < len(chunks) - 1:
+                    chunk_data.pop('reply_markup', None)
+                result = self._send_one(endpoint, chunk_data, post)
+            return result
+        if endpoint == 'editMessageText' and isinstance(text, str) and _telegram_length(text) > TELEGRAM_MESSAGE_LIMIT:
+            # An edit cannot become several messages; keep the head of the text
+            data = dict(data, text=split_message(text, TELEGRAM_MESSAGE_LIMIT - 1)[0] + '…')
+        return self._send_one(endpoint, data, post)
+
+    def _send_one(self, endpoint, data, post):
+        if endpoint in self.UNLIMITED_METHODS or 'chat_id' not in data:
+            return post(endpoint, data)
+
+        chat_id = data['chat_id']
+        edit_key = None
+        if endpoint == 'editMessageText' and data.get('message_id'):
+            edit_key = (chat_id, data['message_id'])
+            with self._lock:
+                if edit_key in self._pending_edits:
+                    # An earlier edit of this message is still waiting for a token; it will send this text instead
+                    self._pending_edits[edit_key] = data
+                    OUTBOUND_MESSAGES.inc(outcome='collapsed')
+                    return True
+                self._pending_edits[edit_key] = data
+
+        if self.waiting_allowed():
+            return self._send_waiting(endpoint, data, post, edit_key)
+
+        chat_bucket = self._chat_bucket(chat_id)
+        with self._lock:
+            queued_for_chat = self._deferred_chats.get(chat_id, 0)
+        if not queued_for_chat and chat_bucket.try_take():
+            if self.global_bucket.try_take():
+                if edit_key:
+                    with self._lock:
+                        data = self._pending_edits.pop(edit_key, data)
+                try:
+                    result = post(endpoint, data)
+                    OUTBOUND_MESSAGES.inc(outcome='sent')
+                    return result
+                except RetryAfter as e:
+                    chat_bucket.block(e.retry_after)
+                    if edit_key:
+                        with self._lock:
+                            data = self._pending_edits.setdefault(edit_key, data)
+            else:
+                chat_bucket.refund()
+        return self._defer(endpoint, data, post, edit_key)
+
+    def _send_waiting(self, endpoint, data, post, edit_key, deferred=False):
+        """
+        Waits for the tokens on this thread, then sends; retries after a 429.
+        A wait over max_wait is left to the delivery thread (deferred=True there).
+        """
+        chat_bucket = self._chat_bucket(data['chat_id'])
+        attempt = 0
+        while True:
+            chat_wait = chat_bucket.reserve()
+            global_wait = self.global_bucket.reserve()
+            wait = max(chat_wait, global_wait)
+            if wait > self.max_wait and not deferred:
+                chat_bucket.refund()
+                self.global_bucket.refund()
+                print(f"WARNING: Deferred {endpoint} to chat {data['chat_id']}: it would wait {wait:.0f}s for the flood limit")
+                return self._defer(endpoint, data, post, edit_key)
+            if wait > 0:
+                OUTBOUND_WAIT.observe(wait)
+                time.sleep(wait)
+            if edit_key:
+                with self._lock:
+                    data = self._pending_edits.pop(edit_key, data)
+            try:
+                result = post(endpoint, data)
+                OUTBOUND_MESSAGES.inc(outcome='sent')
+                return result
+            except RetryAfter as e:
+                attempt += 1
+                chat_bucket.block(e.retry_after)
+                if attempt > self.max_retries:
+                    OUTBOUND_MESSAGES.inc(outcome='rate_limited')
+                    raise
+                if edit_key:
+                    with self._lock:
+                        # Keep collapsing newer edits into this one while it waits again
+                        data = self._pending_edits.setdefault(edit_key, data)
+                if e.retry_after > self.max_wait and not deferred:
+                    print(f"WARNING: Telegram flood limit for chat {data['chat_id']}, deferring for {e.retry_after}s")
+                    return self._defer(endpoint, data, post, edit_key)
+                OUTBOUND_MESSAGES.inc(outcome='retried')
+                print(f"WARNING: Telegram flood limit for chat {data['chat_id']}, retrying in {e.retry_after}s")
+
+    def _defer(self, endpoint, data, post, edit_key):
+        """Queues the call for the delivery thread; returns True like a call answered in the webhook response."""
+        chat_id = data['chat_id']
+        with self._lock:
+            try:
+                self._deferred.put_nowait((endpoint, data, post, edit_key))
+            except queue.Full:
+                if edit_key:
+                    self._pending_edits.pop(edit_key, None)
+                OUTBOUND_MESSAGES.inc(outcome='dropped')
+                print(f"WARNING: Dropped {endpoint} to chat {chat_id}: the deferred delivery queue is full")
+                return True
+            self._deferred_chats[chat_id] = self._deferred_chats.get(chat_id, 0) + 1
+            if self._deferred_thread is None:
+                self._deferred_thread = threading.Thread(target=self._deliver_deferred, name='outbound-deferred', daemon=True)
+                self._deferred_thread.start()
+        OUTBOUND_MESSAGES.inc(outcome='deferred')
+        return True
+
+    def _deliver_deferred(self):
+        while True:
+            endpoint, data, post, edit_key = self._deferred.get()
+            chat_id = data['chat_id']
+            try:
+                self._send_waiting(endpoint, data, post, edit_key, deferred=True)
+            except Exception as e:
+                print(f"WARNING: Deferred {endpoint} to chat {chat_id} failed: {e}")
+            finally:
+                with self._lock:
+                    remaining = self._deferred_chats.get(chat_id, 1) - 1
+                    if remaining > 0:
+                        self._deferred_chats[chat_id] = remaining
+                    else:
+                        self._deferred_chats.pop(chat_id, None)
+
+    def deferred_depth(self):
+        return self._deferred.qsize()
+
+
+outbound_sender = OutboundSender(
+    global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+    group_rate=OUTBOUND_GROUP_RATE_PER_MINUTE / 60.0, chat_burst=OUTBOUND_CHAT_BURST,
+    group_burst=max(1, int(OUTBOUND_GROUP_RATE_PER_MINUTE)),
+    max_retries=OUTBOUND_MAX_RETRIES, max_wait=OUTBOUND_MAX_WAIT,
+    deferred_queue_size=OUTBOUND_DEFERRED_QUEUE_SIZE,
+)
 
-# Create tables in the database
-Base.metadata.create_all(engine)
 
 # -------------------------------------------------------------------------
-# 3. UTILITY FUNCTIONS
+# 3a. METRICS (Prometheus text format, served on <WEBHOOK_PATH>/metrics)
 # -------------------------------------------------------------------------
 
-def get_user_name(user_id):
-    """Retrieves a personalized name based on user ID."""
-    try:
-        user_map_json = os.environ.get('USER_NAMES_MAP')
-        user_map = json.loads(user_map_json) if user_map_json else DEFAULT_USER_MAP
-        return user_map.get(str(user_id), 'رفیق')
-    except (json.JSONDecodeError, TypeError):
-        return DEFAULT_USER_MAP.get(str(user_id), 'رفیق')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
 
-def is_valid_url(url):
-    """Simple check if a string looks like a URL."""
-    return url.startswith('http')
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
 
 
-def _call_external_ai_api_for_summary(text_to_summarize):
-    """Calls the configured external AI API (e.g., GAP API) for summarization."""
-    if not GAP_API_KEY or not GAP_API_URL:
-        return "⚠️ دسترسی به API هوش مصنوعی قطع است. لطفاً متغیرهای محیطی GAP_API_KEY و GAP_API_URL را تنظیم کنید."
+class Counter:
+    """Monotonic counter with optional labels."""
 
-    try:
-        # We need a generic payload structure that many AI models use
-        headers = {
-            'Authorization': f'Bearer {GAP_API_KEY}',
-            'Content-Type': 'application/json',
-        }
-        
-        # System instruction in Persian for the AI model
-        system_prompt = "تو یک دستیار هوشمند، حرفه‌ای و خلاصه نویس هستی. متن فارسی یا انگلیسی زیر را بخوان و خلاصه‌ای دقیق، مختصر و کاملاً به زبان فارسی از آن تهیه کن."
-        
-        payload = {
-            # Assuming a standard chat completion endpoint structure
-            "model": "gpt-3.5-turbo", # Common model name
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"خلاصه‌ای از این متن بده:\n\n{text_to_summarize}"}
-            ],
-            "max_tokens": 500
-        }
-        
-        # Exponential Backoff for stability
-        max_retries = 3
-        for i in range(max_retries):
-            response = requests.post(GAP_API_URL + '/chat/completions', headers=headers, json=payload, timeout=30)
-            if response.status_code == 200:
-                result = response.json()
-                # Assuming the response structure contains choices[0].message.content
-                summary = result['choices'][0]['message']['content']
-                return f"🧠 خلاصه‌سازی هوشمند:\n\n{summary}"
-            elif response.status_code == 429: # Rate limit
-                time.sleep(2 ** i)
-            else:
-                return f"❌ خطای API: {response.status_code} - پیام: {response.text[:100]}"
-                
-        return "❌ خطای ناشی از محدودیت در تعداد درخواست‌ها. لطفاً دوباره تلاش کنید."
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose samples are read from a callback at scrape time: fn() -> [(labels dict, value)]."""
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            samples = self.collect()
+        except Exception as e:
+            print(f"WARNING: Could not collect metric {self.name}: {e}")
+            samples = []
+        lines += [f"{self.name}{_format_labels(sorted(labels.items()))} {value}" for labels, value in samples]
+        return lines
+
+
+HANDLER_DURATION = Histogram('hugger_handler_duration_seconds', 'Time spent in a bot handler.')
+HANDLER_ERRORS = Counter('hugger_handler_errors_total', 'Unhandled exceptions raised by bot handlers.')
+UPDATE_DURATION = Histogram('hugger_update_duration_seconds', 'Time to process one Telegram update end to end.')
+SLOW_UPDATES = Counter('hugger_slow_updates_total', 'Updates slower than SLOW_UPDATE_MS.')
+SQL_STATEMENTS = Counter('hugger_sql_statements_total', 'SQL statements executed, by handler.')
+SQL_DURATION = Histogram('hugger_sql_duration_seconds', 'SQL statement execution time, by handler.')
+WEBHOOK_REPLIES = Counter('hugger_webhook_replies_total', 'Bot API calls answered in the webhook response (inline) or sent separately to keep order (flushed).')
+UPDATE_LEDGER = Counter('hugger_update_ledger_total', 'Update ledger claims by outcome (claimed, reclaimed, done, in_progress, unguarded, pruned).')
+OUTBOUND_MESSAGES = Counter('hugger_outbound_messages_total', 'Outgoing Bot API calls by outcome (sent, split, collapsed, deferred, retried, rate_limited, dropped).')
+OUTBOUND_WAIT = Histogram('hugger_outbound_wait_seconds', 'Time an outgoing call waited for a rate-limit token.')
+REMINDERS_SENT = Counter('hugger_reminders_total', 'Due-date reminders sent, by kind (upcoming, overdue).')
+EXTERNAL_CALL_DURATION = Histogram('hugger_external_call_duration_seconds', 'Outbound API call time (GAP, translate).')
+
+# Name of the handler running on this thread, used to attribute SQL statements
+_handler_context = threading.local()
+
+
+def current_handler():
+    return getattr(_handler_context, 'name', 'none')
+
+
+def instrument_handler(callback, name=None):
+    """Wraps a handler callback to record its latency, SQL usage and errors."""
+    handler_name = name or callback.__name__
+
+    def instrumented(update, context):
+        previous = current_handler()
+        _handler_context.name = handler_name
+        started_at = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=handler_name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started_at, handler=handler_name)
+            _handler_context.name = previous
+
+    instrumented.__name__ = callback.__name__
+    instrumented.__doc__ = callback.__doc__
+    return instrumented
+
+
+def instrument_engine(bind):
+    """Counts and times every SQL statement, attributed to the running handler."""
+
+    @event.listens_for(bind, 'before_cursor_execute')
+    def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    @event.listens_for(bind, 'after_cursor_execute')
+    def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        started_at = connection.info['query_started_at'].pop()
+        handler_name = current_handler()
+        SQL_STATEMENTS.inc(handler=handler_name)
+        SQL_DURATION.observe(time.perf_counter() - started_at, handler=handler_name)
+        _handler_context.sql_count = getattr(_handler_context, 'sql_count', 0) + 1
 
-    except requests.exceptions.RequestException as e:
-        return f"❌ خطای اتصال به سرور GAP API: {e}"
+
+def observe_external_call(service, seconds, outcome):
+    EXTERNAL_CALL_DURATION.observe(seconds, service=service, outcome=outcome)
+
+
+def render_metrics():
+    """Renders all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def _update_queue_samples():
+    if not update_pool:
+        return []
+    stats = update_pool.stats()
+    return [({'kind': 'depth'}, stats['depth']), ({'kind': 'capacity'}, stats['capacity']),
+            ({'kind': 'enqueued_total'}, stats['enqueued']), ({'kind': 'rejected_total'}, stats['rejected'])]
+
+
+def _db_pool_samples():
+    if _engine is None:
+        return []
+    stats = pool_metrics.stats(_engine.pool)
+    samples = [({'kind': 'checkouts_total'}, stats['checkouts']),
+               ({'kind': 'checkout_timeouts_total'}, stats['checkout_timeouts']),
+               ({'kind': 'connections_opened_total'}, stats['connections_opened']),
+               ({'kind': 'checkout_wait_ms_max'}, stats['checkout_wait_ms_max'])]
+    if 'connections_in_use' in stats:
+        samples += [({'kind': 'in_use'}, stats['connections_in_use']), ({'kind': 'idle'}, stats['connections_idle'])]
+    return samples
+
+
+def _cache_samples():
+    summary = summary_cache.stats()
+    translation = translation_service.memory
+    return [({'cache': 'summary_memory', 'result': 'hit'}, summary['memory_hits']),
+            ({'cache': 'summary_memory', 'result': 'miss'}, summary['memory_misses']),
+            ({'cache': 'summary_db', 'result': 'hit'}, summary['db_hits']),
+            ({'cache': 'summary_db', 'result': 'miss'}, summary['db_misses']),
+            ({'cache': 'translation_memory', 'result': 'hit'}, translation.hits),
+            ({'cache': 'translation_memory', 'result': 'miss'}, translation.misses)]
+
+
+METRICS = [
+    HANDLER_DURATION, HANDLER_ERRORS, UPDATE_DURATION, SLOW_UPDATES,
+    SQL_STATEMENTS, SQL_DURATION, EXTERNAL_CALL_DURATION, WEBHOOK_REPLIES, UPDATE_LEDGER, OUTBOUND_MESSAGES, OUTBOUND_WAIT,
+    REMINDERS_SENT,
+    Gauge('hugger_update_queue', 'Background update queue (UPDATE_PROCESSING_MODE=async).', _update_queue_samples),
+    Gauge('hugger_db_pool', 'Database connection pool counters.', _db_pool_samples),
+    Gauge('hugger_cache_lookups', 'Cache lookups by cache and result (cumulative).', _cache_samples),
+]
 
 
 # -------------------------------------------------------------------------
@@ -184,25 +3254,31 @@ def help_command(update: Update, context):
     message = (
         "📚 راهنمای جامع ربات هوگر:\n\n"
         "**مدیریت کارها (تسک):**\n"
-        "• `/addtask <عنوان> /to @نام_کاربر /due YYYY-MM-DD` : ثبت یک کار جدید.\n"
-        "• `/tasks` : نمایش لیست کارهای فعال.\n"
-        "• `/done <شماره_تسک>` : انجام‌شده علامت زدن یک کار.\n\n"
+        "• `/addtask <عنوان> /to @نام_کاربر /due YYYY-MM-DD` : ثبت یک کار جدید (نزدیک مهلت و بعد از آن یادآوری می‌کنم).\n"
+        "• `/tasks` : نمایش لیست کارهای فعال (`mine`، `overdue` یا `@نام_کاربر` برای فیلتر).\n"
+        "• `/done <شماره_تسک>` : انجام‌شده علامت زدن کارها (مثلا `/done 3 5 9` یا `/done 12-15`).\n\n"
         
         "**حافظه بلندمدت و دانش:**\n"
         "• `/memorize` : روی یک پیام مهم ریپلای کن تا ربات اون رو به حافظه بلندمدت اضافه کنه.\n"
-        "• `/archive <لینک> #تگ1 #تگ2` : ذخیره لینک‌ها و مستندات مهم.\n"
-        "• `/search <کلمه کلیدی>` : جستجو در آرشیو و حافظه ربات.\n\n"
+        "• `/archive <لینک> [<لینک> ...] #تگ1 #تگ2` : ذخیره لینک‌ها و مستندات مهم.\n"
+        "• `/search <کلمه کلیدی>` : جستجو در آرشیو و حافظه ربات.\n"
+        "• `/search #تگ1 #تگ2` : آیتم‌هایی که همه این تگ‌ها رو دارن.\n"
+        "• `/related <متن>` : پیدا کردن موارد هم‌معنی در آرشیو و حافظه، حتی با کلمات متفاوت (یا ریپلای روی پیام).\n"
+        "• `/tags` : لیست تگ‌ها و تعداد آیتم‌های هر کدوم.\n\n"
         
         "**مدیریت خرید و فعالیت:**\n"
-        "• `/buy add <آیتم>` : افزودن یک قلم به لیست خرید.\n"
+        "• `/buy add <آیتم>، <آیتم>` : افزودن یک یا چند قلم به لیست خرید.\n"
         "• `/buy list` : نمایش اقلام مورد نیاز و خریداری شده.\n"
-        "• `/buy done <شماره_آیتم>` : علامت زدن یک قلم به عنوان خریداری شده.\n"
-        "• `/logwork <شرح کار>` : ثبت فعالیتی که انجام دادی.\n\n"
+        "• `/buy done <شماره_آیتم> ...` : علامت زدن اقلام به عنوان خریداری شده.\n"
+        "• `/logwork <شرح کار>` : ثبت فعالیتی که انجام دادی.\n"
+        "• `/mywork [از] [تا] [csv|json] [team]` : گزارش کارکرد یا خروجی فایل (تاریخ‌ها به شکل YYYY-MM-DD).\n\n"
         
         "**ابزارهای هوشمند:**\n"
-        "• `/summary` : گزارش آماری هفتگی (و اگر با `#خلاصه_کن` ریپلای کنی، پیام رو با AI خلاصه می‌کنه).\n"
+        "• `/summary` : گزارش آماری هفتگی (و اگر با `#خلاصه_کن` ریپلای کنی، پیام رو با AI خلاصه می‌کنه؛ `#بدون_کش` خلاصه رو از نو می‌سازه).\n"
+        "• `/summary team` : گزارش هفتگی به تفکیک اعضا.\n"
+        "• `/summary digest [تعداد]` : جمع‌بندی AI از آخرین پیام‌های ذخیره‌شده با `/memorize`.\n"
         "• `/countdown` : روزشمار تا شروع هوگر.\n"
-        "• `/translate <متن انگلیسی>` : ترجمه سریع متن به فارسی.\n"
+        "• `/translate <متن انگلیسی>` : ترجمه سریع متن به فارسی (یا ریپلای روی یه پیام).\n"
         "• `/commands` : لیست سریع دستورات."
     )
     update.message.reply_text(message)
@@ -214,13 +3290,16 @@ def command_functions(update: Update, context):
         "📋 لیست سریع دستورات:\n\n"
         "• `/memorize`: ثبت پیام مهم در حافظه (ریپلای لازم).\n"
         "• `/search`: جستجو در آرشیو و حافظه.\n"
+        "• `/related`: موارد مشابه در آرشیو.\n"
         "• `/archive`: ذخیره لینک‌های مهم.\n"
+        "• `/tags`: لیست تگ‌های آرشیو.\n"
         "• `/buy`: مدیریت لیست خرید.\n"
         "• `/addtask`: ثبت کار جدید.\n"
         "• `/tasks`: لیست کارهای باقی‌مانده.\n"
         "• `/done`: اتمام یک کار.\n"
         "• `/summary`: گزارش آماری یا خلاصه‌سازی AI.\n"
         "• `/logwork`: ثبت کارکرد فردی.\n"
+        "• `/mywork`: گزارش و خروجی کارکرد.\n"
         "• `/countdown`: روزشمار هوگر.\n"
         "• `/translate`: ترجمه متن انگلیسی."
     )
@@ -238,6 +3317,7 @@ def add_task(update: Update, context):
         return
 
     # Simple parsing logic
+    session = get_db_session()
     try:
         parts = ' '.join(context.args).split('/')
         title_part = parts[0].strip()
@@ -256,15 +3336,18 @@ def add_task(update: Update, context):
         if not title_part:
             raise ValueError("عنوان کار خالی است.")
             
-        session = Session()
         new_task = Task(
             title=title_part,
             assigned_to=assigned_to,
             due_date=due_date,
-            status='To Do'
+            status='To Do',
+            chat_id=str(update.effective_chat.id)
         )
         session.add(new_task)
+        stats_engine.record(session, 'tasks_created', user_id)
         session.commit()
+        if due_date and reminder_scheduler:
+            reminder_scheduler.schedule(due_date)
         
         due_info = f"تا تاریخ: {due_date.strftime('%Y-%m-%d')}" if due_date else "مهلت: نامشخص"
         update.message.reply_text(
@@ -285,32 +3368,102 @@ def add_task(update: Update, context):
         session.close()
 
 
+def _task_filter_conditions(task_filter):
+    """SQL conditions for a /tasks filter: 'all', 'od' (overdue) or an '@assignee'."""
+    conditions = [Task.status.in_(ACTIVE_TASK_STATUSES)]
+    if task_filter == 'od':
+        conditions.append(Task.due_date < datetime.utcnow())
+    elif task_filter.startswith('@'):
+        # Assignees are free text: '@Ali' and '@ali' are the same Telegram username
+        conditions.append(func.lower(Task.assigned_to) == task_filter.lower())
+    return conditions
+
+
+def fetch_tasks_page(session, task_filter='all', after_id=None, before_id=None, page_size=TASKS_PAGE_SIZE):
+    """
+    Keyset pagination over active tasks ordered by id: every page is an index
+    range scan (status, id) that reads at most page_size + 1 rows.
+    Returns (tasks, has_previous, has_next).
+    """
+    query = session.query(Task).filter(*_task_filter_conditions(task_filter))
+    if before_id is not None:
+        tasks = query.filter(Task.id < before_id).order_by(Task.id.desc()).limit(page_size + 1).all()
+        has_previous = len(tasks) > page_size
+        return list(reversed(tasks[:page_size])), has_previous, True
+
+    if after_id is not None:
+        query = query.filter(Task.id > after_id)
+    tasks = query.order_by(Task.id).limit(page_size + 1).all()
+    return tasks[:page_size], after_id is not None, len(tasks) > page_size
+
+
+def render_tasks_page(session, task_filter='all', after_id=None, before_id=None):
+    """Builds the text and Prev/Next keyboard of one /tasks page (text is None when empty)."""
+    tasks, has_previous, has_next = fetch_tasks_page(session, task_filter, after_id, before_id)
+    if not tasks:
+        return None, None
+
+    # Resolve all assignee names with one batched lookup
+    assignee_names = user_directory.resolve_many(task.assigned_to for task in tasks)
+
+    filter_labels = {'all': '', 'od': ' (عقب‌افتاده)'}
+    tasks_list = f"📋 لیست کارهای باقی‌مانده{filter_labels.get(task_filter, f' ({task_filter})')}:\n\n"
+    for task in tasks:
+        due_info = f"({task.due_date.strftime('%Y-%m-%d')})" if task.due_date else ""
+        assignee = task.assigned_to
+        if assignee in assignee_names:
+            assignee = f"{assignee_names[assignee]} ({assignee})"
+        tasks_list += (
+            f"**#{task.id}** [وضعیت: {task.status}]\n"
+            f"عنوان: {task.title}\n"
+            f"مسئول: {assignee} {due_info}\n"
+            "----------------------------------\n"
+        )
+
+    # callback_data (max 64 bytes): tasks:<filter>:<p|n>:<cursor id>
+    buttons = []
+    if has_previous:
+        buttons.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"tasks:{task_filter}:p:{tasks[0].id}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("بعدی ➡️", callback_data=f"tasks:{task_filter}:n:{tasks[-1].id}"))
+    keyboard = InlineKeyboardMarkup([buttons]) if buttons else None
+    return tasks_list, keyboard
+
+
 def list_tasks(update: Update, context):
-    """Handles the /tasks command to show active tasks."""
+    """
+    Handles the /tasks command to show active tasks, one page at a time.
+    Filters: `/tasks mine`, `/tasks overdue`, `/tasks @username`.
+    """
     user_id = update.effective_user.id
     user_name = get_user_name(user_id)
-    session = Session()
+
+    task_filter = 'all'
+    if context.args:
+        option = context.args[0]
+        if option.lower() in ('mine', 'من'):
+            username = update.effective_user.username
+            if not username:
+                update.message.reply_text(f"{user_name} جان، برای `/tasks mine` باید یوزرنیم تلگرام داشته باشی.")
+                return
+            task_filter = '@' + username
+        elif option.lower() in ('overdue', 'عقب_افتاده'):
+            task_filter = 'od'
+        elif option.startswith('@'):
+            task_filter = option[:33]
+
+    session = get_db_session()
     try:
-        active_tasks = session.query(Task).filter(Task.status.in_(['To Do', 'In Progress'])).all()
+        tasks_list, keyboard = render_tasks_page(session, task_filter)
         
-        if not active_tasks:
+        if not tasks_list:
             update.message.reply_text(
                 f"🎉 آفرین به تیم هوگر! {user_name} جان، در حال حاضر هیچ کار فعالی نداریم. "
                 "بریم سراغ چالش بعدی! 😎"
             )
             return
 
-        tasks_list = "📋 لیست کارهای باقی‌مانده:\n\n"
-        for task in active_tasks:
-            due_info = f"({task.due_date.strftime('%Y-%m-%d')})" if task.due_date else ""
-            tasks_list += (
-                f"**#{task.id}** [وضعیت: {task.status}]\n"
-                f"عنوان: {task.title}\n"
-                f"مسئول: {task.assigned_to} {due_info}\n"
-                "----------------------------------\n"
-            )
-        
-        update.message.reply_text(tasks_list)
+        update.message.reply_text(tasks_list, reply_markup=keyboard)
         
     except SQLAlchemyError:
         update.message.reply_text("❌ خطای دیتابیس در دریافت لیست کارها.")
@@ -318,32 +3471,88 @@ def list_tasks(update: Update, context):
         session.close()
 
 
+def tasks_page_callback(update: Update, context):
+    """Handles the Prev/Next buttons of /tasks by editing the message in place."""
+    query = update.callback_query
+    try:
+        _, task_filter, direction, cursor = query.data.split(':', 3)
+        cursor = int(cursor)
+    except ValueError:
+        query.answer()
+        return
+
+    session = get_db_session()
+    try:
+        if direction == 'p':
+            tasks_list, keyboard = render_tasks_page(session, task_filter, before_id=cursor)
+        else:
+            tasks_list, keyboard = render_tasks_page(session, task_filter, after_id=cursor)
+
+        if not tasks_list:
+            query.answer("صفحه دیگه‌ای نیست.")
+            return
+        query.edit_message_text(tasks_list, reply_markup=keyboard)
+        query.answer()
+
+    except SQLAlchemyError:
+        query.answer("❌ خطای دیتابیس در دریافت لیست کارها.")
+    except BadRequest:
+        # "Message is not modified" when the page did not change
+        query.answer()
+    finally:
+        session.close()
+
+
 def mark_done(update: Update, context):
-    """Handles the /done command to complete a task."""
+    """Handles /done to complete one or more tasks: `/done 15`, `/done 3 5 9`, `/done 12-15`."""
     user_id = update.effective_user.id
     user_name = get_user_name(user_id)
 
-    if not context.args or not context.args[0].isdigit():
-        update.message.reply_text(f"عزیزم {user_name} جان! باید شماره تسک رو بعد از `/done` بزنی. مثلا: `/done 15`")
+    task_ids = parse_id_list(context.args) if context.args else None
+    if not task_ids:
+        update.message.reply_text(
+            f"عزیزم {user_name} جان! باید شماره تسک رو بعد از `/done` بزنی. مثلا: `/done 15`، `/done 3 5 9` یا `/done 12-15` "
+            f"(حداکثر {BULK_MAX_ITEMS} تسک)"
+        )
         return
-        
-    task_id = int(context.args[0])
-    session = Session()
+
+    session = get_db_session()
     try:
-        task = session.query(Task).filter(Task.id == task_id).first()
-        
-        if not task:
-            update.message.reply_text(f"❌ تسکی با شماره `{task_id}` پیدا نشد. مطمئنی درسته؟")
-            return
-            
-        task.status = 'Done'
-        session.commit()
-        update.message.reply_text(
-            f"✅ دمت گرم {user_name}!\n"
-            f"کار **'{task.title}'** با موفقیت به وضعیت 'انجام‌شده' منتقل شد. "
-            "بریم سراغ کار بعدی؟ 😉"
+        # One UPDATE ... RETURNING for all ids; tasks that are already done are left untouched
+        completed = update_returning(
+            session, Task, task_ids, {Task.status: 'Done', Task.completed_at: datetime.utcnow()},
+            Task.status != 'Done', columns=(Task.id, Task.title)
         )
-        
+        stats_engine.record(session, 'tasks_done', user_id, amount=len(completed))
+        session.commit()
+
+        skipped = sorted(set(task_ids) - {row.id for row in completed})
+        already_done = set()
+        if skipped:
+            already_done = {row.id for row in session.query(Task.id).filter(Task.id.in_(skipped))}
+        missing = [task_id for task_id in skipped if task_id not in already_done]
+
+        if len(task_ids) == 1 and completed:
+            update.message.reply_text(
+                f"✅ دمت گرم {user_name}!\n"
+                f"کار **'{completed[0].title}'** با موفقیت به وضعیت 'انجام‌شده' منتقل شد. "
+                "بریم سراغ کار بعدی؟ 😉"
+            )
+            return
+        if len(task_ids) == 1 and missing:
+            update.message.reply_text(f"❌ تسکی با شماره `{task_ids[0]}` پیدا نشد. مطمئنی درسته؟")
+            return
+
+        lines = []
+        if completed:
+            lines.append(f"✅ دمت گرم {user_name}! این {len(completed)} کار انجام‌شده ثبت شد:")
+            lines += [f"• `#{row.id}` {row.title}" for row in sorted(completed, key=lambda row: row.id)]
+        if already_done:
+            lines.append("☑️ از قبل انجام‌شده: " + '، '.join(f"`#{task_id}`" for task_id in sorted(already_done)))
+        if missing:
+            lines.append("❌ پیدا نشد: " + '، '.join(f"`#{task_id}`" for task_id in missing))
+        update.message.reply_text('\n'.join(lines))
+
     except SQLAlchemyError:
         update.message.reply_text("❌ خطای دیتابیس در به‌روزرسانی وضعیت کار.")
         session.rollback()
@@ -351,6 +3560,40 @@ def mark_done(update: Update, context):
         session.close()
 
 
+def _save_archive_entries(session, entries, tags, user_id, is_memorize):
+    """
+    Stores (title, content) entries and commits. Content already in the archive is
+    found by its hash with one indexed lookup: that item is returned instead of a
+    new row, and the new tags are added to it. Returns (new_items, existing_items).
+    """
+    by_hash = {}
+    for title, content in entries:
+        by_hash.setdefault(archive_content_hash(content), (title, content))
+    existing = {
+        item.content_hash: item
+        for item in session.query(ArchiveItem).filter(ArchiveItem.content_hash.in_(list(by_hash)))
+    }
+
+    # Tags are resolved once and shared; add_all() flushes as one multi-row INSERT
+    tag_list = get_or_create_tags(session, parse_tags(tags))
+    new_items = [
+        ArchiveItem(
+            title=title, content=content, tags=tags, user_id=str(user_id), tag_list=list(tag_list),
+            metadata_status=None if is_memorize else 'pending', content_hash=content_hash
+        )
+        for content_hash, (title, content) in by_hash.items() if content_hash not in existing
+    ]
+    for item in existing.values():
+        added_tags = [tag for tag in tag_list if tag not in item.tag_list]
+        if added_tags:
+            item.tag_list = item.tag_list + added_tags
+            item.tags = ','.join(tag.name for tag in item.tag_list)
+    session.add_all(new_items)
+    stats_engine.record(session, 'archive_items', user_id, amount=len(new_items))
+    session.commit()
+    return new_items, list(existing.values())
+
+
 def archive_item(update: Update, context):
     """Handles /archive for links and /memorize for important texts."""
     user_id = update.effective_user.id
@@ -375,8 +3618,9 @@ def archive_item(update: Update, context):
         
         title = f"پیام مهم از {original_user_name} (@{original_user.username or original_user.first_name})"
         content = original_message
-        tags = "حافظه_بلند_مدت, پیام_مهم"
+        tags = f"{MEMORIZE_TAG}, پیام_مهم"
         confirmation_msg = "🧠 پیام با موفقیت در حافظه بلندمدت ربات ثبت شد."
+        entries = [(title, content)]
         
     else:
         # ARCHIVE LOGIC (for links)
@@ -387,32 +3631,57 @@ def archive_item(update: Update, context):
             )
             return
 
-        # Simple parsing for link and tags
+        # Simple parsing for links and tags; every link in the message shares the tags
         input_text = ' '.join(context.args)
         parts = input_text.split()
         
-        link = next((p for p in parts if is_valid_url(p)), None)
+        links = list(dict.fromkeys(p for p in parts if is_valid_url(p)))
         tags = ','.join(p[1:] for p in parts if p.startswith('#'))
+
+        if len(links) > BULK_MAX_ITEMS:
+            update.message.reply_text(
+                f"❌ {user_name} جان، {len(links)} لینک فرستادی ولی هر بار حداکثر {BULK_MAX_ITEMS} لینک آرشیو می‌کنم. "
+                "لطفاً در چند پیام بفرست."
+            )
+            return
         
-        if not link:
+        if not links:
             update.message.reply_text(f"لینک معتبری پیدا نکردم {user_name} جان. مطمئن شو با `http` یا `https` شروع می‌شه.")
             return
 
-        title = link # Use link as title if not provided
-        content = link
-        confirmation_msg = f"🔗 لینک **{link}** با موفقیت در آرشیو ذخیره شد."
-
+        # Use link as title if not provided
+        entries = [(link, link) for link in links]
 
-    session = Session()
+    session = get_db_session()
     try:
-        new_archive = ArchiveItem(
-            title=title,
-            content=content,
-            tags=tags,
-            user_id=str(user_id)
-        )
-        session.add(new_archive)
-        session.commit()
+        try:
+            new_items, existing_items = _save_archive_entries(session, entries, tags, user_id, is_memorize)
+        except IntegrityError:
+            # The same content was saved concurrently; the retry finds it as a duplicate
+            session.rollback()
+            new_items, existing_items = _save_archive_entries(session, entries, tags, user_id, is_memorize)
+        if LINK_METADATA_ENABLED and not is_memorize:
+            # Titles/descriptions are fetched in the background; leftovers are picked up by /enrich-links
+            for item in new_items:
+                link_metadata_fetcher.submit(item.id, item.content)
+        if new_items and get_related_index():
+            # New items reach /related through the background refresh (or the maintenance route)
+            get_related_index().schedule_refresh(RELATED_REFRESH_MAX_ROWS)
+
+        if is_memorize:
+            if existing_items:
+                confirmation_msg = f"🧠 این پیام قبلاً با شماره `#{existing_items[0].id}` در حافظه ثبت شده بود."
+        elif len(new_items) == 1 and not existing_items:
+            confirmation_msg = f"🔗 لینک **{new_items[0].content}** با موفقیت در آرشیو ذخیره شد."
+        else:
+            lines = []
+            if new_items:
+                lines.append(f"🔗 {len(new_items)} لینک با موفقیت در آرشیو ذخیره شد:")
+                lines += [f"• {item.content}" for item in new_items]
+            if existing_items:
+                lines.append("♻️ این لینک‌ها قبلاً آرشیو شده بودند:")
+                lines += [f"• `#{item.id}` {item.content}" for item in existing_items]
+            confirmation_msg = '\n'.join(lines)
         update.message.reply_text(confirmation_msg + f"\nتگ‌ها: {tags}")
         
     except SQLAlchemyError:
@@ -421,9 +3690,6 @@ def archive_item(update: Update, context):
     finally:
         session.close()
 
-# Alias the /memorize command to the archive_item handler
-memorize_command = CommandHandler("memorize", archive_item)
-
 
 def search_archive(update: Update, context):
     """Handles the /search command for finding items in the archive."""
@@ -435,28 +3701,39 @@ def search_archive(update: Update, context):
         return
 
     query_text = ' '.join(context.args).lower()
-    session = Session()
+    # '#tag' arguments become an indexed tag intersection, the rest is full-text
+    tag_args = [arg for arg in context.args if arg.startswith('#')]
+    word_args = ' '.join(arg for arg in context.args if not arg.startswith('#'))
+    session = get_db_session()
     try:
-        # Search by title, content (link/text), or tags
-        results = session.query(ArchiveItem).filter(
-            (ArchiveItem.title.ilike(f'%{query_text}%')) |
-            (ArchiveItem.content.ilike(f'%{query_text}%')) |
-            (ArchiveItem.tags.ilike(f'%{query_text}%'))
-        ).order_by(ArchiveItem.archived_at.desc()).limit(10).all()
+        # Full-text search over title, content (link/text) and tags
+        results = find_archive_items(session, word_args, tags=tag_args, limit=10)
+        # Items worded differently from the query, found by the local vector index
+        similar = find_related_items(session, word_args, limit=3, exclude_ids=[item.id for item in results]) if word_args else []
 
-        if not results:
+        if not results and not similar:
             update.message.reply_text(f"متأسفانه {user_name} جان، چیزی با عبارت **'{query_text}'** در حافظه پیدا نشد. 🧐")
             return
 
-        result_list = f"🔍 نتایج جستجو برای '{query_text}' (جدیدترین‌ها):\n\n"
+        if results:
+            result_list = f"🔍 نتایج جستجو برای '{query_text}' (مرتبط‌ترین‌ها):\n\n"
+        else:
+            result_list = f"🔍 دقیقاً **'{query_text}'** پیدا نشد {user_name} جان.\n"
         for i, item in enumerate(results):
             content_preview = item.content[:50] + '...' if len(item.content) > 50 else item.content
+            description = f"توضیح: {item.description[:120]}\n" if item.description else ""
             result_list += (
                 f"**#{item.id}** - **{item.title}**\n"
                 f"محتوا: {content_preview}\n"
+                f"{description}"
                 f"تگ‌ها: {item.tags or 'ندارد'}\n"
                 "----------------------------------\n"
             )
+        if similar:
+            result_list += "\n🧭 **موارد مشابه:**\n"
+            for item, score in similar:
+                content_preview = item.content[:50] + '...' if len(item.content) > 50 else item.content
+                result_list += f"**#{item.id}** - {item.title} ({score:.0%})\n{content_preview}\n"
 
         update.message.reply_text(result_list)
 
@@ -466,6 +3743,80 @@ def search_archive(update: Update, context):
         session.close()
 
 
+def related_items(update: Update, context):
+    """Handles /related <text> (or a reply): archive items with similar wording, even without shared keywords."""
+    user_id = update.effective_user.id
+    user_name = get_user_name(user_id)
+
+    query_text = ' '.join(context.args or [])
+    replied = update.message.reply_to_message
+    if not query_text and replied:
+        query_text = replied.text or replied.caption or ''
+    if not query_text.strip():
+        update.message.reply_text(f"{user_name} جان، یه متن بنویس یا روی یه پیام ریپلای کن: `/related <متن>`")
+        return
+    index = get_related_index()
+    if index is None:
+        update.message.reply_text("❌ جستجوی موارد مشابه روی این سرور فعال نیست.")
+        return
+    if not index.ready():
+        index.schedule_refresh(RELATED_REFRESH_MAX_ROWS)
+        update.message.reply_text(f"⏳ {user_name} جان، فهرست موارد مشابه هنوز در حال ساخته شدنه. چند دقیقه دیگه دوباره امتحان کن.")
+        return
+
+    session = get_db_session()
+    try:
+        results = find_related_items(session, query_text, limit=5)
+        if not results:
+            update.message.reply_text(f"{user_name} جان، چیز مشابهی در آرشیو و حافظه پیدا نکردم. 🧐")
+            return
+
+        preview = query_text[:40] + '...' if len(query_text) > 40 else query_text
+        result_list = f"🧭 موارد مشابه '{preview}':\n\n"
+        for item, score in results:
+            content_preview = item.content[:80] + '...' if len(item.content) > 80 else item.content
+            result_list += (
+                f"**#{item.id}** - **{item.title}** ({score:.0%})\n"
+                f"محتوا: {content_preview}\n"
+                "----------------------------------\n"
+            )
+        update.message.reply_text(result_list)
+
+    except SQLAlchemyError:
+        update.message.reply_text("❌ خطای دیتابیس در جستجوی موارد مشابه.")
+    finally:
+        session.close()
+
+
+def list_tags(update: Update, context):
+    """Handles the /tags command: all archive tags with their item counts."""
+    user_id = update.effective_user.id
+    user_name = get_user_name(user_id)
+    session = get_db_session()
+    try:
+        # One aggregate query over the tag link table
+        item_count = func.count(archive_tags.c.archive_id)
+        tag_counts = session.query(Tag.name, item_count).join(
+            archive_tags, archive_tags.c.tag_id == Tag.id
+        ).group_by(Tag.id, Tag.name).order_by(item_count.desc(), Tag.name).limit(50).all()
+
+        if not tag_counts:
+            update.message.reply_text(f"{user_name} جان، هنوز هیچ تگی در آرشیو ثبت نشده.")
+            return
+
+        tags_list = "🏷 تگ‌های آرشیو (پرکاربردترین‌ها):\n\n"
+        for name, count in tag_counts:
+            tags_list += f"#{name} ({count})\n"
+        tags_list += "\nبرای جستجو با تگ: `/search #تگ1 #تگ2`"
+
+        update.message.reply_text(tags_list)
+
+    except SQLAlchemyError:
+        update.message.reply_text("❌ خطای دیتابیس در دریافت لیست تگ‌ها.")
+    finally:
+        session.close()
+
+
 def log_work(update: Update, context):
     """Handles the /logwork command to archive individual activities."""
     user_id = update.effective_user.id
@@ -475,24 +3826,183 @@ def log_work(update: Update, context):
         update.message.reply_text(f"خب {user_name}، بگو چه کاری انجام دادی تا ثبت کنم. فرمت: `/logwork <شرح کامل کار>`")
         return
 
-    description = ' '.join(context.args)
-    session = Session()
+    description = ' '.join(context.args)
+    session = get_db_session()
+    try:
+        new_log = ActivityLog(
+            user_id=str(user_id),
+            description=description
+        )
+        session.add(new_log)
+        stats_engine.record(session, 'activity_logs', user_id)
+        session.commit()
+        update.message.reply_text(
+            f"📝 آفرین {user_name} جان! کارکرد شما با شرح:\n"
+            f"**'{description[:100]}...'**\n"
+            f"با موفقیت در آرشیو فعالیت‌های فردی ثبت شد. دمت گرم! 💪"
+        )
+        
+    except SQLAlchemyError:
+        update.message.reply_text("❌ خطای دیتابیس در ثبت فعالیت.")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def parse_report_args(args):
+    """
+    Parses `/mywork [from] [to] [csv|json] [team]` (dates as YYYY-MM-DD, Persian
+    digits allowed). Returns (start, end, export_format, team) with `end` exclusive,
+    or None for an invalid date. Defaults to the last 30 days.
+    """
+    normalized = [normalize_persian_text(arg) for arg in args]
+    try:
+        dates = [datetime.strptime(arg, '%Y-%m-%d') for arg in normalized if re.fullmatch(r'\d{4}-\d{1,2}-\d{1,2}', arg)]
+    except ValueError:
+        return None
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = dates[0] if dates else today - timedelta(days=29)
+    end = (dates[1] if len(dates) > 1 else today) + timedelta(days=1)
+    export_format = next((arg for arg in normalized if arg in ('csv', 'json')), None)
+    team = any(arg in ('team', 'تیم') for arg in normalized)
+    return start, end, export_format, team
+
+
+def write_activity_export(session, export_format, start, end, user_id=None, batch_size=1000):
+    """
+    Streams activity logs into a spooled temporary file as CSV or JSON and returns
+    (file positioned at 0, row count). Rows are fetched in batches with yield_per
+    (a server-side cursor on Postgres) and written as they arrive, so a large
+    export never holds all rows in memory. Logs already moved to
+    activity_log_archive by retention come first.
+    """
+    import io
+    import csv
+    import tempfile
+    from itertools import chain
+
+    def stream_rows(model):
+        query = session.query(
+            model.id, model.user_id, model.logged_at, model.description
+        ).filter(model.logged_at >= start, model.logged_at < end)
+        if user_id is not None:
+            query = query.filter(model.user_id == str(user_id))
+        return query.order_by(model.logged_at, model.id).yield_per(batch_size)
+
+    rows = chain(*(stream_rows(model) for model in activity_log_models(start)))
+
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES, mode='w+b')
+    stream = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    count = 0
+    if export_format == 'csv':
+        stream.write('\ufeff')  # BOM, so spreadsheet apps read the Persian text as UTF-8
+        writer = csv.writer(stream)
+        writer.writerow(['id', 'user_id', 'name', 'logged_at', 'description'])
+        for row in rows:
+            writer.writerow([row.id, row.user_id, get_user_name(row.user_id), row.logged_at.isoformat(sep=' ', timespec='seconds'), row.description])
+            count += 1
+    else:
+        stream.write('[')
+        for row in rows:
+            record = {
+                'id': row.id, 'user_id': row.user_id, 'name': get_user_name(row.user_id),
+                'logged_at': row.logged_at.isoformat(timespec='seconds'), 'description': row.description,
+            }
+            stream.write((',\n' if count else '\n') + json.dumps(record, ensure_ascii=False))
+            count += 1
+        stream.write('\n]\n')
+    stream.flush()
+    stream.detach()  # Keep `output` open after the wrapper is gone
+    output.seek(0)
+    return output, count
+
+
+def my_work(update: Update, context):
+    """Handles /mywork [from] [to] [csv|json] [team]: a personal activity report or a file export."""
+    user_id = update.effective_user.id
+    user_name = get_user_name(user_id)
+
+    parsed = parse_report_args(context.args or [])
+    if parsed is None:
+        update.message.reply_text(f"{user_name} جان، تاریخ‌ها رو به شکل `YYYY-MM-DD` بنویس. مثلا: `/mywork 2025-01-01 2025-03-31 csv`")
+        return
+    start, end, export_format, team = parsed
+    period = f"{start:%Y-%m-%d} تا {end - timedelta(days=1):%Y-%m-%d}"
+    owner_id = None if team else user_id
+
+    session = get_db_session()
     try:
-        new_log = ActivityLog(
-            user_id=str(user_id),
-            description=description
-        )
-        session.add(new_log)
-        session.commit()
-        update.message.reply_text(
-            f"📝 آفرین {user_name} جان! کارکرد شما با شرح:\n"
-            f"**'{description[:100]}...'**\n"
-            f"با موفقیت در آرشیو فعالیت‌های فردی ثبت شد. دمت گرم! 💪"
-        )
-        
+        if export_format:
+            output, count = write_activity_export(session, export_format, start, end, user_id=owner_id)
+            session.close()  # Release the connection before the upload
+            size = output.seek(0, 2)
+            output.seek(0)
+            if not count:
+                update.message.reply_text(f"{user_name} جان، در بازه {period} هیچ فعالیتی ثبت نشده.")
+            elif size > EXPORT_MAX_BYTES:
+                update.message.reply_text(f"❌ فایل خروجی ({size // (1024 * 1024)} MB) برای تلگرام بزرگ است. بازه کوتاه‌تری انتخاب کن.")
+            else:
+                scope = 'team' if team else str(user_id)
+                update.message.reply_document(
+                    document=output,
+                    filename=f"worklog_{scope}_{start:%Y%m%d}_{end - timedelta(days=1):%Y%m%d}.{export_format}",
+                    caption=f"📎 {count} فعالیت ({period})"
+                )
+            output.close()
+            return
+
+        # Logs moved out by retention still count: each query runs on the archive table too when needed
+        models = activity_log_models(start)
+
+        def filters(model):
+            conditions = [model.logged_at >= start, model.logged_at < end]
+            if owner_id is not None:
+                conditions.append(model.user_id == str(owner_id))
+            return conditions
+
+        if team:
+            totals = {}
+            for model in models:
+                for member_id, count in session.query(model.user_id, func.count(model.id)).filter(
+                    *filters(model)
+                ).group_by(model.user_id):
+                    totals[member_id] = totals.get(member_id, 0) + count
+            per_user = sorted(totals.items(), key=lambda entry: entry[1], reverse=True)
+            if not per_user:
+                update.message.reply_text(f"در بازه {period} هیچ‌کس فعالیتی ثبت نکرده! 😴")
+                return
+            lines = [f"👥 کارکرد تیم ({period}):\n"]
+            lines += [f"• **{get_user_name(member_id)}**: {count} فعالیت" for member_id, count in per_user]
+            update.message.reply_text('\n'.join(lines))
+            return
+
+        # Aggregates and the latest entries come from the (user_id, logged_at) indexes
+        per_day, latest = {}, []
+        for model in models:
+            day = func.date(model.logged_at)
+            for row_day, count in session.query(day, func.count(model.id)).filter(*filters(model)).group_by(day):
+                per_day[row_day] = per_day.get(row_day, 0) + count
+            latest += session.query(model.logged_at, model.description).filter(*filters(model)).order_by(
+                model.logged_at.desc()
+            ).limit(10).all()
+        total = sum(per_day.values())
+        if not total:
+            update.message.reply_text(f"{user_name} جان، در بازه {period} هیچ فعالیتی ثبت نکردی. با `/logwork` شروع کن! 📝")
+            return
+        latest = sorted(latest, key=lambda entry: entry[0], reverse=True)[:10]
+
+        lines = [
+            f"📒 کارکرد {user_name} ({period}):\n",
+            f"• **تعداد فعالیت‌ها:** {total}",
+            f"• **روزهای فعال:** {len(per_day)}",
+            "\n**آخرین فعالیت‌ها:**",
+        ]
+        lines += [f"• {logged_at:%Y-%m-%d} — {description[:80]}" for logged_at, description in latest]
+        lines.append("\nخروجی کامل: `/mywork <از> <تا> csv` یا `json`")
+        update.message.reply_text('\n'.join(lines))
+
     except SQLAlchemyError:
-        update.message.reply_text("❌ خطای دیتابیس در ثبت فعالیت.")
-        session.rollback()
+        update.message.reply_text("❌ خطای دیتابیس در تهیه گزارش کارکرد.")
     finally:
         session.close()
 
@@ -524,26 +4034,32 @@ def countdown_to_hugger(update: Update, context):
 
 
 def translate_command(update: Update, context):
-    """Handles the /translate command for English to Persian translation."""
+    """
+    Handles the /translate command for English to Persian translation.
+    Without arguments it translates the replied-to message, all paragraphs in one batch.
+    """
     user_id = update.effective_user.id
     user_name = get_user_name(user_id)
 
-    if not context.args:
-        update.message.reply_text(f"متن انگلیسی رو بده {user_name} جان. مثل: `/translate This is a great project.`")
+    replied_text = update.message.reply_to_message.text if update.message.reply_to_message else None
+    if not context.args and not replied_text:
+        update.message.reply_text(f"متن انگلیسی رو بده {user_name} جان. مثل: `/translate This is a great project.` (یا روی یه پیام ریپلای کن)")
         return
 
-    text_to_translate = ' '.join(context.args)
+    text_to_translate = ' '.join(context.args) if context.args else replied_text
     
-    # Use googletrans library (unofficial Google Translate API usage)
+    # Shared translator (googletrans by default) with LRU + database cache
     try:
-        translator = Translator()
-        # Translate from auto-detected source (usually English) to Persian ('fa')
-        translation = translator.translate(text_to_translate, dest='fa')
+        # Translate from auto-detected source (usually English) to Persian ('fa'), line by line in one batch
+        lines = text_to_translate.split('\n')
+        non_empty = [line.strip() for line in lines if line.strip()]
+        translated = iter(translation_service.translate_many(non_empty, dest='fa'))
+        translation_text = '\n'.join(next(translated) if line.strip() else '' for line in lines)
         
         message = (
             f"🌍 ترجمه سریع برای {user_name}:\n"
             f"**متن انگلیسی:** {text_to_translate}\n"
-            f"**ترجمه فارسی:** {translation.text}"
+            f"**ترجمه فارسی:** {translation_text}"
         )
         update.message.reply_text(message)
         
@@ -551,6 +4067,66 @@ def translate_command(update: Update, context):
         update.message.reply_text(f"❌ مشکل در اتصال به مترجم. اینم دلیلش: {e}")
 
 
+class ProgressiveReply:
+    """
+    Reply that grows while an AI answer streams in. The placeholder is sent on the
+    first update() and then edited, at most once per edit interval; finish() writes
+    the final text (or sends a normal reply if no placeholder was needed).
+    """
+
+    PLACEHOLDER = "⏳ در حال خلاصه‌سازی..."
+
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self.shown_text = None
+        self.last_edit_at = 0.0
+        is_group = message.chat_id < 0
+        self.interval = max(SUMMARY_STREAM_EDIT_INTERVAL, 60.0 / OUTBOUND_GROUP_RATE_PER_MINUTE if is_group else 0)
+        # update() may be called from summary worker threads; they inherit the request's no-wait sending
+        self.no_wait = not outbound_sender.waiting_allowed()
+        self._lock = threading.Lock()
+
+    def _sending(self):
+        return outbound_sender.no_wait() if self.no_wait else nullcontext()
+
+    def update(self, text_value):
+        with self._lock, self._sending():
+            if self.sent is None:
+                webhook_reply.disarm()  # The edits need the placeholder's message_id
+                sent = self.message.reply_text(self.PLACEHOLDER)
+                # A deferred placeholder has no message_id yet: skip progress edits, finish() replies normally
+                self.sent = sent if isinstance(sent, Message) else False
+                self.shown_text = self.PLACEHOLDER
+                self.last_edit_at = time.monotonic()
+                return
+            if not self.sent or not text_value or time.monotonic() - self.last_edit_at < self.interval:
+                return
+            self._edit(text_value + " ▌")
+
+    def finish(self, text_value):
+        with self._lock, self._sending():
+            if not self.sent:
+                self.message.reply_text(text_value)
+                return
+            chunks = split_message(text_value)
+            self._edit(chunks[0])
+            for chunk in chunks[1:]:
+                self.message.reply_text(chunk)
+
+    def _edit(self, text_value):
+        text_value = split_message(text_value)[0]
+        if text_value == self.shown_text:
+            return
+        try:
+            self.sent.edit_text(text_value)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+        self.shown_text = text_value
+        self.last_edit_at = time.monotonic()
+
+
 def weekly_summary(update: Update, context):
     """
     Handles /summary. It checks for a reply with #خلاصه_کن for AI summarization,
@@ -560,36 +4136,68 @@ def weekly_summary(update: Update, context):
     user_name = get_user_name(user_id)
     
     # AI SUMMARIZATION LOGIC (If reply and #خلاصه_کن is present)
-    if update.message.reply_to_message and ('#خلاصه_کن' in update.message.text or '#خلاصه_کن' in update.message.caption or 'خلاصه_کن' in context.args):
+    if update.message.reply_to_message and ('#خلاصه_کن' in update.message.text or '#خلاصه_کن' in (update.message.caption or '') or 'خلاصه_کن' in context.args):
         text_to_summarize = update.message.reply_to_message.text
         if not text_to_summarize:
             update.message.reply_text(f"{user_name} جان، برای خلاصه‌سازی هوشمند باید روی یک پیام متنی ریپلای کنی.")
             return
             
-        # Call the external AI API
-        summary_result = _call_external_ai_api_for_summary(text_to_summarize)
-        update.message.reply_text(summary_result)
+        # Call the external AI API (#بدون_کش forces a fresh summary instead of the cached one)
+        use_cache = '#بدون_کش' not in update.message.text
+        reply = ProgressiveReply(update.message)
+        summary_result = _call_external_ai_api_for_summary(text_to_summarize, use_cache=use_cache, on_progress=reply.update)
+        reply.finish(summary_result)
         return
 
     # STATISTICAL SUMMARY LOGIC (Default behavior)
-    session = Session()
+    session = get_db_session()
     try:
-        one_week_ago = datetime.utcnow() - timedelta(days=7)
-        
-        # 1. New Tasks in the last 7 days
-        new_tasks = session.query(Task).filter(Task.created_at >= one_week_ago).count()
-        
-        # 2. Done Tasks in the last 7 days
-        done_tasks = session.query(Task).filter(Task.status == 'Done', Task.created_at >= one_week_ago).count()
+        # DIGEST OF THE LAST N /memorize ITEMS (/summary digest [N])
+        if context.args and context.args[0].lower() in ('digest', 'حافظه'):
+            limit = DIGEST_DEFAULT_ITEMS
+            if len(context.args) > 1 and context.args[1].isdigit():
+                limit = max(1, min(int(context.args[1]), DIGEST_MAX_ITEMS))
+            item_count, digest_text = build_memorize_digest_text(session, limit)
+            session.close()  # Release the connection before the (slow) AI calls
+            if not item_count:
+                update.message.reply_text(f"{user_name} جان، هنوز هیچ پیامی با `/memorize` ذخیره نشده.")
+                return
+            use_cache = '#بدون_کش' not in update.message.text
+            reply = ProgressiveReply(update.message)
+            reply.finish(_call_external_ai_api_for_summary(
+                digest_text, use_cache=use_cache, prompt=SUMMARY_DIGEST_PROMPT,
+                title=f"🗂 جمع‌بندی {item_count} پیام مهم آخر:", on_progress=reply.update
+            ))
+            return
 
-        # 3. Remaining active tasks
-        remaining_tasks = session.query(Task).filter(Task.status.in_(['To Do', 'In Progress'])).count()
-        
-        # 4. New Archive Items in the last 7 days
-        new_archives = session.query(ArchiveItem).filter(ArchiveItem.archived_at >= one_week_ago).count()
-        
-        # 5. New Activity Logs in the last 7 days
-        new_logs = session.query(ActivityLog).filter(ActivityLog.logged_at >= one_week_ago).count()
+        # PER-USER BREAKDOWN (/summary team)
+        if context.args and context.args[0].lower() in ('team', 'تیم'):
+            breakdown = stats_engine.per_user_counts(session, days=7)
+            if not breakdown:
+                update.message.reply_text(f"{user_name} جان، این هفته هیچ‌کس هیچ کاری ثبت نکرده! 😴")
+                return
+
+            metric_labels = [
+                ('tasks_created', 'تسک جدید'),
+                ('tasks_done', 'تسک انجام‌شده'),
+                ('archive_items', 'آرشیو'),
+                ('activity_logs', 'فعالیت'),
+            ]
+            message = "👥 گزارش هفتگی به تفکیک اعضا:\n\n"
+            ranked = sorted(breakdown.items(), key=lambda entry: -sum(entry[1].values()))
+            for member_id, counts in ranked:
+                details = '، '.join(f"{label}: {counts[metric]}" for metric, label in metric_labels if counts.get(metric))
+                message += f"• **{get_user_name(member_id)}** — {details}\n"
+            update.message.reply_text(message)
+            return
+
+        # 1-5. All weekly counters in a single round trip (or from daily rollups)
+        counts = stats_engine.weekly_counts(session, days=7)
+        new_tasks = counts['new_tasks']
+        done_tasks = counts['done_tasks']
+        remaining_tasks = counts['remaining_tasks']
+        new_archives = counts['new_archives']
+        new_logs = counts['new_logs']
         
         # 6. Weekly Report Formatting with Taunting/Motivational Tone
         
@@ -639,42 +4247,79 @@ def buy_command(update: Update, context):
     if not context.args:
         update.message.reply_text(
             f"لطفاً یکی از دستورهای خرید را وارد کنید:\n"
-            f"• `/buy add <آیتم>`\n"
-            f"• `/buy done <شماره آیتم>`\n"
+            f"• `/buy add <آیتم>` (چند آیتم: `/buy add شیر، تخم‌مرغ، نان`)\n"
+            f"• `/buy done <شماره آیتم>` (چند آیتم: `/buy done 3 5 9` یا `/buy done 3-6`)\n"
             f"• `/buy list`"
         )
         return
 
     sub_command = context.args[0].lower()
     
-    session = Session()
+    session = get_db_session()
     try:
         if sub_command == 'add':
             if len(context.args) < 2:
                 update.message.reply_text(f"چی رو باید بخریم {user_name}؟")
                 return
-            item_name = ' '.join(context.args[1:])
-            new_item = ShoppingItem(item_name=item_name)
-            session.add(new_item)
+            item_names = parse_item_list(' '.join(context.args[1:]))
+            if item_names is None:
+                update.message.reply_text(f"❌ {user_name} جان، هر بار حداکثر {BULK_MAX_ITEMS} آیتم می‌تونی اضافه کنی. لیست رو چند قسمت کن.")
+                return
+            if not item_names:
+                update.message.reply_text(f"چی رو باید بخریم {user_name}؟")
+                return
+            new_items = insert_returning(
+                session, ShoppingItem, [{'item_name': item_name} for item_name in item_names],
+                columns=(ShoppingItem.id, ShoppingItem.item_name)
+            )
             session.commit()
-            update.message.reply_text(f"🛒 **'{item_name}'** به لیست خرید اضافه شد. ممنون {user_name}!")
+            if len(item_names) == 1:
+                update.message.reply_text(f"🛒 **'{item_names[0]}'** به لیست خرید اضافه شد. ممنون {user_name}!")
+            else:
+                listed = [f"**#{row.id}** - {row.item_name}" for row in new_items] or item_names
+                update.message.reply_text(
+                    f"🛒 {len(item_names)} آیتم به لیست خرید اضافه شد. ممنون {user_name}!\n" + '\n'.join(listed)
+                )
             
         elif sub_command == 'done':
-            if len(context.args) < 2 or not context.args[1].isdigit():
-                update.message.reply_text(f"شماره آیتم رو برای `/buy done` وارد کن.")
+            item_ids = parse_id_list(context.args[1:])
+            if not item_ids:
+                update.message.reply_text(f"شماره آیتم رو برای `/buy done` وارد کن (حداکثر {BULK_MAX_ITEMS} آیتم).")
                 return
-            item_id = int(context.args[1])
-            item = session.query(ShoppingItem).filter(ShoppingItem.id == item_id).first()
-            
-            if item and not item.is_bought:
-                item.is_bought = True
-                item.bought_at = datetime.utcnow()
-                session.commit()
-                update.message.reply_text(f"✅ **'{item.item_name}'** خریداری شد. {user_name}، دمت گرم!")
-            elif item and item.is_bought:
-                update.message.reply_text(f"این آیتم ({item.item_name}) قبلاً خریداری شده بود!")
-            else:
-                update.message.reply_text(f"آیتمی با شماره `{item_id}` در لیست خرید پیدا نشد.")
+            # One UPDATE ... RETURNING; items that were already bought are left untouched
+            bought = update_returning(
+                session, ShoppingItem, item_ids,
+                {ShoppingItem.is_bought: True, ShoppingItem.bought_at: datetime.utcnow()},
+                ShoppingItem.is_bought == False, columns=(ShoppingItem.id, ShoppingItem.item_name)
+            )
+            session.commit()
+
+            skipped = sorted(set(item_ids) - {row.id for row in bought})
+            already_bought = {}
+            if skipped:
+                already_bought = dict(
+                    session.query(ShoppingItem.id, ShoppingItem.item_name).filter(ShoppingItem.id.in_(skipped)).all()
+                )
+            missing = [item_id for item_id in skipped if item_id not in already_bought]
+
+            if len(item_ids) == 1:
+                if bought:
+                    update.message.reply_text(f"✅ **'{bought[0].item_name}'** خریداری شد. {user_name}، دمت گرم!")
+                elif already_bought:
+                    update.message.reply_text(f"این آیتم ({already_bought[item_ids[0]]}) قبلاً خریداری شده بود!")
+                else:
+                    update.message.reply_text(f"آیتمی با شماره `{item_ids[0]}` در لیست خرید پیدا نشد.")
+                return
+
+            lines = []
+            if bought:
+                lines.append(f"✅ {len(bought)} آیتم خریداری شد. {user_name}، دمت گرم!")
+                lines += [f"• {row.item_name}" for row in sorted(bought, key=lambda row: row.id)]
+            if already_bought:
+                lines.append("☑️ قبلاً خریداری شده: " + '، '.join(already_bought[item_id] for item_id in sorted(already_bought)))
+            if missing:
+                lines.append("❌ پیدا نشد: " + '، '.join(f"`#{item_id}`" for item_id in missing))
+            update.message.reply_text('\n'.join(lines))
 
         elif sub_command == 'list':
             required_items = session.query(ShoppingItem).filter(ShoppingItem.is_bought == False).order_by(ShoppingItem.created_at).all()
@@ -710,62 +4355,925 @@ def buy_command(update: Update, context):
 
 
 # -------------------------------------------------------------------------
-# 6. FLASK & BOT SETUP
+# 6. BACKGROUND UPDATE WORKERS
+# -------------------------------------------------------------------------
+
+class UpdateWorkerPool:
+    """
+    Bounded background pool for Telegram updates.
+
+    Every chat is pinned to a single worker (chat_id modulo number of workers),
+    so updates from the same chat are processed strictly in arrival order while
+    different chats are handled in parallel.
+    """
+
+    _STOP = object()
+
+    def __init__(self, process_func, workers=4, queue_size=100):
+        self._process = process_func
+        self._workers = max(1, workers)
+        per_worker = max(1, -(-queue_size // self._workers))  # ceil division
+        self._queues = [queue.Queue(maxsize=per_worker) for _ in range(self._workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._accepting = True
+        self._stats = {
+            'enqueued': 0,
+            'processed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'max_depth': 0,
+            'wait_seconds_total': 0.0,
+            'process_seconds_total': 0.0,
+        }
+
+        for index, worker_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run,
+                args=(worker_queue,),
+                name=f"update-worker-{index}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def _ordering_key(update):
+        """Returns the key used to keep updates of one chat in order."""
+        chat = update.effective_chat
+        return chat.id if chat else update.update_id
+
+    def submit(self, update):
+        """Queues an update without blocking. Returns False when the pool is full or stopped."""
+        if not self._accepting:
+            with self._lock:
+                self._stats['rejected'] += 1
+            return False
+
+        worker_queue = self._queues[hash(self._ordering_key(update)) % self._workers]
+        try:
+            worker_queue.put_nowait((update, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            return False
+
+        with self._lock:
+            self._stats['enqueued'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], self.depth())
+        return True
+
+    def _run(self, worker_queue):
+        """Worker loop: processes queued updates until the stop marker arrives."""
+        while True:
+            item = worker_queue.get()
+            if item is self._STOP:
+                worker_queue.task_done()
+                break
+
+            update, enqueued_at = item
+            started_at = time.monotonic()
+            failed = False
+            try:
+                self._process(update)
+            except Exception as e:
+                failed = True
+                print(f"ERROR: Update {update.update_id} failed in background worker: {e}")
+            finally:
+                finished_at = time.monotonic()
+                with self._lock:
+                    self._stats['failed' if failed else 'processed'] += 1
+                    self._stats['wait_seconds_total'] += started_at - enqueued_at
+                    self._stats['process_seconds_total'] += finished_at - started_at
+                worker_queue.task_done()
+
+    def depth(self):
+        """Number of updates currently waiting in all worker queues."""
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def stats(self):
+        """Returns a snapshot of the backpressure and throughput counters."""
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot['workers'] = self._workers
+        snapshot['capacity'] = sum(worker_queue.maxsize for worker_queue in self._queues)
+        snapshot['depth'] = self.depth()
+        snapshot['depth_per_worker'] = [worker_queue.qsize() for worker_queue in self._queues]
+        snapshot['accepting'] = self._accepting
+        return snapshot
+
+    def shutdown(self, timeout=UPDATE_DRAIN_TIMEOUT):
+        """Stops accepting updates and waits (up to timeout seconds) for queued ones to finish."""
+        if not self._accepting:
+            return
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+
+        for worker_queue in self._queues:
+            try:
+                worker_queue.put(self._STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+        pending = self.depth()
+        if pending:
+            print(f"WARNING: Update worker pool stopped with {pending} unprocessed updates.")
+
+
+class UpdateLedger:
+    """
+    Exactly-once claims of Telegram updates across threads, processes and instances.
+
+    claim() inserts the update_id into processed_updates; the primary key lets
+    only one worker succeed. A claim is a lease: if its worker dies before
+    the update is marked done, another worker may take the update over once
+    the lease expired. Marking done rides on the handler's first commit of
+    the request-scoped session (see begin()), so a handler that writes pays no
+    extra transaction for it and its writes and the done mark land together.
+    Standalone sessions (user profiles, caches) never mark it. An update whose
+    handler failed before committing is released, so a redelivery runs it again.
+    Old rows are pruned in small batches every `prune_every` claims, so the
+    ledger stays around (updates per retention window) rows.
+    """
+
+    PRUNE_BATCH = 1000
+
+    def __init__(self, lease_seconds=120, retention_hours=48, prune_every=500):
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retention = timedelta(hours=retention_hours)
+        self.prune_every = prune_every
+        self._claims = 0
+        self._local = threading.local()  # pending: update_id this thread still has to mark as done
+        self._lock = threading.Lock()
+        event.listen(_session_factory, 'before_commit', self._mark_done_in_commit)
+        event.listen(_session_factory, 'after_commit', self._committed)
+
+    def claim(self, update_id):
+        """
+        Returns 'claimed', 'reclaimed' (lease expired) or 'unguarded' (database
+        unreachable, fails open) when this worker owns the update now; 'done'
+        for an update that was already processed, or 'in_progress' while another
+        worker holds a live lease on it.
+        """
+        table = ProcessedUpdate.__table__
+        now = datetime.utcnow()
+        try:
+            with get_engine().begin() as connection:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(table.insert().values(
+                            update_id=update_id, status='processing', lease_until=now + self.lease, claimed_at=now
+                        ))
+                    outcome = 'claimed'
+                except IntegrityError:
+                    # Already claimed: take over only if the previous worker's lease ran out
+                    taken_over = connection.execute(table.update().where(
+                        table.c.update_id == update_id,
+                        table.c.status == 'processing',
+                        table.c.lease_until < now
+                    ).values(lease_until=now + self.lease, claimed_at=now)).rowcount
+                    if taken_over:
+                        outcome = 'reclaimed'
+                    else:
+                        status = connection.execute(
+                            select(table.c.status).where(table.c.update_id == update_id)
+                        ).scalar()
+                        outcome = 'in_progress' if status == 'processing' else 'done'
+        except SQLAlchemyError as e:
+            print(f"WARNING: Update ledger unavailable, processing update {update_id} unguarded: {e}")
+            UPDATE_LEDGER.inc(outcome='unguarded')
+            return 'unguarded'
+
+        UPDATE_LEDGER.inc(outcome=outcome)
+        if outcome in ('claimed', 'reclaimed'):
+            self._maybe_prune()
+        return outcome
+
+    def begin(self, update_id):
+        """Marks `update_id` as done in the next commit made on this thread."""
+        self._local.pending = update_id
+
+    def finish(self, update_id):
+        """Marks the update as done unless one of its handler's commits already did."""
+        if getattr(self._local, 'pending', None) == update_id:
+            self._local.pending = None
+            self.complete(update_id)
+
+    def abandon(self, update_id):
+        """After a failed handler: drops the claim unless a handler commit already marked the update done."""
+        self._local.pending = None
+        self.release(update_id)
+
+    def _mark_done_in_commit(self, session):
+        update_id = getattr(self._local, 'pending', None)
+        if update_id is None or not session.info.get('request_scoped'):
+            return
+        table = ProcessedUpdate.__table__
+        session.execute(table.update().where(table.c.update_id == update_id).values(status='done'))
+        self._local.committing = update_id
+
+    def _committed(self, session):
+        # Only now is the mark durable; after a rollback finish() still writes it
+        if getattr(self._local, 'committing', None) is not None:
+            if getattr(self._local, 'pending', None) == self._local.committing:
+                self._local.pending = None
+            self._local.committing = None
+
+    def complete(self, update_id):
+        """Marks the update as processed; redeliveries are ignored from now on."""
+        table = ProcessedUpdate.__table__
+        try:
+            with get_engine().begin() as connection:
+                connection.execute(table.update().where(table.c.update_id == update_id).values(status='done'))
+        except SQLAlchemyError as e:
+            print(f"WARNING: Could not mark update {update_id} as done: {e}")
+
+    def release(self, update_id):
+        """Drops a claim that was not processed (e.g. rejected by a full queue) so a redelivery can claim it."""
+        table = ProcessedUpdate.__table__
+        try:
+            with get_engine().begin() as connection:
+                connection.execute(table.delete().where(
+                    table.c.update_id == update_id, table.c.status == 'processing'
+                ))
+        except SQLAlchemyError as e:
+            print(f"WARNING: Could not release update {update_id}: {e}")
+
+    def _maybe_prune(self):
+        with self._lock:
+            self._claims += 1
+            if self.prune_every <= 0 or self._claims % self.prune_every:
+                return
+        self.prune()
+
+    def prune(self):
+        """Deletes up to PRUNE_BATCH entries older than the retention window (index range scan on claimed_at)."""
+        table = ProcessedUpdate.__table__
+        cutoff = datetime.utcnow() - self.retention
+        try:
+            with get_engine().begin() as connection:
+                oldest = select(table.c.update_id).where(
+                    table.c.claimed_at < cutoff
+                ).order_by(table.c.claimed_at).limit(self.PRUNE_BATCH)
+                pruned = connection.execute(table.delete().where(table.c.update_id.in_(oldest.scalar_subquery()))).rowcount
+        except SQLAlchemyError as e:
+            print(f"WARNING: Could not prune the update ledger: {e}")
+            return 0
+        UPDATE_LEDGER.inc(pruned, outcome='pruned')
+        return pruned
+
+
+class RetentionJob:
+    """
+    Keeps the hot tables small: done tasks, bought shopping items and activity
+    logs older than `retention_days` are counted into monthly_rollups, copied to
+    their *_archive table and deleted. Each batch is one transaction, so a row
+    is either fully moved or untouched, and a run stops after `max_batches`
+    batches; call it again (cron) until it reports complete.
+    """
+
+    def __init__(self, retention_days=180, batch_size=1000, max_batches=20):
+        self.retention = timedelta(days=retention_days)
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def policies():
+        """(name, hot table, archive table, age expression, extra conditions, rollup metric, user column)"""
+        tasks, logs, shopping = Task.__table__, ActivityLog.__table__, ShoppingItem.__table__
+        # Rows finished before completed_at/bought_at existed have NULL there; their creation time stands in
+        return [
+            ('activity_log', logs, ActivityLogArchive.__table__, logs.c.logged_at, (), 'activity_logs', logs.c.user_id),
+            ('tasks', tasks, TaskArchive.__table__, func.coalesce(tasks.c.completed_at, tasks.c.created_at),
+             (tasks.c.status == 'Done',), 'tasks_done', tasks.c.assigned_to),
+            ('shopping_list', shopping, ShoppingItemArchive.__table__, func.coalesce(shopping.c.bought_at, shopping.c.created_at),
+             (shopping.c.is_bought == True,), 'items_bought', None),
+        ]
+
+    def run(self, bind, max_batches=None):
+        """Moves up to `max_batches` batches; returns per-table counts and whether anything is left."""
+        if not self._lock.acquire(blocking=False):
+            return {'status': 'busy'}
+        try:
+            cutoff = datetime.utcnow() - self.retention
+            budget = self.max_batches if max_batches is None else max_batches
+            moved, complete = {}, True
+            for name, *policy in self.policies():
+                moved[name] = 0
+                while True:
+                    if budget <= 0:
+                        complete = False
+                        break
+                    budget -= 1
+                    count = self._move_batch(bind, cutoff, *policy)
+                    moved[name] += count
+                    if count < self.batch_size:
+                        break
+            return {'status': 'ok', 'cutoff': cutoff.isoformat(timespec='seconds'), 'moved': moved, 'complete': complete}
+        finally:
+            self._lock.release()
+
+    def _move_batch(self, bind, cutoff, hot, archive, age, conditions, metric, user_column):
+        with bind.begin() as connection:
+            rows = connection.execute(
+                select(hot, age.label('retention_age')).where(age < cutoff, *conditions).order_by(hot.c.id).limit(self.batch_size)
+            ).all()
+            if not rows:
+                return 0
+
+            counts = {}
+            for row in rows:
+                moment = row.retention_age
+                if isinstance(moment, str):
+                    moment = datetime.fromisoformat(moment)  # SQLite returns coalesce() of datetimes as text
+                user_id = row._mapping[user_column.name] if user_column is not None else None
+                key = (moment.date().replace(day=1), str(user_id or ''))
+                counts[key] = counts.get(key, 0) + 1
+            self._add_to_rollups(connection, metric, counts)
+
+            connection.execute(archive.insert(), [
+                {column.name: row._mapping[column.name] for column in hot.columns} for row in rows
+            ])
+            connection.execute(hot.delete().where(hot.c.id.in_([row.id for row in rows])))
+        return len(rows)
+
+    @staticmethod
+    def _add_to_rollups(connection, metric, counts):
+        rollups = MonthlyRollup.__table__
+        for (month, user_id), count in counts.items():
+            key = (rollups.c.month == month, rollups.c.user_id == user_id, rollups.c.metric == metric)
+            updated = connection.execute(rollups.update().where(*key).values(count=rollups.c.count + count)).rowcount
+            if not updated:
+                connection.execute(rollups.insert().values(month=month, user_id=user_id, metric=metric, count=count))
+
+
+class ReminderScheduler:
+    """
+    Due-date reminders for active tasks.
+
+    Every reminder has a fire time: due_date - lead ('upcoming') or due_date
+    ('overdue'). run_window() claims the window (last run, now] in
+    scheduler_state with a compare-and-set, so concurrent callers and instances
+    never send the same window twice, then reads the tasks firing in it with
+    two range scans on the (status, due_date) index and sends one message per
+    chat. In 'thread' mode a background thread keeps the next fire times in a
+    min-heap (refilled every `horizon` from the same index, extended by
+    schedule() for new tasks) and sleeps until the earliest one.
+    """
+
+    NAME = 'reminders'
+
+    def __init__(self, lead_hours=24, catchup_hours=24, horizon_hours=6):
+        self.lead = timedelta(hours=lead_hours)
+        self.catchup = timedelta(hours=catchup_hours)
+        self.horizon = timedelta(hours=horizon_hours)
+        self._heap = []
+        self._horizon_end = None
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def _fire_times(self, due_date):
+        return [due_date - self.lead, due_date] if self.lead else [due_date]
+
+    def _claim_window(self, connection, now):
+        """Moves last_run_at to `now`; returns the window start, or None if another caller got there first."""
+        table = SchedulerState.__table__
+        last_run = connection.execute(select(table.c.last_run_at).where(table.c.name == self.NAME)).scalar()
+        if last_run is None:
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert().values(name=self.NAME, last_run_at=now))
+            except IntegrityError:
+                return None
+            return now - self.catchup
+        if last_run >= now:
+            return None
+        claimed = connection.execute(table.update().where(
+            table.c.name == self.NAME, table.c.last_run_at == last_run
+        ).values(last_run_at=now)).rowcount
+        return max(last_run, now - self.catchup) if claimed else None
+
+    def due_reminders(self, connection, start, end):
+        """Returns [(kind, task row)] for every reminder firing in (start, end]."""
+        tasks = Task.__table__
+        columns = (tasks.c.id, tasks.c.title, tasks.c.assigned_to, tasks.c.due_date, tasks.c.chat_id)
+        active = tasks.c.status.in_(ACTIVE_TASK_STATUSES)
+        windows = [('overdue', start, end)]
+        if self.lead:
+            windows.append(('upcoming', start + self.lead, end + self.lead))
+        reminders = []
+        for kind, window_start, window_end in windows:
+            rows = connection.execute(select(*columns).where(
+                active, tasks.c.due_date > window_start, tasks.c.due_date <= window_end
+            ).order_by(tasks.c.due_date)).all()
+            reminders += [(kind, row) for row in rows]
+        return reminders
+
+    def run_window(self, now=None):
+        """Sends the reminders that fired since the last run; returns counts for the caller."""
+        now = now or datetime.utcnow()
+        with get_engine().begin() as connection:
+            start = self._claim_window(connection, now)
+            if start is None:
+                return {'status': 'skipped'}
+            reminders = self.due_reminders(connection, start, now)
+
+        by_chat = {}
+        for kind, row in reminders:
+            if row.chat_id:  # Tasks added before reminders existed have no chat
+                by_chat.setdefault(row.chat_id, []).append((kind, row))
+        sent = 0
+        for chat_id, chat_reminders in by_chat.items():
+            try:
+                bot.send_message(chat_id=chat_id, text=self.render(chat_reminders))
+                sent += 1
+            except Exception as e:
+                print(f"WARNING: Could not send due-date reminders to chat {chat_id}: {e}")
+                continue
+            for kind, _ in chat_reminders:
+                REMINDERS_SENT.inc(kind=kind)
+        return {
+            'status': 'ok', 'window_start': start.isoformat(timespec='seconds'),
+            'window_end': now.isoformat(timespec='seconds'), 'reminders': len(reminders), 'messages': sent,
+        }
+
+    def render(self, reminders):
+        """One message listing a chat's overdue and upcoming tasks with their assignees."""
+        sections = [
+            ('overdue', "🔥 **مهلتش تموم شد:**"),
+            ('upcoming', f"⏳ **کمتر از {self.lead.total_seconds() / 3600:g} ساعت تا مهلت:**"),
+        ]
+        lines = ["⏰ یادآوری مهلت کارها:"]
+        for kind, heading in sections:
+            rows = [row for row_kind, row in reminders if row_kind == kind]
+            if not rows:
+                continue
+            lines.append("\n" + heading)
+            for row in rows:
+                assignee = row.assigned_to if row.assigned_to and row.assigned_to != 'N/A' else "بدون مسئول"
+                lines.append(f"• **#{row.id}** {row.title} — {assignee} (مهلت: {row.due_date:%Y-%m-%d})")
+        lines.append("\nکار تموم شد؟ `/done <شماره>` 😉")
+        return '\n'.join(lines)
+
+    # --- In-process scheduling (REMINDER_MODE=thread) ---
+
+    def start(self):
+        """Starts the background scheduler thread (long-running servers only)."""
+        self._thread = threading.Thread(target=self._loop, name='reminder-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def schedule(self, due_date):
+        """Adds a new task's fire times to the heap and wakes the thread if one is now the earliest."""
+        if self._thread is None:
+            return
+        with self._wakeup:
+            for fire_at in self._fire_times(due_date):
+                if self._horizon_end and datetime.utcnow() < fire_at <= self._horizon_end:
+                    heapq.heappush(self._heap, fire_at)
+            self._wakeup.notify()
+
+    def _refill(self, now):
+        """Loads the fire times of the next horizon with one range scan on (status, due_date)."""
+        tasks = Task.__table__
+        horizon_end = now + self.horizon
+        with get_engine().connect() as connection:
+            due_dates = connection.execute(select(tasks.c.due_date).where(
+                tasks.c.status.in_(ACTIVE_TASK_STATUSES), tasks.c.due_date > now,
+                tasks.c.due_date <= horizon_end + self.lead
+            )).scalars().all()
+        heap = sorted({fire_at for due_date in due_dates for fire_at in self._fire_times(due_date)
+                       if now < fire_at <= horizon_end})
+        with self._wakeup:
+            self._heap, self._horizon_end = heap, horizon_end
+
+    def _run_safely(self):
+        try:
+            self.run_window()
+        except SQLAlchemyError as e:
+            print(f"WARNING: Reminder run failed: {e}")
+
+    def _loop(self):
+        self._run_safely()  # Catch up on whatever fired while the process was down
+        while not self._stopped:
+            now = datetime.utcnow()
+            if self._horizon_end is None or now >= self._horizon_end:
+                try:
+                    self._refill(now)
+                except SQLAlchemyError as e:
+                    print(f"WARNING: Could not load reminder fire times: {e}")
+                    self._heap, self._horizon_end = [], now + timedelta(minutes=1)
+
+            with self._wakeup:
+                next_fire = self._heap[0] if self._heap else self._horizon_end
+                delay = (next_fire - datetime.utcnow()).total_seconds()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                while self._heap and self._heap[0] <= datetime.utcnow():
+                    heapq.heappop(self._heap)
+            self._run_safely()
+
+
+# -------------------------------------------------------------------------
+# 7. FLASK & BOT SETUP
 # -------------------------------------------------------------------------
 
 app = Flask(__name__)
 
-# Initialize Telegram Bot
+
+class WebhookReply:
+    """
+    Per-thread slot for the one Bot API call Telegram accepts in a webhook response.
+
+    While a slot is open, the first fire-and-forget call of the update (see METHODS)
+    is held back and returned by webhook() as the response body. If the handler makes
+    another call, the held one is sent first over the normal client so replies keep
+    their order. Telegram does not report errors for calls made this way.
+    """
+
+    METHODS = frozenset({'sendMessage', 'editMessageText', 'answerCallbackQuery', 'sendChatAction'})
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def open(self):
+        self._local.armed = True
+        self._local.payload = None
+
+    def close(self):
+        """Ends the slot and returns the held call (or None)."""
+        payload = getattr(self._local, 'payload', None)
+        self._local.armed = False
+        self._local.payload = None
+        return payload
+
+    def disarm(self):
+        """Sends everything through the client for the rest of the update (for handlers that need the sent Message)."""
+        self._local.armed = False
+
+    def capture(self, endpoint, data):
+        """Holds the call if the slot is free; returns False if it must be sent normally."""
+        if not getattr(self._local, 'armed', False) or self._local.payload is not None:
+            return False
+        if endpoint not in self.METHODS:
+            return False
+        text = data.get('text')
+        if isinstance(text, str) and _telegram_length(text) > TELEGRAM_MESSAGE_LIMIT:
+            return False  # Needs splitting into several messages
+        payload = {key: value for key, value in data.items() if value is not None and not isinstance(value, DefaultValue)}
+        if isinstance(payload.get('reply_markup'), str):
+            payload['reply_markup'] = json.loads(payload['reply_markup'])
+        payload['method'] = endpoint
+        self._local.payload = payload
+        return True
+
+    def take_pending(self):
+        """Removes and returns the held call so it can be sent before a later one; disarms the slot."""
+        payload = getattr(self._local, 'payload', None)
+        self._local.payload = None
+        self._local.armed = False
+        return payload
+
+
+webhook_reply = WebhookReply()
+
+
+class HuggerBot(Bot):
+    """
+    Bot whose calls go through the outbound sender (flood limits, splitting) and
+    may be answered through the webhook response (WEBHOOK_REPLY_ENABLED).
+    """
+
+    def _post(self, endpoint, data=None, *args, **kwargs):
+        if data is None or kwargs.get('api_kwargs'):
+            return super()._post(endpoint, data, *args, **kwargs)
+        # A call answered in the webhook response is no Bot API request, so it spends no flood-limit token
+        if webhook_reply.capture(endpoint, data):
+            WEBHOOK_REPLIES.inc(outcome='inline')
+            return True
+        pending = webhook_reply.take_pending()
+        if pending:
+            WEBHOOK_REPLIES.inc(outcome='flushed')
+            outbound_sender.send(pending.pop('method'), pending, self._deliver)
+        return outbound_sender.send(endpoint, data, lambda name, payload: self._deliver(name, payload, *args, **kwargs))
+
+    def _deliver(self, endpoint, data, *args, **kwargs):
+        return super()._post(endpoint, data, *args, **kwargs)
+
+
+# Initialize Telegram Bot (no network access until the first API call)
 if BOT_TOKEN:
-    bot = Bot(BOT_TOKEN)
-    dispatcher = Dispatcher(bot, None, use_context=True)
+    bot = HuggerBot(BOT_TOKEN)
 else:
     print("FATAL: BOT_TOKEN is not set. Bot will not function.")
-    dispatcher = None # Ensure dispatcher is None if BOT_TOKEN is missing
+    bot = None
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
 
-# Add Handlers to Dispatcher
-if dispatcher:
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("commands", command_functions))
+
+def get_dispatcher():
+    """Builds the dispatcher and registers all handlers on first use (None without BOT_TOKEN)."""
+    global _dispatcher
+    if _dispatcher is None and bot:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                from telegram.ext import Dispatcher  # Heavy import (job queue, scheduler), deferred
+                dispatcher = Dispatcher(bot, None, use_context=True)
+                register_handlers(dispatcher)
+                _dispatcher = dispatcher
+    return _dispatcher
+
+
+def error_handler(update, context):
+    """Logs exceptions that escaped a handler instead of dropping them silently."""
+    update_id = update.update_id if isinstance(update, Update) else None
+    print(f"ERROR: Update {update_id} caused error {context.error!r}")
+    _handler_context.failed = True  # The dispatcher swallows the exception; the ledger must not mark it done
+
+
+def register_handlers(dispatcher):
+    """Registers all command handlers on the dispatcher."""
+    from telegram.ext import CommandHandler, CallbackQueryHandler, TypeHandler
+
+    # Every handler is wrapped by instrument_handler() for the /metrics endpoint.
+    # Group -1 runs before the command handlers for every update
+    dispatcher.add_handler(TypeHandler(Update, instrument_handler(learn_user, "learn_user")), group=-1)
+
+    dispatcher.add_handler(CommandHandler("start", instrument_handler(start, "start")))
+    dispatcher.add_handler(CommandHandler("help", instrument_handler(help_command, "help")))
+    dispatcher.add_handler(CommandHandler("commands", instrument_handler(command_functions, "commands")))
     
     # Task Management
-    dispatcher.add_handler(CommandHandler("addtask", add_task))
-    dispatcher.add_handler(CommandHandler("tasks", list_tasks))
-    dispatcher.add_handler(CommandHandler("done", mark_done))
+    dispatcher.add_handler(CommandHandler("addtask", instrument_handler(add_task, "addtask")))
+    dispatcher.add_handler(CommandHandler("tasks", instrument_handler(list_tasks, "tasks")))
+    dispatcher.add_handler(CallbackQueryHandler(instrument_handler(tasks_page_callback, 'tasks_page'), pattern=r'^tasks:'))
+    dispatcher.add_handler(CommandHandler("done", instrument_handler(mark_done, "done")))
     
     # Knowledge Management
-    dispatcher.add_handler(CommandHandler("archive", archive_item))
-    dispatcher.add_handler(CommandHandler("memorize", archive_item)) # Same handler used for /memorize
-    dispatcher.add_handler(CommandHandler("search", search_archive))
+    dispatcher.add_handler(CommandHandler("archive", instrument_handler(archive_item, "archive")))
+    dispatcher.add_handler(CommandHandler("memorize", instrument_handler(archive_item, "memorize"))) # Same handler used for /memorize
+    dispatcher.add_handler(CommandHandler("search", instrument_handler(search_archive, "search")))
+    dispatcher.add_handler(CommandHandler("related", instrument_handler(related_items, "related")))
+    dispatcher.add_handler(CommandHandler("tags", instrument_handler(list_tags, "tags")))
     
     # Utility and Summary
-    dispatcher.add_handler(CommandHandler("logwork", log_work))
-    dispatcher.add_handler(CommandHandler("countdown", countdown_to_hugger))
-    dispatcher.add_handler(CommandHandler("translate", translate_command))
-    dispatcher.add_handler(CommandHandler("summary", weekly_summary))
+    dispatcher.add_handler(CommandHandler("logwork", instrument_handler(log_work, "logwork")))
+    dispatcher.add_handler(CommandHandler("mywork", instrument_handler(my_work, "mywork")))
+    dispatcher.add_handler(CommandHandler("countdown", instrument_handler(countdown_to_hugger, "countdown")))
+    dispatcher.add_handler(CommandHandler("translate", instrument_handler(translate_command, "translate")))
+    dispatcher.add_handler(CommandHandler("summary", instrument_handler(weekly_summary, "summary")))
     
     # Shopping List
-    dispatcher.add_handler(CommandHandler("buy", buy_command))
+    dispatcher.add_handler(CommandHandler("buy", instrument_handler(buy_command, "buy")))
 
     # Error Handler (Basic)
-    # def error_handler(update, context):
-    #     print(f"Update {update} caused error {context.error}")
-    # dispatcher.add_error_handler(error_handler)
+    dispatcher.add_error_handler(error_handler)
+
+
+def process_update(update):
+    """Runs one update through the dispatcher; its request-scoped DB session ends with it."""
+    _handler_context.sql_count = 0
+    _handler_context.failed = False
+    started_at = time.perf_counter()
+    try:
+        get_dispatcher().process_update(update)
+    finally:
+        db_session.remove()
+        elapsed = time.perf_counter() - started_at
+        UPDATE_DURATION.observe(elapsed)
+        if SLOW_UPDATE_MS and elapsed * 1000 > SLOW_UPDATE_MS:
+            SLOW_UPDATES.inc()
+            message = update.effective_message
+            command = message.text.split()[0] if message and message.text else type(update).__name__
+            print(f"SLOW UPDATE: {update.update_id} ({command}) took {elapsed * 1000:.0f} ms, "
+                  f"{_handler_context.sql_count} SQL statements")
+
+
+def process_claimed_update(update):
+    """
+    process_update() for an update claimed in the ledger. On success it is marked
+    done (in the handler's commit if it makes one); if a handler failed, the claim
+    is released so a redelivery runs it again. Returns True on success.
+    """
+    if update_ledger:
+        update_ledger.begin(update.update_id)
+    succeeded = False
+    try:
+        process_update(update)
+        succeeded = not _handler_context.failed
+    finally:
+        if update_ledger:
+            if succeeded:
+                update_ledger.finish(update.update_id)
+            else:
+                update_ledger.abandon(update.update_id)
+    return succeeded
+
+
+update_ledger = UpdateLedger(
+    lease_seconds=UPDATE_LEASE_SECONDS,
+    retention_hours=UPDATE_LEDGER_RETENTION_HOURS,
+    prune_every=UPDATE_LEDGER_PRUNE_EVERY,
+) if UPDATE_LEDGER_ENABLED else None
+
+retention_job = RetentionJob(
+    retention_days=RETENTION_DAYS,
+    batch_size=RETENTION_BATCH_SIZE,
+    max_batches=RETENTION_MAX_BATCHES,
+)
+
+reminder_scheduler = None
+if bot and REMINDERS_ENABLED:
+    reminder_scheduler = ReminderScheduler(
+        lead_hours=REMINDER_LEAD_HOURS,
+        catchup_hours=REMINDER_CATCHUP_HOURS,
+        horizon_hours=REMINDER_HORIZON_HOURS,
+    )
+    if REMINDER_MODE == 'thread':
+        reminder_scheduler.start()
+        atexit.register(reminder_scheduler.stop)
+
+# Background Update Processing (UPDATE_PROCESSING_MODE=async)
+# The dispatcher stays synchronous (no update_queue of its own); the pool only
+# decides on which thread and in which order process_update is called.
+update_pool = None
+if bot and UPDATE_PROCESSING_MODE == 'async':
+    update_pool = UpdateWorkerPool(
+        process_claimed_update,
+        workers=UPDATE_WORKERS,
+        queue_size=UPDATE_QUEUE_SIZE
+    )
+    atexit.register(update_pool.shutdown)
+
+
+# The webhook URL contains the bot token as a shared secret. Without a token the
+# route still exists (and answers 500) so the app can start for `migrate` etc.
+WEBHOOK_PATH = '/' + (BOT_TOKEN or 'webhook')
+
+
+def ops_route(rule, **options):
+    """
+    Registers an operational endpoint under WEBHOOK_PATH, where the bot token in
+    the URL is the shared secret. Without BOT_TOKEN the path would be the
+    guessable /webhook, so the endpoint is not registered at all.
+    """
+    if not BOT_TOKEN:
+        return lambda view: view
+    return app.route(WEBHOOK_PATH + rule, **options)
 
 
-@app.route('/' + BOT_TOKEN, methods=['POST'])
+@app.route(WEBHOOK_PATH, methods=['POST'])
 def webhook():
     """Main Webhook endpoint for Telegram."""
     if not BOT_TOKEN:
         return "BOT_TOKEN is missing.", 500
         
     if request.method == "POST":
-        update = Update.de_json(request.get_json(force=True), bot)
-        dispatcher.process_update(update)
+        payload = request.get_json(force=True, silent=True)
+        if not isinstance(payload, dict) or 'update_id' not in payload:
+            return 'invalid update', 400
+
+        update = Update.de_json(payload, bot)
+        claim = update_ledger.claim(update.update_id) if update_ledger else 'unguarded'
+        if claim == 'done':
+            return 'ok', 200  # A redelivery of an update that has been handled
+        if claim == 'in_progress':
+            # Another worker is handling it right now. A 503 makes Telegram redeliver later, so the
+            # update is not lost if that worker dies: the redelivery takes over the expired lease.
+            return 'busy', 503
+
+        if update_pool:
+            # Acknowledge immediately; a 503 makes Telegram redeliver later (backpressure).
+            if not update_pool.submit(update):
+                if update_ledger:
+                    update_ledger.release(update.update_id)
+                return 'busy', 503
+            return 'ok', 200
+
+        # Sends never sleep on this thread: calls without a flood-limit token are deferred
+        # A failed handler answers 500, so Telegram redelivers the released update
+        if not WEBHOOK_REPLY_ENABLED:
+            with outbound_sender.no_wait():
+                succeeded = process_claimed_update(update)
+            return ('ok', 200) if succeeded else ('error', 500)
+
+        # The first reply rides on this response, saving a round trip to the Bot API
+        webhook_reply.open()
+        try:
+            with outbound_sender.no_wait():
+                succeeded = process_claimed_update(update)
+        finally:
+            reply = webhook_reply.close()
+        if not succeeded:
+            return 'error', 500
+        if reply:
+            return jsonify(reply), 200
         return 'ok', 200
     return 'ok', 200
 
+
+@ops_route('/reload-users', methods=['POST'])
+def reload_users():
+    """Re-reads USER_NAMES_MAP and drops cached user profiles without a restart."""
+    user_directory.reload()
+    return 'ok', 200
+
+
+@ops_route('/enrich-links', methods=['POST'])
+def enrich_links():
+    """Fetches metadata for archived links still pending (cron target where background threads do not survive)."""
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    return jsonify(link_metadata_fetcher.enrich_pending(limit=limit)), 200
+
+
+@ops_route('/reminders', methods=['POST'])
+def send_reminders():
+    """Sends the due-date reminders that fired since the previous call (cron target on serverless)."""
+    if not reminder_scheduler:
+        return jsonify({'status': 'disabled'}), 200
+    try:
+        return jsonify(reminder_scheduler.run_window()), 200
+    except SQLAlchemyError as e:
+        print(f"ERROR: Reminder run failed: {e}")
+        return jsonify({'status': 'error'}), 500
+
+
+@ops_route('/maintenance/related-index', methods=['POST'])
+def refresh_related_index():
+    """Adds up to RELATED_REFRESH_MAX_ROWS new archive items to the /related index (cron target on serverless)."""
+    index = get_related_index()
+    if index is None:
+        return jsonify({'status': 'disabled'}), 200
+    session = Session()
+    try:
+        added = index.refresh(session, max_rows=RELATED_REFRESH_MAX_ROWS)
+    except (SQLAlchemyError, OSError) as e:
+        print(f"ERROR: Related-items refresh failed: {e}")
+        return jsonify({'status': 'error'}), 500
+    finally:
+        session.close()
+    return jsonify({'status': 'ok', 'added': added, 'indexed': index.count, 'complete': added < RELATED_REFRESH_MAX_ROWS}), 200
+
+
+@ops_route('/maintenance/retention', methods=['POST'])
+def run_retention():
+    """Moves old done tasks, bought items and activity logs to rollups/archive tables in bounded batches (cron target)."""
+    max_batches = request.args.get('max_batches', type=int)
+    if max_batches is not None:
+        max_batches = max(1, min(max_batches, 200))
+    try:
+        result = retention_job.run(get_engine(), max_batches=max_batches)
+    except SQLAlchemyError as e:
+        print(f"ERROR: Retention run failed: {e}")
+        return jsonify({'status': 'error'}), 500
+    return jsonify(result), 200 if result['status'] == 'ok' else 409
+
+
+@ops_route('/stats/updates')
+def update_stats():
+    """Backpressure metrics of the background update worker pool."""
+    if not update_pool:
+        return jsonify({'mode': 'sync'}), 200
+    return jsonify(dict(update_pool.stats(), mode='async')), 200
+
+
+@ops_route('/metrics')
+def metrics():
+    """Prometheus metrics: handler latency, SQL usage, external calls, queue depth, pool and caches."""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@ops_route('/stats/db')
+def db_stats():
+    """Connection pool profile, checkout wait times and connection counts."""
+    pool = _engine.pool if _engine is not None else None
+    return jsonify(dict(pool_metrics.stats(pool), profile=resolve_pool_profile())), 200
+
+
+@ops_route('/stats/gap')
+def gap_stats():
+    """Latency, failure and circuit breaker state of the GAP API client."""
+    if _gap_client is None:
+        return jsonify({'status': 'idle'}), 200  # Not used yet; do not build the client just to report on it
+    return jsonify(_gap_client.stats()), 200
+
+
+@ops_route('/stats/summary-cache')
+def summary_cache_stats():
+    """Hit/miss counters of the AI summary cache."""
+    return jsonify(summary_cache.stats()), 200
+
 # Vercel requires a default endpoint check
 @app.route('/')
 def home():
@@ -773,5 +5281,71 @@ def home():
     return f"Hugger Bot is running. Database Status: {'Connected' if DATABASE_URL else 'Missing URI'}", 200
 
 
+@app.cli.command('migrate')
+def migrate_command():
+    """Creates/upgrades the database schema: flask --app app migrate"""
+    migrate(create_app_engine())
+    print("Database schema is up to date.")
+
+
+def rebuild_related_index(bind):
+    """Re-vectorizes every archive item with current document frequencies (CLI use)."""
+    index = get_related_index()
+    if index is None:
+        return 0
+    session = Session(bind=bind)
+    try:
+        return index.rebuild(session)
+    finally:
+        session.close()
+
+
+@app.cli.command('related-index')
+def related_index_command():
+    """Rebuilds the related-items vector index from scratch: flask --app app related-index"""
+    print(f"Related-items index rebuilt: {rebuild_related_index(create_app_engine())} items")
+
+
+@app.cli.command('dedupe-archive')
+def dedupe_archive_command():
+    """Hashes old archive rows and removes duplicates: flask --app app dedupe-archive"""
+    print(f"Archive dedupe finished: {dedupe_archive(create_app_engine())}")
+
+
+def run_retention_until_complete(bind):
+    """Runs retention batches until every table is within the retention window (CLI use)."""
+    totals = {}
+    while True:
+        result = retention_job.run(bind)
+        for name, count in result.get('moved', {}).items():
+            totals[name] = totals.get(name, 0) + count
+        if result.get('complete', True):
+            return totals
+
+
+@app.cli.command('retention')
+def retention_command():
+    """Moves old rows to rollups/archive tables until nothing is left: flask --app app retention"""
+    print(f"Retention finished: {run_retention_until_complete(create_app_engine())}")
+
+
 # The Flask application instance (app) is used by Vercel for deployment.
-# In a local environment, you would run app.run() here.
+# In a local environment: `python app.py migrate` once, then `python app.py` to run.
+# After upgrading, `python app.py dedupe-archive` hashes old archive rows and removes duplicates.
+# `python app.py retention` moves everything older than RETENTION_DAYS to rollups/archive tables.
+# `python app.py related-index` rebuilds the /related vector index (new items are added by a background
+# refresh, or by POST <WEBHOOK_PATH>/maintenance/related-index where background threads do not survive).
+if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:2] == ['migrate']:
+        migrate(create_app_engine())
+        print("Database schema is up to date.")
+    elif sys.argv[1:2] == ['dedupe-archive']:
+        print(f"Archive dedupe finished: {dedupe_archive(create_app_engine())}")
+    elif sys.argv[1:2] == ['related-index']:
+        print(f"Related-items index rebuilt: {rebuild_related_index(create_app_engine())} items")
+    elif sys.argv[1:2] == ['retention']:
+        print(f"Retention finished: {run_retention_until_complete(create_app_engine())}")
+    else:
+        app.run()
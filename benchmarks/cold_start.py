@@ -0,0 +1,106 @@
+# -------------------------------------------------------------------------
+# HUGGER BOT - Cold Start Benchmark
+#
+# Measures, in fresh Python processes, how long it takes from `import app`
+# until the first webhook update has been answered. Outbound Telegram calls
+# are replaced by a stub, so only the bot's own work is measured.
+#
+# Usage:
+#   python benchmarks/cold_start.py                      # 10 runs, temp SQLite
+#   python benchmarks/cold_start.py --runs 30 --command "/tasks"
+#   python benchmarks/cold_start.py --database-url postgresql://... --no-auto-migrate
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside every child process: import the app, then answer one update.
+CHILD_SCRIPT = r"""
+import sys, time, json
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = time.perf_counter()
+
+from telegram import Message, User
+replies = []
+Message.reply_text = lambda self, text, *args, **kwargs: replies.append(text)
+app.bot._bot = User(1, 'HuggerBot', True, username='hugger_bot')  # Skip the getMe round trip
+
+command = sys.argv[2]
+update = {
+    'update_id': int(sys.argv[3]),  # Unique per run: the update ledger ignores redelivered update_ids
+    'message': {
+        'message_id': 1, 'date': 0, 'text': command,
+        'chat': {'id': -100, 'type': 'group'},
+        'from': {'id': 6847219190, 'is_bot': False, 'first_name': 'Bench'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}],
+    },
+}
+response = app.app.test_client().post(app.WEBHOOK_PATH, json=update)
+answered = time.perf_counter()
+
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_response_ms': (answered - imported) * 1000,
+    'total_ms': (answered - started) * 1000,
+    'status': response.status_code,
+    'replied': bool(replies),
+}))
+"""
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def run_once(env, command, update_id):
+    output = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', CHILD_SCRIPT, REPO_ROOT, command, str(update_id)],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-to-first-response benchmark for the webhook.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--command', default='/start', help='Command sent as the first update')
+    parser.add_argument('--database-url', help='Defaults to a temporary SQLite database')
+    parser.add_argument('--no-auto-migrate', action='store_true',
+                        help='Run `app.py migrate` once up front and start children with AUTO_MIGRATE=false')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hugger-bench-')
+    env = dict(os.environ)
+    env.setdefault('BOT_TOKEN', '123456:benchmark')
+    env['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    env['AUTO_MIGRATE'] = 'false' if args.no_auto_migrate else 'true'
+
+    if args.no_auto_migrate:
+        subprocess.run([sys.executable, '-W', 'ignore', os.path.join(REPO_ROOT, 'app.py'), 'migrate'],
+                       env=env, check=True, capture_output=True)
+
+    results = [run_once(env, args.command, run + 1) for run in range(args.runs)]
+    failed = [result for result in results if result['status'] != 200 or not result['replied']]
+
+    print(f"Cold start: {args.runs} runs of '{args.command}' "
+          f"(AUTO_MIGRATE={env['AUTO_MIGRATE']}, {env['DATABASE_URL'].split(':')[0]})")
+    for key in ('import_ms', 'first_response_ms', 'total_ms'):
+        values = [result[key] for result in results]
+        print(f"  {key:<18} p50={median(values):8.1f}  p95={percentile(values, 0.95):8.1f}  max={max(values):8.1f}")
+    if failed:
+        print(f"  WARNING: {len(failed)} runs did not answer the update")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+# -------------------------------------------------------------------------
+# HUGGER BOT - Handler Benchmark Suite
+#
+# Replays recorded or synthetic Telegram updates through the real webhook
+# processing path (ledger claim + app.process_claimed_update) against SQLite or
+# a local Postgres.
+# Only the HTTP connection pool of the Bot API client is replaced by a recording
+# stub, so the real send path (rate shaping, splitting, JSON encoding and
+# response parsing) is measured and no network is used. For every handler it
+# reports p50/p95/p99 latency, SQL statements per update and (optionally) memory
+# allocated per update, and exits with status 1 when a handler regresses past
+# the given thresholds, a saved baseline, or when a handler fails.
+#
+# Usage:
+#   python benchmarks/handlers.py                          # 1k archive rows, temp SQLite
+#   python benchmarks/handlers.py --archive-rows 100000 --per-handler 100
+#   python benchmarks/handlers.py --archive-rows 1000000 --database-url postgresql://localhost/hugger_bench
+#   python benchmarks/handlers.py --updates recorded_updates.jsonl --trace-allocations
+#   python benchmarks/handlers.py --output baseline.json                  # Save a baseline
+#   python benchmarks/handlers.py --baseline baseline.json --max-regression 0.25
+#   python benchmarks/handlers.py --max-p95-ms 50 --max-statements 12
+#
+# Recorded updates are JSON Lines, one Telegram Update object per line.
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Vocabulary for synthetic archive content (mixed Persian/English, like the real archive)
+WORDS = (
+    "پروژه طراحی جلسه گزارش کتاب برنامه نویسی پایتون سرور دیتابیس تیم هوگر "
+    "ایده بازاریابی فروش مشتری قرارداد بودجه ارائه مستند لینک مقاله ویدیو "
+    "python flask telegram postgres deploy vercel design meeting budget api"
+).split()
+TAGS = ['مهم', 'مقاله', 'ابزار', 'آموزش', 'ایده', 'حافظه_بلند_مدت', 'پیام_مهم', 'design', 'dev', 'finance']
+TEAM = ['6847219190', '7291579302', '8078073721', '6550959404', '1140241105']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replays Telegram updates through the bot handlers and reports latency.')
+    parser.add_argument('--database-url', help='Defaults to a temporary SQLite database')
+    parser.add_argument('--archive-rows', type=int, default=1000, help='Seeded archive size (e.g. 1000, 100000, 1000000)')
+    parser.add_argument('--skip-seed', action='store_true', help='Reuse an already seeded database')
+    parser.add_argument('--updates', help='JSON Lines file of recorded updates (replaces the synthetic mix)')
+    parser.add_argument('--per-handler', type=int, default=50, help='Synthetic updates per handler')
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='Measure allocations with tracemalloc (slows down the latency numbers)')
+    parser.add_argument('--output', help='Also write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Results JSON of an earlier run (--output) to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Allowed growth of p95 latency and SQL statements per handler over the baseline (0.25 = 25%%)')
+    parser.add_argument('--max-p95-ms', type=float, help='Fail when any handler has a higher p95 latency')
+    parser.add_argument('--max-statements', type=float, help='Fail when any handler runs more SQL statements per update')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """Sets the environment before app.py is imported."""
+    workdir = tempfile.mkdtemp(prefix='hugger-bench-')
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['RELATED_INDEX_DIR'] = os.path.join(workdir, 'related')  # Never the shared /tmp default
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ['AUTO_MIGRATE'] = 'false'
+    os.environ['UPDATE_PROCESSING_MODE'] = 'sync'
+    # Thousands of replies go to one benchmark chat: lift the flood limits so the
+    # shaping code runs but never sleeps, which would hide the handlers' own cost
+    os.environ.setdefault('OUTBOUND_GLOBAL_RATE', '1000000')
+    os.environ.setdefault('OUTBOUND_CHAT_RATE', '1000000')
+    os.environ.setdefault('OUTBOUND_GROUP_RATE_PER_MINUTE', '60000000')
+    sys.path.insert(0, REPO_ROOT)
+    return database_url
+
+
+class FakeResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+
+class RecordingTelegramHTTP:
+    """
+    Replaces the Bot API client's urllib3 pool (bot._request._con_pool): records
+    every call and answers with the JSON Telegram would send.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self._message_id = 0
+
+    def request(self, method, url, body=None, fields=None, headers=None, **unused):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls.append(endpoint)
+        data = json.loads(body) if body else dict(fields or {})
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'HuggerBot', 'username': 'hugger_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText', 'sendDocument'):
+            self._message_id += 1
+            result = {
+                'message_id': self._message_id, 'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0) or 0), 'type': 'group'},
+                'text': data.get('text', '') if isinstance(data.get('text'), str) else '',
+            }
+        else:
+            result = True
+        return FakeResponse(200, json.dumps({'ok': True, 'result': result}).encode('utf-8'))
+
+
+def seed_database(app, rows, rng):
+    """Bulk-loads a synthetic dataset: `rows` archive items plus proportional tasks, logs and purchases."""
+    engine = app.get_engine()
+    app.migrate(engine)
+    now = datetime.utcnow()
+    batch_size = 10000
+
+    with engine.begin() as connection:
+        tag_ids = {}
+        for name in TAGS:
+            tag_ids[name] = connection.execute(app.Tag.__table__.insert().values(name=name)).inserted_primary_key[0]
+
+        for start in range(0, rows, batch_size):
+            items, links = [], []
+            for item_id in range(start + 1, min(rows, start + batch_size) + 1):
+                title = ' '.join(rng.choices(WORDS, k=4))
+                content = ' '.join(rng.choices(WORDS, k=rng.randint(8, 40)))
+                tags = rng.sample(TAGS, k=rng.randint(0, 3))
+                items.append({
+                    'id': item_id, 'title': title, 'content': content, 'tags': ','.join(tags),
+                    'user_id': rng.choice(TEAM),
+                    'archived_at': now - timedelta(minutes=rng.randint(0, 525600)),
+                    'search_text': app.normalize_persian_text(' '.join([title, content, ','.join(tags)])),
+                })
+                links.extend({'archive_id': item_id, 'tag_id': tag_ids[name]} for name in tags)
+            connection.execute(app.ArchiveItem.__table__.insert(), items)
+            if links:
+                connection.execute(app.archive_tags.insert(), links)
+
+        side_rows = max(100, rows // 10)
+        connection.execute(app.Task.__table__.insert(), [{
+            'title': ' '.join(rng.choices(WORDS, k=3)),
+            'assigned_to': '@' + rng.choice(['xenorion', 'comrade_amir', 'sahand', 'iliya_r8']),
+            'due_date': now + timedelta(days=rng.randint(-30, 30)),
+            'status': rng.choice(['To Do', 'To Do', 'In Progress', 'Done']),
+            'created_at': now - timedelta(days=rng.randint(0, 60)),
+        } for _ in range(side_rows)])
+        connection.execute(app.ActivityLog.__table__.insert(), [{
+            'user_id': rng.choice(TEAM), 'description': ' '.join(rng.choices(WORDS, k=8)),
+            'logged_at': now - timedelta(days=rng.randint(0, 365)),
+        } for _ in range(side_rows)])
+        connection.execute(app.ShoppingItem.__table__.insert(), [{
+            'item_name': rng.choice(WORDS), 'is_bought': rng.random() < 0.8,
+            'created_at': now - timedelta(days=rng.randint(0, 90)), 'bought_at': now - timedelta(days=rng.randint(0, 30)),
+        } for _ in range(min(side_rows, 2000))])
+
+
+def synthetic_updates(per_handler, rng):
+    """Yields a shuffled mix of command updates covering the hot handlers."""
+    commands = {
+        '/addtask': lambda: f"/addtask {' '.join(rng.choices(WORDS, k=3))} /to @xenorion /due 2030-01-01",
+        '/tasks': lambda: rng.choice(['/tasks', '/tasks overdue', '/tasks @sahand']),
+        '/done': lambda: f"/done {rng.randint(1, 100)}",
+        '/search': lambda: rng.choice([
+            f"/search {rng.choice(WORDS)}",
+            f"/search {rng.choice(WORDS)} {rng.choice(WORDS)}",
+            f"/search #{rng.choice(TAGS)}",
+            f"/search #{rng.choice(TAGS)} #{rng.choice(TAGS)}",
+        ]),
+        '/tags': lambda: '/tags',
+        '/archive': lambda: f"/archive https://example.com/{rng.randint(1, 10 ** 9)} #{rng.choice(TAGS)}",
+        '/memorize': lambda: '/memorize',
+        '/logwork': lambda: f"/logwork {' '.join(rng.choices(WORDS, k=6))}",
+        '/summary': lambda: rng.choice(['/summary', '/summary team']),
+        '/buy': lambda: rng.choice([
+            f"/buy add {rng.choice(WORDS)}", '/buy list', f"/buy done {rng.randint(1, 100)}",
+        ]),
+        '/countdown': lambda: '/countdown',
+    }
+    updates = []
+    for command, make_text in commands.items():
+        for _ in range(per_handler):
+            text = make_text()
+            message = {
+                'message_id': rng.randint(1, 10 ** 9), 'date': int(time.time()), 'text': text,
+                'chat': {'id': -1001, 'type': 'supergroup'},
+                'from': {'id': int(rng.choice(TEAM)), 'is_bot': False, 'first_name': 'Bench', 'username': 'xenorion'},
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+            }
+            if command == '/memorize':
+                message['reply_to_message'] = {
+                    'message_id': 1, 'date': int(time.time()), 'chat': message['chat'],
+                    'from': {'id': int(rng.choice(TEAM)), 'is_bot': False, 'first_name': 'Member'},
+                    'text': ' '.join(rng.choices(WORDS, k=30)),
+                }
+            updates.append(message)
+    rng.shuffle(updates)
+    return [{'update_id': index + 1, 'message': message} for index, message in enumerate(updates)]
+
+
+def handler_name(payload):
+    """Groups updates by command (e.g. '/search'), or by update type for non-commands."""
+    message = payload.get('message') or payload.get('edited_message')
+    if message and message.get('text', '').startswith('/'):
+        return message['text'].split()[0].split('@')[0]
+    if payload.get('callback_query'):
+        return 'callback:' + payload['callback_query'].get('data', '').split(':')[0]
+    return 'other'
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def find_regressions(summary, args):
+    """Lists every handler that breaks an absolute threshold or grew past --max-regression over the baseline."""
+    failures = []
+    for name, row in sorted(summary.items()):
+        if args.max_p95_ms is not None and row['p95_ms'] > args.max_p95_ms:
+            failures.append(f"{name}: p95 {row['p95_ms']:.2f} ms > {args.max_p95_ms:.2f} ms")
+        if args.max_statements is not None and row['statements_per_update'] > args.max_statements:
+            failures.append(f"{name}: {row['statements_per_update']:.2f} SQL/update > {args.max_statements:.2f}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['handlers']
+        for name, row in sorted(summary.items()):
+            previous = baseline.get(name)
+            if not previous:
+                continue
+            for key, unit in (('p95_ms', 'ms'), ('statements_per_update', 'SQL/update')):
+                # Small absolute slack keeps sub-millisecond handlers from failing on timer noise
+                limit = previous[key] * (1 + args.max_regression) + (0.5 if key == 'p95_ms' else 0)
+                if row[key] > limit:
+                    failures.append(f"{name}: {key} {row[key]:.2f} {unit} > baseline {previous[key]:.2f} {unit} "
+                                    f"+{args.max_regression:.0%}")
+    return failures
+
+
+def main():
+    args = parse_args()
+    database_url = configure_environment(args)
+    rng = random.Random(args.seed)
+
+    import app
+    from sqlalchemy import event
+    from telegram import Update
+
+    stub = RecordingTelegramHTTP()
+    app.bot._request._con_pool = stub
+
+    if not args.skip_seed:
+        started_at = time.perf_counter()
+        seed_database(app, args.archive_rows, rng)
+        print(f"Seeded {args.archive_rows} archive rows in {time.perf_counter() - started_at:.1f}s")
+
+    statement_count = [0]
+    event.listen(app.get_engine(), 'before_cursor_execute', lambda *unused: statement_count.__setitem__(0, statement_count[0] + 1))
+
+    if args.updates:
+        with open(args.updates, encoding='utf-8') as updates_file:
+            payloads = [json.loads(line) for line in updates_file if line.strip()]
+    else:
+        payloads = synthetic_updates(args.per_handler, rng)
+
+    # Warm-up: builds the dispatcher and pool connections outside the measurements
+    app.process_update(Update.de_json(synthetic_updates(1, random.Random(0))[0], app.bot))
+    # Every update is claimed like a webhook delivery; a reused database must not answer 'done'
+    with app.get_engine().begin() as connection:
+        connection.execute(app.ProcessedUpdate.__table__.delete())
+
+    if args.trace_allocations:
+        tracemalloc.start()
+
+    results = {}
+    failed = []
+    for payload in payloads:
+        update = Update.de_json(payload, app.bot)
+        statements_before = statement_count[0]
+        if args.trace_allocations:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        started_at = time.perf_counter()
+        claim = app.update_ledger.claim(update.update_id)
+        if claim in ('done', 'in_progress'):
+            print(f"WARNING: update {update.update_id} is a duplicate ({claim}); replayed updates need unique update_ids")
+            continue
+        if not app.process_claimed_update(update):
+            failed.append(f"{handler_name(payload)}: update {update.update_id} failed")
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+
+        entry = results.setdefault(handler_name(payload), {'latency_ms': [], 'statements': [], 'alloc_kib': []})
+        entry['latency_ms'].append(elapsed_ms)
+        entry['statements'].append(statement_count[0] - statements_before)
+        if args.trace_allocations:
+            entry['alloc_kib'].append((tracemalloc.get_traced_memory()[1] - memory_before) / 1024)
+
+    backend = database_url.split(':')[0]
+    print(f"\nHandler latency ({len(payloads)} updates, {args.archive_rows} archive rows, {backend}, search={app.SEARCH_BACKEND})")
+    print(f"{'handler':<14}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'SQL/upd':>10}{'KiB/upd':>10}")
+    summary = {}
+    for name in sorted(results):
+        entry = results[name]
+        latencies = entry['latency_ms']
+        summary[name] = {
+            'count': len(latencies),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'statements_per_update': round(sum(entry['statements']) / len(latencies), 2),
+            'alloc_kib_per_update': round(sum(entry['alloc_kib']) / len(latencies), 1) if entry['alloc_kib'] else None,
+        }
+        row = summary[name]
+        alloc = f"{row['alloc_kib_per_update']:>10.1f}" if row['alloc_kib_per_update'] is not None else f"{'-':>10}"
+        print(f"{name:<14}{row['count']:>6}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+              f"{row['statements_per_update']:>10.2f}{alloc}")
+    print(f"\nBot API calls recorded: {len(stub.calls)}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump({'archive_rows': args.archive_rows, 'database': backend, 'handlers': summary}, output_file, indent=2)
+
+    failures = failed + find_regressions(summary, args)
+    if failures:
+        print(f"\nRegressions ({len(failures)}):")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# -------------------------------------------------------------------------
+# HUGGER BOT - Link Metadata Harness
+#
+# Runs the link metadata fetcher against a local HTTP stand-in (no internet)
+# and checks what it stores: title/description/canonical URL, the byte cap,
+# conditional GET revalidation (304), redirects, the per-host concurrency
+# limit, the refusal of private hosts, and that a host whose DNS answer
+# changes after the check (DNS rebinding) is still fetched from the checked
+# address. Prints one line per check and exits with status 1 on a failure.
+#
+# Usage:
+#   python benchmarks/link_metadata.py
+#   python benchmarks/link_metadata.py --pages 40 --per-host 2
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGE = """<!doctype html><html><head>
+<meta charset="utf-8"><title>  صفحه {index}  </title>
+<meta name="description" content="توضیح   صفحه {index}">
+<link rel="canonical" href="/canonical/{index}">
+</head><body>{padding}</body></html>"""
+
+
+class StandInState:
+    def __init__(self, delay):
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+
+def make_handler(state):
+    class StandInHandler(BaseHTTPRequestHandler):
+        """/page/N (with ETag), /redirect/N -> /page/N, /large (body far over the byte cap)."""
+
+        def log_message(self, *unused):
+            pass
+
+        def do_GET(self):
+            with state.lock:
+                state.requests.append((self.path, self.headers.get('Host'), self.headers.get('If-None-Match')))
+                state.active += 1
+                state.peak = max(state.peak, state.active)
+            time.sleep(state.delay)
+            with state.lock:
+                state.active -= 1  # Before the headers go out: the fetcher holds its host slot until then
+            self._respond()
+
+        def _respond(self):
+            if self.path.startswith('/redirect/'):
+                self.send_response(302)
+                self.send_header('Location', '/page/' + self.path.rsplit('/', 1)[-1])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.path.startswith('/page/'):
+                index = self.path.rsplit('/', 1)[-1]
+                etag = f'"page-{index}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                body = PAGE.format(index=index, padding='').encode('utf-8')
+            elif self.path == '/large':
+                body = PAGE.format(index='large', padding='x' * (4 * 1024 * 1024)).encode('utf-8')
+                etag = None
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            if etag:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # The fetcher stops reading at its byte cap
+
+    return StandInHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the link metadata fetcher against a local HTTP stand-in.')
+    parser.add_argument('--pages', type=int, default=20, help='Pages fetched concurrently for the per-host check')
+    parser.add_argument('--per-host', type=int, default=2)
+    parser.add_argument('--delay', type=float, default=0.05, help='Seconds the stand-in takes per response')
+    args = parser.parse_args()
+
+    state = StandInState(args.delay)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='hugger-bench-'), 'bench.db')}"
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    sys.path.insert(0, REPO_ROOT)
+
+    import app
+    failures = []
+
+    def check(name, passed, detail=''):
+        print(f"{'ok  ' if passed else 'FAIL'} {name}{': ' + detail if detail else ''}")
+        if not passed:
+            failures.append(name)
+
+    fetcher = app.LinkMetadataFetcher(workers=8, per_host=args.per_host, max_bytes=64 * 1024, timeout=5, allow_private=True)
+
+    metadata = fetcher.fetch(f"{base}/page/1")
+    check('metadata parsed', metadata == {
+        'title': 'صفحه 1', 'description': 'توضیح صفحه 1', 'canonical_url': f"{base}/canonical/1",
+    }, repr(metadata))
+
+    state.requests.clear()
+    again = fetcher.fetch(f"{base}/page/1")
+    check('revalidated with If-None-Match', state.requests[-1][2] == '"page-1"' and again == metadata)
+
+    redirected = fetcher.fetch(f"{base}/redirect/2")
+    check('redirect followed', redirected and redirected['title'] == 'صفحه 2', repr(redirected))
+
+    started_at = time.perf_counter()
+    large = fetcher.fetch(f"{base}/large")
+    check('byte cap', large and large['title'] == 'صفحه large', f"{time.perf_counter() - started_at:.2f}s")
+
+    state.peak = 0
+    futures = [fetcher._get_executor().submit(fetcher.fetch, f"{base}/page/{index}") for index in range(100, 100 + args.pages)]
+    results = [future.result() for future in futures]
+    check('per-host limit', state.peak <= args.per_host and all(results),
+          f"peak {state.peak} concurrent requests, limit {args.per_host}")
+
+    strict = app.LinkMetadataFetcher(workers=2, per_host=2, timeout=2, allow_private=False)
+    check('private host refused', strict.fetch(f"{base}/page/3") is None)
+
+    # DNS rebinding: the first answer (the check) is the stand-in, every later one an unroutable
+    # address. A fetcher that resolved the name again when connecting would time out there.
+    real_getaddrinfo = socket.getaddrinfo
+    answers = {'rebind.test': ['127.0.0.1']}
+
+    def rebinding_getaddrinfo(host, *rest, **kwargs):
+        if host == 'rebind.test':
+            address = answers['rebind.test'].pop(0) if answers['rebind.test'] else '192.0.2.1'
+            return real_getaddrinfo(address, *rest, **kwargs)
+        return real_getaddrinfo(host, *rest, **kwargs)
+
+    real_public_address = app._public_address
+    socket.getaddrinfo = rebinding_getaddrinfo
+    # Treats the stand-in as public, so only the pinning decides where the fetcher connects
+    app._public_address = lambda host: rebinding_getaddrinfo(host, None)[0][4][0]
+    try:
+        state.requests.clear()
+        pinned = strict.fetch(f"http://rebind.test:{server.server_port}/page/4")
+    except Exception as e:
+        pinned = f"{type(e).__name__}: {e}"
+    finally:
+        socket.getaddrinfo = real_getaddrinfo
+        app._public_address = real_public_address
+    host_header = state.requests[-1][1] if state.requests else None
+    check('DNS rebinding: connects to the checked address', isinstance(pinned, dict) and pinned['title'] == 'صفحه 4', repr(pinned))
+    check('DNS rebinding: Host header keeps the name', host_header == f"rebind.test:{server.server_port}", repr(host_header))
+
+    server.shutdown()
+    print(f"\n{len(failures)} failed" if failures else '\nAll checks passed')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
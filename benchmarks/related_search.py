@@ -0,0 +1,93 @@
+# -------------------------------------------------------------------------
+# HUGGER BOT - Related Items Benchmark
+#
+# Fills a temporary SQLite archive with synthetic Persian items, builds the
+# /related vector index from scratch, adds a small incremental batch, and
+# times top-k similarity queries over the memory-mapped matrix.
+#
+# Usage:
+#   python benchmarks/related_search.py
+#   python benchmarks/related_search.py --items 100000 --queries 200 --dim 256
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from statistics import median
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VOCABULARY = (
+    'جلسه تیم طراحی دیتابیس ایندکس سرور ربات استقرار باگ کاربر اپلیکیشن موبایل تست انتشار خرید '
+    'لپ‌تاپ مستندات پروژه مهلت گزارش هزینه قرارداد مشتری پرداخت امنیت رمز شبکه کلود فروش بازاریابی '
+    'طراحی‌ها رابط کاربری عملکرد سرعت حافظه کش صف پیام اعلان ایمیل تقویم برنامه‌ریزی بودجه'
+).split()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def synthetic_text(rng, words=12):
+    return ' '.join(rng.choice(VOCABULARY) for _ in range(words)) + f" {rng.randrange(10 ** 6)}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query time of the /related vector index.')
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--dim', type=int, default=256)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hugger-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ['RELATED_INDEX_DIR'] = os.path.join(workdir, 'related')
+    os.environ['RELATED_VECTOR_DIM'] = str(args.dim)
+    sys.path.insert(0, REPO_ROOT)
+
+    import app
+    rng = random.Random(7)
+    session = app.Session()
+
+    def add_items(count):
+        rows = []
+        for _ in range(count):
+            content = synthetic_text(rng)
+            rows.append({'title': content[:40], 'content': content, 'search_text': app.normalize_persian_text(content)})
+        session.bulk_insert_mappings(app.ArchiveItem, rows)
+        session.commit()
+
+    add_items(args.items)
+    index = app.get_related_index()
+
+    started = time.perf_counter()
+    index.rebuild(session)
+    build_s = time.perf_counter() - started
+
+    add_items(100)
+    started = time.perf_counter()
+    added = index.refresh(session)
+    refresh_ms = (time.perf_counter() - started) * 1000
+
+    timings = []
+    for _ in range(args.queries):
+        query = synthetic_text(rng, words=6)
+        started = time.perf_counter()
+        index.similar(query, k=5)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    print(f"Related index: {index.count} items x {args.dim} dims "
+          f"({os.path.getsize(os.path.join(workdir, 'related', f'vectors.{index.generation}.f32')) / 2 ** 20:.0f} MB mapped)")
+    print(f"  full build        {build_s:8.1f} s")
+    print(f"  refresh (+{added})     {refresh_ms:8.1f} ms")
+    print(f"  query top-5       p50={median(timings):6.1f} ms  p95={percentile(timings, 0.95):6.1f} ms  max={max(timings):6.1f} ms")
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
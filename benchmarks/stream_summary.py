@@ -0,0 +1,189 @@
+# -------------------------------------------------------------------------
+# HUGGER BOT - Streaming Summary Benchmark
+#
+# Runs `/summary #خلاصه_کن` against a local fake GAP server that streams its
+# completion as server-sent events, once with streaming and once without.
+# Reports when the user first sees something (placeholder), when the first
+# summary text appears, when the answer is complete, and how many edits were
+# sent. Only the HTTP connection pool of the Bot API client is stubbed, so the
+# real send path (including the flood-limit shaping of the edits) is measured
+# without network. Exits with status 1 when streaming misses the thresholds.
+#
+# Usage:
+#   python benchmarks/stream_summary.py
+#   python benchmarks/stream_summary.py --tokens 400 --token-delay 0.02 --first-token-delay 1.5
+#   python benchmarks/stream_summary.py --max-first-content-s 2 --max-edits 10
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Time-to-first-content of AI summaries with and without SSE streaming.')
+    parser.add_argument('--tokens', type=int, default=200, help='Tokens in the fake completion')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='Seconds between streamed tokens')
+    parser.add_argument('--first-token-delay', type=float, default=0.8, help='Seconds before the first token')
+    parser.add_argument('--edit-interval', type=float, default=1.0, help='SUMMARY_STREAM_EDIT_INTERVAL')
+    parser.add_argument('--max-first-content-s', type=float,
+                        help='Fail when streaming shows the first summary text later (default: first token delay + 1.5s)')
+    parser.add_argument('--max-edits', type=int,
+                        help='Fail when streaming sends more edits (default: one per edit interval of the stream, plus 2)')
+    return parser.parse_args()
+
+
+def make_fake_gap_handler(args):
+    class FakeGapHandler(BaseHTTPRequestHandler):
+        """OpenAI-style /chat/completions: SSE when the request asks for "stream", one JSON body otherwise."""
+
+        def log_message(self, *unused):
+            pass
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            tokens = [f"واژه{index} " for index in range(args.tokens)]
+            time.sleep(args.first_token_delay)
+
+            if not payload.get('stream'):
+                time.sleep(args.token_delay * args.tokens)
+                body = json.dumps({'choices': [{'message': {'content': ''.join(tokens)}}]}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            self.wfile.write(b': keep-alive\n\n')
+            for token in tokens:
+                event = {'choices': [{'delta': {'content': token}}]}
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(args.token_delay)
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+            self.close_connection = True
+
+    return FakeGapHandler
+
+
+class FakeResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+
+class TimedTelegramHTTP:
+    """
+    Replaces the Bot API client's urllib3 pool (bot._request._con_pool): records
+    (seconds since start, endpoint, text) of every call and answers like Telegram.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.started_at = time.perf_counter()
+        self._message_id = 0
+
+    def request(self, method, url, body=None, fields=None, headers=None, **unused):
+        endpoint = url.rsplit('/', 1)[-1]
+        data = json.loads(body) if body else dict(fields or {})
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'HuggerBot', 'username': 'hugger_bot'}
+        else:
+            self.calls.append((time.perf_counter() - self.started_at, endpoint, data.get('text', '')))
+            self._message_id += 1
+            result = {
+                'message_id': self._message_id, 'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0) or 0), 'type': 'private'}, 'text': data.get('text', ''),
+            }
+        return FakeResponse(200, json.dumps({'ok': True, 'result': result}).encode('utf-8'))
+
+
+def run_summary(app, stub, streaming):
+    from telegram import Update
+
+    app.SUMMARY_STREAMING_ENABLED = streaming
+    text = '/summary #خلاصه_کن #بدون_کش'
+    payload = {'update_id': 1, 'message': {
+        'message_id': 2, 'date': int(time.time()), 'text': text,
+        'chat': {'id': 6847219190, 'type': 'private'},
+        'from': {'id': 6847219190, 'is_bot': False, 'first_name': 'Bench'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len('/summary')}],
+        'reply_to_message': {
+            'message_id': 1, 'date': int(time.time()), 'chat': {'id': 6847219190, 'type': 'private'},
+            'from': {'id': 7291579302, 'is_bot': False, 'first_name': 'Member'},
+            'text': 'متن بلندی که باید خلاصه شود. ' * 50,
+        },
+    }}
+    stub.calls.clear()
+    stub.started_at = time.perf_counter()
+    app.process_update(Update.de_json(payload, app.bot))
+
+    placeholder = app.ProgressiveReply.PLACEHOLDER
+    content_times = [at for at, _, text in stub.calls if text and text != placeholder]
+    return {
+        'first_reply_s': stub.calls[0][0] if stub.calls else None,
+        'first_content_s': content_times[0] if content_times else None,
+        'complete_s': stub.calls[-1][0] if stub.calls else None,
+        'bot_calls': len(stub.calls),
+        'edits': sum(1 for _, endpoint, _ in stub.calls if endpoint == 'editMessageText'),
+    }
+
+
+def main():
+    args = parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_fake_gap_handler(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='hugger-bench-'), 'bench.db')}"
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ['GAP_API_KEY'] = 'benchmark'
+    os.environ['GAP_API_URL'] = f"http://127.0.0.1:{server.server_port}"
+    os.environ['SUMMARY_STREAM_EDIT_INTERVAL'] = str(args.edit_interval)
+    os.environ['UPDATE_PROCESSING_MODE'] = 'sync'
+    sys.path.insert(0, REPO_ROOT)
+
+    import app
+    stub = TimedTelegramHTTP()
+    app.bot._request._con_pool = stub
+
+    print(f"Fake GAP: {args.tokens} tokens, first after {args.first_token_delay}s, then every {args.token_delay}s")
+    print(f"{'mode':<12}{'first reply s':>15}{'first content s':>17}{'complete s':>12}{'bot calls':>11}{'edits':>7}")
+    results = {}
+    for streaming in (False, True):
+        result = results[streaming] = run_summary(app, stub, streaming)
+        print(f"{'streaming' if streaming else 'blocking':<12}{result['first_reply_s']:>15.2f}"
+              f"{result['first_content_s']:>17.2f}{result['complete_s']:>12.2f}{result['bot_calls']:>11}{result['edits']:>7}")
+    server.shutdown()
+
+    streamed = results[True]
+    stream_seconds = args.tokens * args.token_delay
+    max_first_content = args.max_first_content_s
+    if max_first_content is None:
+        max_first_content = args.first_token_delay + 1.5
+    max_edits = args.max_edits
+    if max_edits is None:
+        max_edits = int(stream_seconds / args.edit_interval) + 2
+    failures = []
+    if streamed['first_content_s'] is None or streamed['first_content_s'] > max_first_content:
+        failures.append(f"first content after {streamed['first_content_s']}s > {max_first_content:.2f}s")
+    if streamed['edits'] > max_edits:
+        failures.append(f"{streamed['edits']} edits > {max_edits}")
+    if failures:
+        print(f"\nRegressions: {'; '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -------------------------------------------------------------------------
+# HUGGER BOT - Test Setup
+#
+# app.py reads its configuration at import time, so the environment is set
+# here before the first import: a temporary SQLite database, a fake bot token,
+# synchronous update processing and flood limits high enough to never sleep.
+# The Bot API client's HTTP pool is replaced by a recording stub, so replies
+# go through the real send path without touching the network.
+# -------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import tempfile
+import itertools
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='hugger-tests-')
+
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ['BOT_TOKEN'] = '123456:test'
+os.environ['UPDATE_PROCESSING_MODE'] = 'sync'
+os.environ['REMINDER_MODE'] = 'cron'
+os.environ['RELATED_INDEX_DIR'] = os.path.join(WORKDIR, 'related')
+os.environ['OUTBOUND_GLOBAL_RATE'] = '1000000'
+os.environ['OUTBOUND_CHAT_RATE'] = '1000000'
+os.environ['OUTBOUND_GROUP_RATE_PER_MINUTE'] = '60000000'
+sys.path.insert(0, REPO_ROOT)
+
+import app as hugger  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+
+class RecordingTelegramHTTP:
+    """Stands in for bot._request._con_pool: records (endpoint, payload) and answers like Telegram."""
+
+    def __init__(self):
+        self.calls = []
+        self._message_id = 0
+
+    def request(self, method, url, body=None, fields=None, headers=None, **unused):
+        endpoint = url.rsplit('/', 1)[-1]
+        data = json.loads(body) if body else dict(fields or {})
+        self.calls.append((endpoint, data))
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'HuggerBot', 'username': 'hugger_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            self._message_id += 1
+            result = {
+                'message_id': self._message_id, 'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0) or 0), 'type': 'group'},
+                'text': data.get('text', ''),
+            }
+        else:
+            result = True
+        return FakeResponse(200, json.dumps({'ok': True, 'result': result}).encode('utf-8'))
+
+    def texts(self, endpoint='sendMessage'):
+        return [data.get('text') for called, data in self.calls if called == endpoint]
+
+
+_update_ids = itertools.count(1000)
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    hugger.get_engine()
+    return hugger
+
+
+@pytest.fixture
+def telegram(app_module, monkeypatch):
+    stub = RecordingTelegramHTTP()
+    monkeypatch.setattr(app_module.bot._request, '_con_pool', stub)
+    return stub
+
+
+@pytest.fixture
+def make_update():
+    """Builds a command update payload with a fresh update_id."""
+
+    def build(text, user_id=6847219190, chat_id=-1001, username='xenorion'):
+        update_id = next(_update_ids)
+        return {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'supergroup'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test', 'username': username},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        }}
+    return build
+
+
+@pytest.fixture
+def replace_handler(app_module, monkeypatch):
+    """Swaps a module-level handler function; the dispatcher is rebuilt so it picks the replacement up."""
+
+    def replace(name, handler):
+        monkeypatch.setattr(app_module, name, handler)
+        monkeypatch.setattr(app_module, '_dispatcher', None)
+    return replace
@@ -0,0 +1,103 @@
+"""Invalidation of the in-memory caches: user profiles (UserDirectory) and AI summaries (SummaryCache)."""
+
+import time
+
+import pytest
+from sqlalchemy import event
+from telegram import User
+
+
+@pytest.fixture
+def statements(app_module):
+    """Counts the SQL statements sent to the shared engine while the test runs."""
+    count = [0]
+
+    def on_execute(*unused):
+        count[0] += 1
+
+    engine = app_module.get_engine()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    yield count
+    event.remove(engine, 'before_cursor_execute', on_execute)
+
+
+@pytest.fixture
+def directory(app_module, monkeypatch):
+    monkeypatch.setenv('USER_NAMES_MAP', '{}')
+    return app_module.UserDirectory(cache_ttl=300, miss_ttl=0.2)
+
+
+def stored_user(app_module, user_id):
+    session = app_module.Session()
+    try:
+        row = session.get(app_module.BotUser, str(user_id))
+        return (row.username, row.first_name, row.updated_at) if row else None
+    finally:
+        session.close()
+
+
+def test_learn_writes_only_when_the_profile_changed(app_module, directory, statements):
+    user = User(id=501, first_name='Sara', is_bot=False, username='sara')
+    directory.learn(user)
+    first = stored_user(app_module, 501)
+    assert first[:2] == ('sara', 'Sara')
+
+    statements[0] = 0
+    directory.learn(user)
+    assert statements[0] == 0  # Cached profile, nothing to do
+
+    directory.reload()  # Cache miss: the stored row is compared, not rewritten
+    directory.learn(user)
+    assert stored_user(app_module, 501) == first
+
+    directory.learn(User(id=501, first_name='Sara J', is_bot=False, username='sara'))
+    assert stored_user(app_module, 501)[1] == 'Sara J'
+    assert directory.name(501) == 'Sara J'
+
+
+def test_reload_drops_cached_profiles(app_module, directory, monkeypatch):
+    directory.learn(User(id=502, first_name='Reza', is_bot=False, username='reza'))
+    assert directory.name(502) == 'Reza'
+
+    monkeypatch.setenv('USER_NAMES_MAP', '{"502": "رضا"}')
+    assert directory.name(502) == 'Reza'  # USER_NAMES_MAP is only re-read on reload()
+    directory.reload()
+    assert directory.name(502) == 'رضا'
+
+
+def test_unknown_keys_are_not_looked_up_again_until_the_miss_expires(app_module, directory, statements):
+    assert directory.resolve_many(['9990001', '@nobody_here']) == {}
+
+    statements[0] = 0
+    assert directory.resolve_many(['9990001', '@nobody_here']) == {}
+    assert statements[0] == 0
+
+    time.sleep(0.25)
+    directory.resolve_many(['9990001'])
+    assert statements[0] == 1
+
+
+def test_learning_a_user_clears_its_cached_miss(app_module, directory):
+    assert directory.resolve_many(['503', '@nima']) == {}
+
+    directory.learn(User(id=503, first_name='Nima', is_bot=False, username='Nima'))
+    assert directory.resolve_many(['503', '@NIMA']) == {'503': 'Nima', '@NIMA': 'Nima'}
+
+
+def test_summary_cache_key_changes_with_prompt_version_and_model(app_module):
+    make_key = app_module.SummaryCache.make_key
+    text = 'متن آزمایشی برای خلاصه'
+
+    assert make_key(text, prompt_version='v1') != make_key(text, prompt_version='v2')
+    assert make_key(text, model='a', prompt_version='v1') != make_key(text, model='b', prompt_version='v1')
+
+
+def test_summary_cache_entries_expire(app_module):
+    cache = app_module.SummaryCache(maxsize=8, ttl=1)
+    key = app_module.SummaryCache.make_key('متن منقضی', prompt_version='test-expiry')
+    cache.put(key, 'خلاصه')
+    assert cache.get(key) == 'خلاصه'
+
+    time.sleep(1.1)
+    assert cache.memory.get(key) is None
+    assert cache.get(key) is None  # The database tier honours the same TTL
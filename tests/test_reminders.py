@@ -0,0 +1,94 @@
+"""Due-date reminders: every window is claimed once, so no reminder is sent twice."""
+
+import itertools
+from datetime import datetime, timedelta
+
+import pytest
+
+_names = itertools.count(1)
+
+
+@pytest.fixture
+def make_scheduler(app_module):
+    """ReminderSchedulers with their own scheduler_state row, so tests do not share windows."""
+    name = f"reminders-test-{next(_names)}"
+
+    def build(**kwargs):
+        scheduler = app_module.ReminderScheduler(**kwargs)
+        scheduler.NAME = name
+        return scheduler
+    return build
+
+
+def add_task(app_module, title, due_date, chat_id, status='To Do'):
+    session = app_module.Session()
+    try:
+        task = app_module.Task(title=title, assigned_to='@sahand', due_date=due_date, status=status, chat_id=chat_id)
+        session.add(task)
+        session.commit()
+        return task.id
+    finally:
+        session.close()
+
+
+def reminder_texts(telegram, chat_id):
+    return [data['text'] for endpoint, data in telegram.calls
+            if endpoint == 'sendMessage' and str(data.get('chat_id')) == chat_id]
+
+
+def test_window_is_sent_once(app_module, telegram, make_scheduler):
+    now = datetime.utcnow().replace(microsecond=0)
+    chat_id = '-2001'
+    task_id = add_task(app_module, 'گزارش ماهانه', now - timedelta(hours=1), chat_id)
+    scheduler = make_scheduler(lead_hours=24, catchup_hours=24)
+
+    result = scheduler.run_window(now)
+    assert result['status'] == 'ok'
+    texts = reminder_texts(telegram, chat_id)
+    assert len(texts) == 1 and f"#{task_id}" in texts[0]
+
+    assert scheduler.run_window(now) == {'status': 'skipped'}
+    scheduler.run_window(now + timedelta(minutes=5))
+    assert len(reminder_texts(telegram, chat_id)) == 1
+
+
+def test_second_instance_does_not_resend_a_claimed_window(app_module, telegram, make_scheduler):
+    now = datetime.utcnow().replace(microsecond=0)
+    chat_id = '-2002'
+    add_task(app_module, 'تمدید دامنه', now + timedelta(hours=10), chat_id)  # 'upcoming' with a 24h lead
+    first, second = make_scheduler(lead_hours=24), make_scheduler(lead_hours=24)
+
+    assert first.run_window(now)['status'] == 'ok'
+    assert second.run_window(now) == {'status': 'skipped'}
+    assert second.run_window(now - timedelta(minutes=1)) == {'status': 'skipped'}  # A clock behind the claim
+    assert len(reminder_texts(telegram, chat_id)) == 1
+
+
+def test_later_window_only_sends_new_reminders(app_module, telegram, make_scheduler):
+    now = datetime.utcnow().replace(microsecond=0)
+    chat_id = '-2003'
+    scheduler = make_scheduler(lead_hours=0, catchup_hours=24)
+    scheduler.run_window(now)  # Claims the first window before the tasks exist
+
+    due_soon = add_task(app_module, 'ارسال فاکتور', now + timedelta(minutes=30), chat_id)
+    add_task(app_module, 'بستن پروژه', now + timedelta(minutes=30), chat_id, status='Done')
+    add_task(app_module, 'جلسه بعدی', now + timedelta(hours=3), chat_id)
+
+    result = scheduler.run_window(now + timedelta(hours=1))
+    assert result['reminders'] == 1
+    texts = reminder_texts(telegram, chat_id)
+    assert len(texts) == 1 and f"#{due_soon}" in texts[0]
+
+
+def test_catchup_limits_the_window_after_downtime(app_module, telegram, make_scheduler):
+    now = datetime.utcnow().replace(microsecond=0)
+    chat_id = '-2004'
+    scheduler = make_scheduler(lead_hours=0, catchup_hours=2)
+    scheduler.run_window(now - timedelta(days=3))
+
+    add_task(app_module, 'خیلی قدیمی', now - timedelta(days=1), chat_id)
+    recent = add_task(app_module, 'تازه', now - timedelta(hours=1), chat_id)
+
+    scheduler.run_window(now)
+    texts = reminder_texts(telegram, chat_id)
+    assert len(texts) == 1 and f"#{recent}" in texts[0] and 'خیلی قدیمی' not in texts[0]
@@ -0,0 +1,126 @@
+"""Exactly-once processing of webhook updates (UpdateLedger + the synchronous webhook path)."""
+
+import pytest
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def ledger_status(app_module, update_id):
+    session = app_module.Session()
+    try:
+        row = session.get(app_module.ProcessedUpdate, update_id)
+        return row.status if row else None
+    finally:
+        session.close()
+
+
+def post_update(app_module, client, payload):
+    return client.post(app_module.WEBHOOK_PATH, json=payload).status_code
+
+
+def test_update_is_not_done_until_the_handler_commits(app_module, client, telegram, make_update, replace_handler):
+    seen = []
+
+    def write_something(update, context):
+        seen.append(ledger_status(app_module, update.update_id))
+        session = app_module.get_db_session()
+        session.add(app_module.ShoppingItem(item_name='چای'))
+        session.commit()
+        seen.append(ledger_status(app_module, update.update_id))
+        update.message.reply_text('ok')
+
+    replace_handler('list_tags', write_something)
+    payload = make_update('/tags')
+
+    assert post_update(app_module, client, payload) == 200
+    assert seen == ['processing', 'done']
+    assert ledger_status(app_module, payload['update_id']) == 'done'
+
+
+def test_standalone_session_commit_does_not_mark_the_update_done(app_module, client, telegram, make_update,
+                                                                 replace_handler):
+    seen = []
+
+    def write_on_the_side(update, context):
+        session = app_module.Session()
+        try:
+            session.add(app_module.ShoppingItem(item_name='نان'))
+            session.commit()
+        finally:
+            session.close()
+        seen.append(ledger_status(app_module, update.update_id))
+
+    replace_handler('list_tags', write_on_the_side)
+    payload = make_update('/tags')
+
+    assert post_update(app_module, client, payload) == 200
+    assert seen == ['processing']
+    assert ledger_status(app_module, payload['update_id']) == 'done'  # Marked by finish() after the handler
+
+
+def test_read_only_handler_is_marked_done(app_module, client, telegram, make_update):
+    payload = make_update('/help')
+
+    assert post_update(app_module, client, payload) == 200
+    assert ledger_status(app_module, payload['update_id']) == 'done'
+    assert telegram.texts()
+
+
+def test_handler_exception_leaves_the_update_retryable(app_module, client, telegram, make_update, replace_handler):
+    def fail(update, context):
+        raise RuntimeError('boom')
+
+    replace_handler('list_tags', fail)
+    payload = make_update('/tags')
+
+    assert post_update(app_module, client, payload) == 500
+    assert ledger_status(app_module, payload['update_id']) is None  # Released: the redelivery may claim it
+
+    handled = []
+    replace_handler('list_tags', lambda update, context: handled.append(update.update_id))
+    assert post_update(app_module, client, payload) == 200
+    assert handled == [payload['update_id']]
+    assert ledger_status(app_module, payload['update_id']) == 'done'
+
+
+def test_handler_exception_after_its_commit_keeps_the_update_done(app_module, client, telegram, make_update,
+                                                                  replace_handler):
+    def commit_then_fail(update, context):
+        session = app_module.get_db_session()
+        session.add(app_module.ShoppingItem(item_name='شیر'))
+        session.commit()
+        raise RuntimeError('boom')
+
+    replace_handler('list_tags', commit_then_fail)
+    payload = make_update('/tags')
+
+    # The handler's writes and the done mark landed together, so a redelivery must not repeat them
+    assert post_update(app_module, client, payload) == 500
+    assert ledger_status(app_module, payload['update_id']) == 'done'
+    assert post_update(app_module, client, payload) == 200
+
+
+def test_redelivery_of_a_done_update_is_ignored(app_module, client, telegram, make_update, replace_handler):
+    handled = []
+    replace_handler('list_tags', lambda update, context: handled.append(update.update_id))
+    payload = make_update('/tags')
+
+    assert post_update(app_module, client, payload) == 200
+    assert post_update(app_module, client, payload) == 200
+    assert handled == [payload['update_id']]
+
+
+def test_in_progress_duplicate_is_answered_with_503(app_module, client, telegram, make_update, replace_handler):
+    handled = []
+    replace_handler('list_tags', lambda update, context: handled.append(update.update_id))
+    payload = make_update('/tags')
+
+    assert app_module.update_ledger.claim(payload['update_id']) == 'claimed'  # Another worker holds the lease
+    try:
+        assert post_update(app_module, client, payload) == 503
+        assert handled == []
+    finally:
+        app_module.update_ledger.release(payload['update_id'])